@@ -8,7 +8,6 @@ import llm                  # LLMモジュール
 import database             # データベースモジュール
 import metrics              # 評価指標モジュール
 import data                 # データモジュール
-from config import MODEL_NAMES
 from huggingface_hub import login
 
 
@@ -33,20 +32,8 @@ database.init_db()
 # データベースが空ならサンプルデータを投入
 data.ensure_initial_data()
 
-# LLMモデルのロード
-models = {}
-with st.spinner("モデルをロード中..."):
-    for model_key, model_name in MODEL_NAMES.items():
-        try:
-            st.write(f"Loading model: {model_key} ({model_name})")
-            models[model_key] = llm.load_model(model_name)
-            st.success(f"{model_key}モデルの読み込みに成功しました。")
-        except Exception as e:
-            st.error(f"{model_key}モデルの読み込みに失敗しました: {e}")
-            models[model_key] = None
-if not any(models.values()):
-    st.error("全てのモデルの読み込みに失敗しました。アプリケーションを終了します。")
-    st.stop()
+# LLMモデルは起動時には読み込まず、チャットページで選択された時に読み込む
+model_manager = llm.get_model_manager()
 
 
 # --- Streamlit アプリケーション ---
@@ -71,15 +58,26 @@ page = st.sidebar.radio(
 
 # --- メインコンテンツ ---
 if st.session_state.page == "チャット":
-    if all(models.values()):
-        ui.display_chat_page(models)
-    else:
-        st.error("チャット機能を利用できません。モデルの読み込みに失敗しました。")
+    ui.display_chat_page(model_manager)
 elif st.session_state.page == "履歴閲覧":
     ui.display_history_page()
 elif st.session_state.page == "サンプルデータ管理":
     ui.display_data_page()
 
+# --- ロード済みモデル ---
+st.sidebar.markdown("---")
+manager_stats = model_manager.stats()
+st.sidebar.caption(
+    f"ロード済みモデル: {', '.join(manager_stats['loaded']) or 'なし'} "
+    f"({manager_stats['loaded_bytes'] / 1024 ** 2:.0f} / {manager_stats['max_memory_bytes'] / 1024 ** 2:.0f} MB)"
+)
+
+# --- 投機的デコーディング ---
+for target_key, spec_stats in llm.get_speculative_stats().items():
+    acceptance = f"{spec_stats['acceptance_rate']:.0%}" if spec_stats["acceptance_rate"] is not None else "-"
+    speedup = f"{spec_stats['speedup']:.2f}x" if spec_stats["speedup"] is not None else "-"
+    st.sidebar.caption(f"投機的デコーディング ({target_key}, {spec_stats['mode']}): 受理率 {acceptance}, 速度比 {speedup}")
+
 # --- フッター ---
 st.sidebar.markdown("---")
 st.sidebar.info("開発者: Johan Marsya")
\ No newline at end of file
@@ -0,0 +1,9 @@
+# common_path.py
+# 02_streamlit_app と 03_FastAPI で共有するモジュール（day1/common）を import できるようにする
+# 共有モジュールを import する前に `import common_path` を実行する
+import os
+import sys
+
+COMMON_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "common"))
+if COMMON_DIR not in sys.path:
+    sys.path.append(COMMON_DIR)
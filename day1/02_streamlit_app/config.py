@@ -1,6 +1,60 @@
 # config.py
 DB_FILE = "chat_feedback.db"
+# フィードバック保存のバックグラウンド書き込み設定
+HISTORY_SPILL_FILE = "chat_feedback.spill.jsonl"  # 未保存レコードの退避先（クラッシュ時に次回起動で再投入）
+HISTORY_WRITE_BATCH_SIZE = 50                     # 1トランザクションでまとめて書き込む最大件数
+HISTORY_FLUSH_INTERVAL = 0.5                      # 後続のレコードを待つ最大時間（秒）
+HISTORY_DEAD_LETTER_FILE = "chat_feedback.dead.jsonl"  # 再試行しても書き込めないレコードの隔離先
+HISTORY_WRITE_MAX_RETRIES = 3                     # 失敗したバッチを再試行する回数（超えると1件ずつ書き込む）
 MODEL_NAMES = {
     "Gemma-2-2B": "google/gemma-2-2b-jpn-it",
     "XGLM-564M": "facebook/xglm-564M"
-}
\ No newline at end of file
+}
+# 投機的デコーディング（小さいドラフトモデルが提案したトークンを大きいモデルがまとめて検証する）
+SPECULATIVE_ENABLED = False
+SPECULATIVE_PAIRS = {
+    # ターゲットのモデルキー -> ドラフトのモデルキーと、ドラフトが1回に提案するトークン数
+    "Gemma-2-2B": {"draft": "XGLM-564M", "num_assistant_tokens": 5},
+}
+SPECULATIVE_ALLOW_UNIVERSAL = True  # 語彙が異なる組でも Universal Assisted Decoding（transformers 4.46以降）を使う
+SPECULATIVE_BASELINE_EVERY = 0      # N件に1件は通常の生成で実行し、速度比の基準にする（0の場合は計測しない）
+# チャットページで生成途中の回答を読み出して表示する間隔（秒）
+CHAT_STREAM_REFRESH_SECONDS = 0.3
+# 生成を打ち切る停止文字列（EOSに加えて判定する）。チャットテンプレートのターン区切りは全モデル共通
+STOP_SEQUENCES = ["<start_of_turn>", "<end_of_turn>"]
+MODEL_STOP_SEQUENCES = {
+    # モデルキーごとに追加する停止文字列（XGLMは回答の後に次の質問を書き始めることが多い）
+    "XGLM-564M": ["質問:", "質問：", "Q:"],
+}
+# 過去の応答の長さ（chat_historyの出力トークン数・単語数）から、モデルごとに max_new_tokens の上限を決める
+ADAPTIVE_MAX_NEW_TOKENS = True
+ADAPTIVE_TOKENS_QUANTILE = 0.95   # 上限の基準にする応答トークン数の分位点
+ADAPTIVE_TOKENS_MARGIN = 1.25     # 分位点に掛ける余裕
+ADAPTIVE_TOKENS_MIN = 64          # 上限の下限
+ADAPTIVE_TOKENS_MIN_SAMPLES = 20  # 履歴がこれより少ないモデルは指定の max_new_tokens をそのまま使う
+ADAPTIVE_TOKENS_WINDOW = 500      # モデルごとに参照する直近の応答数
+# 同時にメモリへ載せておくモデルの合計サイズの上限（MB）。超える場合は最も長く使われていないモデルを解放
+MODEL_MEMORY_BUDGET_MB = 8192
+
+# CPU推論の設定
+TORCH_DTYPE = "auto"        # auto（ホストを計測して最速のものを選択）/ float32 / bfloat16 / float16
+QUANTIZE_INT8 = False       # CPU実行時にLinear層をint8へ動的量子化する
+TORCH_THREADS = None        # intra-opスレッド数（Noneの場合はCPUコア数）
+TORCH_INTEROP_THREADS = None
+
+# 応答キャッシュの設定（do_sample=False またはシード固定の決定的な生成のみ対象）
+RESPONSE_CACHE_MAX_ENTRIES = 1024   # メモリ上に保持する最大件数
+RESPONSE_CACHE_TTL_SECONDS = 3600   # 有効期間（秒）
+RESPONSE_CACHE_DB_FILE = None       # 例: "response_cache.db"（指定するとSQLiteにも保存し、再起動後も再利用）
+
+# チャットページで質問の前に付ける共通の指示文（Noneの場合は質問だけをモデルに渡す）。
+# 全質問で同じ接頭辞になるため、そのKVキャッシュを接頭辞KVキャッシュから再利用する
+CHAT_SYSTEM_PROMPT = (
+    "あなたは日本語で質問に答えるアシスタントです。質問の意図を汲み取り、正確で簡潔な回答を書いてください。"
+    "わからないことは推測で補わず、わからないと答えてください。"
+)
+
+# 接頭辞KVキャッシュの設定（システムプロンプトや参考資料など、共通の接頭辞のプリフィルを再利用）
+PREFIX_CACHE_ENABLED = True
+PREFIX_CACHE_MAX_MB = 512           # 保持するKVキャッシュの合計サイズの上限（MB）
+PREFIX_CACHE_MIN_TOKENS = 32        # これより短い接頭辞はキャッシュしない
@@ -1,10 +1,16 @@
 # database.py
 import sqlite3
+import threading
+import time
+import weakref
 import pandas as pd
 from datetime import datetime
 import streamlit as st
-from config import DB_FILE
-from metrics import calculate_metrics # metricsを計算するために必要
+from config import DB_FILE, HISTORY_SPILL_FILE, HISTORY_WRITE_BATCH_SIZE, HISTORY_FLUSH_INTERVAL
+from config import HISTORY_DEAD_LETTER_FILE, HISTORY_WRITE_MAX_RETRIES
+from metrics import calculate_metrics, calculate_metrics_batch # metricsを計算するために必要
+from history_writer import HistoryWriter
+import rollups
 
 # --- スキーマ定義 ---
 TABLE_NAME = "chat_history"
@@ -22,88 +28,381 @@ CREATE TABLE IF NOT EXISTS {TABLE_NAME}
  bleu_score REAL,
  similarity_score REAL,
  word_count INTEGER,
- relevance_score REAL)
+ relevance_score REAL,
+ templating_time REAL,       -- 以下、応答生成の段階別の処理時間（秒）と入出力トークン数
+ tokenization_time REAL,
+ prefill_time REAL,
+ decode_time REAL,
+ decode_time_per_token REAL,
+ postprocess_time REAL,
+ db_write_time REAL,         -- 評価指標の計算とINSERTにかかった時間（バッチ書き込みの場合は1件あたり）
+ input_tokens INTEGER,
+ output_tokens INTEGER)
 '''
+# 後から追加した列（既存のDBには init_db で ALTER TABLE により追加する）
+LATENCY_COLUMNS = {
+    "templating_time": "REAL",
+    "tokenization_time": "REAL",
+    "prefill_time": "REAL",
+    "decode_time": "REAL",
+    "decode_time_per_token": "REAL",
+    "postprocess_time": "REAL",
+    "db_write_time": "REAL",
+    "input_tokens": "INTEGER",
+    "output_tokens": "INTEGER",
+}
+# 履歴ページの絞り込み・並び替えをSQLite側で行うためのインデックス
+INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_timestamp ON {TABLE_NAME} (timestamp)",
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_is_correct ON {TABLE_NAME} (is_correct, timestamp)",
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_model_name ON {TABLE_NAME} (model_name, timestamp)",
+]
+
+# --- SQL文 ---
+# 同じ文字列を使い回すことで、接続ごとのプリペアドステートメントキャッシュが再利用される
+# db_write_time は書き込み後にしか分からないため、INSERT後に同じトランザクション内で更新する
+LATENCY_INSERT_COLUMNS = tuple(column for column in LATENCY_COLUMNS if column != "db_write_time")
+INSERT_COLUMNS = ("timestamp", "model_name", "question", "answer", "feedback", "correct_answer", "is_correct",
+                  "response_time", "bleu_score", "similarity_score", "word_count", "relevance_score",
+                  *LATENCY_INSERT_COLUMNS)
+INSERT_SQL = f'''
+INSERT INTO {TABLE_NAME} ({', '.join(INSERT_COLUMNS)})
+VALUES ({', '.join('?' for _ in INSERT_COLUMNS)})
+'''
+UPDATE_DB_WRITE_TIME_SQL = f"UPDATE {TABLE_NAME} SET db_write_time = ? WHERE id BETWEEN ? AND ?"
+COUNT_SQL = f"SELECT COUNT(*) FROM {TABLE_NAME}"
+SELECT_MAX_ID_SQL = f"SELECT MAX(id) FROM {TABLE_NAME}"
+DELETE_ALL_SQL = f"DELETE FROM {TABLE_NAME}"
+# モデルごとの直近の応答の長さ（max_new_tokens の上限の学習用、古い順）
+SELECT_RESPONSE_LENGTHS_SQL = f'''
+SELECT model_name, word_count, output_tokens FROM
+ (SELECT id, model_name, word_count, output_tokens,
+         ROW_NUMBER() OVER (PARTITION BY model_name ORDER BY id DESC) AS recency
+  FROM {TABLE_NAME} WHERE word_count IS NOT NULL OR output_tokens IS NOT NULL)
+WHERE recency <= ? ORDER BY id
+'''
+SELECT_FOR_RESCORE_SQL = f"SELECT id, answer, correct_answer FROM {TABLE_NAME} WHERE id > ? ORDER BY id LIMIT ?"
+UPDATE_METRICS_SQL = f'''
+UPDATE {TABLE_NAME} SET bleu_score = ?, similarity_score = ?, word_count = ?, relevance_score = ? WHERE id = ?
+'''
+
+# --- 接続管理 ---
+# WALモードでは読み込みと書き込みが互いをブロックせず、synchronous=NORMALでコミットごとのfsyncを減らせる
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-20000",     # ページキャッシュ 約20MB（負の値はKB単位）
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=30000",    # ロック中は最大30秒待ってから失敗させる
+]
+
+class _ThreadConnection:
+    """スレッドローカルに置く接続の入れ物（スレッドの終了時に破棄され、接続を閉じるきっかけになる）"""
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn):
+        self.conn = conn
+
+class ConnectionManager:
+    """スレッドごとに1本のSQLite接続を作成・再利用するプロセス共通の接続マネージャ
+
+    sqlite3の接続はスレッド間で共有しないため、Streamlitのセッション（スレッド）ごとに
+    接続を持ち、同じスレッドからの呼び出しでは開き直さずに使い回す。
+    Streamlitは再実行のたびに新しいスレッドを使うため、スレッドが終了した時点で
+    （スレッドローカルの入れ物が破棄されたときに）その接続を閉じ、接続とファイル記述子を溜めない。
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+
+    def get(self):
+        """現在のスレッド用の接続を取得する（なければ作成する）"""
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            # 接続を使うのは作成したスレッドだけだが、終了後の後始末は別のスレッドで行われることがあるため
+            # check_same_thread=False で開く
+            conn = sqlite3.connect(self.db_file, timeout=30, cached_statements=256, check_same_thread=False)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            holder = _ThreadConnection(conn)
+            self._local.holder = holder
+            with self._lock:
+                self._connections.add(conn)
+            weakref.finalize(holder, self._release, conn)
+        return holder.conn
+
+    def open_count(self):
+        """開いている接続の数"""
+        with self._lock:
+            return len(self._connections)
+
+    def _release(self, conn):
+        """スレッドの終了時に、そのスレッドの接続を閉じる"""
+        with self._lock:
+            self._connections.discard(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        """作成した全ての接続を閉じる"""
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+connection_manager = ConnectionManager(DB_FILE)
+
+def get_connection():
+    """現在のスレッド用のデータベース接続を取得する"""
+    return connection_manager.get()
 
 # --- データベース初期化 ---
 def init_db():
     """データベースとテーブルを初期化する"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(SCHEMA)
-        conn.commit()
-        conn.close()
+        conn = get_connection()
+        with conn:
+            conn.execute(SCHEMA)
+            existing_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")}
+            for column, column_type in LATENCY_COLUMNS.items():
+                if column not in existing_columns:
+                    conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {column} {column_type}")
+            for index in INDEXES:
+                conn.execute(index)
+            rollups.create_tables(conn)
+            # 集計テーブル導入前のDBでは、既存の履歴から1度だけ集計を作成する
+            if rollups.is_empty(conn) and conn.execute(COUNT_SQL).fetchone()[0] > 0:
+                rollups.rebuild(conn, TABLE_NAME)
         print(f"Database '{DB_FILE}' initialized successfully.")
     except Exception as e:
         st.error(f"データベースの初期化に失敗しました: {e}")
         raise e # エラーを再発生させてアプリの起動を止めるか、適切に処理する
 
 # --- データ操作関数 ---
-def save_to_db(model_name, question, answer, feedback, correct_answer, is_correct, response_time):
-    """チャット履歴と評価指標をデータベースに保存する"""
-    conn = None
+def save_to_db(model_name, question, answer, feedback, correct_answer, is_correct, response_time, latency=None):
+    """チャット履歴と評価指標をデータベースに保存する
+
+    latency には LatencyBreakdown.as_dict() の段階別の処理時間とトークン数を渡す（省略可）。
+    """
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
+        conn = get_connection()
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        write_start = time.perf_counter()
 
         # 追加の評価指標を計算
         bleu_score, similarity_score, word_count, relevance_score = calculate_metrics(
             answer, correct_answer
         )
 
-        c.execute(f'''
-        INSERT INTO {TABLE_NAME} (timestamp, model_name, question, answer, feedback, correct_answer, is_correct,
-                                 response_time, bleu_score, similarity_score, word_count, relevance_score)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (timestamp, model_name, question, answer, feedback, correct_answer, is_correct,
-             response_time, bleu_score, similarity_score, word_count, relevance_score))
-        conn.commit()
+        latency = latency or {}
+        row = (timestamp, model_name, question, answer, feedback, correct_answer, is_correct,
+               response_time, bleu_score, similarity_score, word_count, relevance_score,
+               *[latency.get(column) for column in LATENCY_INSERT_COLUMNS])
+        with conn:  # 成功時はコミット、例外時はロールバック
+            row_id = conn.execute(INSERT_SQL, row).lastrowid
+            rollups.apply(conn, [dict(zip(INSERT_COLUMNS, row))])
+            conn.execute(UPDATE_DB_WRITE_TIME_SQL, (time.perf_counter() - write_start, row_id, row_id))
         print("Data saved to DB successfully.") # デバッグ用
     except sqlite3.Error as e:
         st.error(f"データベースへの保存中にエラーが発生しました: {e}")
-    finally:
-        if conn:
-            conn.close()
 
-def get_chat_history():
-    """データベースから全てのチャット履歴を取得する"""
-    conn = None
+def insert_records(records):
+    """評価指標を計算したうえで、複数のレコードを1トランザクションでまとめて保存する
+
+    ライターのバックグラウンドスレッドから呼ばれるため、エラーはst.errorで表示せず例外として送出する。
+    レコードに評価指標（bleu_score など）が含まれている場合は、再計算せずにその値を保存する。
+    """
+    write_start = time.perf_counter()
+    rows = []
+    for record in records:
+        if "bleu_score" in record:
+            bleu_score, similarity_score, word_count, relevance_score = (
+                record["bleu_score"], record["similarity_score"], record["word_count"], record["relevance_score"]
+            )
+        else:
+            bleu_score, similarity_score, word_count, relevance_score = calculate_metrics(
+                record["answer"], record["correct_answer"]
+            )
+        rows.append((record["timestamp"], record["model_name"], record["question"], record["answer"],
+                     record["feedback"], record["correct_answer"], record["is_correct"], record["response_time"],
+                     bleu_score, similarity_score, word_count, relevance_score,
+                     *[record.get(column) for column in LATENCY_INSERT_COLUMNS]))
+    conn = get_connection()
+    with conn:
+        conn.executemany(INSERT_SQL, rows)
+        # 同じトランザクション内で連続して採番されるため、最後のidから今回のレコードの範囲が分かる
+        # （集計テーブルへのUPSERTの後では last_insert_rowid() が集計テーブルの行を指すため、先に読む）
+        last_id = conn.execute(SELECT_MAX_ID_SQL).fetchone()[0]
+        rollups.apply(conn, [dict(zip(INSERT_COLUMNS, row)) for row in rows])
+        per_record = (time.perf_counter() - write_start) / max(len(rows), 1)
+        conn.execute(UPDATE_DB_WRITE_TIME_SQL, (per_record, last_id - len(rows) + 1, last_id))
+
+@st.cache_resource
+def get_history_writer():
+    """全セッションで共有するバックグラウンド書き込みライターを取得"""
+    return HistoryWriter(
+        insert_records,
+        HISTORY_SPILL_FILE,
+        batch_size=HISTORY_WRITE_BATCH_SIZE,
+        flush_interval=HISTORY_FLUSH_INTERVAL,
+        dead_letter_file=HISTORY_DEAD_LETTER_FILE,
+        max_retries=HISTORY_WRITE_MAX_RETRIES,
+    )
+
+def save_to_db_async(model_name, question, answer, feedback, correct_answer, is_correct, response_time, latency=None):
+    """チャット履歴を書き込みキューに積んですぐに戻る（評価指標の計算と保存はバックグラウンドで行う）"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        # is_correctがREAL型なので、それに応じて読み込む
-        df = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC", conn)
-        # is_correct カラムのデータ型を確認し、必要なら変換
+        get_history_writer().submit({
+            **(latency or {}),
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "model_name": model_name,
+            "question": question,
+            "answer": answer,
+            "feedback": feedback,
+            "correct_answer": correct_answer,
+            "is_correct": is_correct,
+            "response_time": response_time,
+        })
+    except OSError as e:
+        # スピルファイルに書けない場合は同期的に保存する
+        print(f"書き込みキューへの追加に失敗したため同期的に保存します: {e}")
+        save_to_db(model_name, question, answer, feedback, correct_answer, is_correct, response_time, latency)
+
+def rescore_chat_history(chunk_size=1000, progress=None, score_batch=calculate_metrics_batch):
+    """保存済みの全履歴の評価指標を、チャンク単位のバッチ計算で再計算する
+
+    idの昇順にチャンクを読み出し（キーセットページング）、チャンクごとに calculate_metrics_batch で計算して
+    1トランザクションで更新する。最後に集計テーブルを作り直す。
+
+    Args:
+        chunk_size: 1回に読み出して計算する件数
+        progress: 処理済み件数と全件数を受け取るコールバック（省略可）
+        score_batch: (回答のリスト, 正解のリスト) から指標のリストを返す関数（並列計算する場合に差し替える）
+
+    Returns:
+        更新した件数
+    """
+    conn = get_connection()
+    total = conn.execute(COUNT_SQL).fetchone()[0]
+    updated, last_id = 0, 0
+    while True:
+        chunk = conn.execute(SELECT_FOR_RESCORE_SQL, (last_id, int(chunk_size))).fetchall()
+        if not chunk:
+            break
+        ids = [row[0] for row in chunk]
+        scores = score_batch([row[1] for row in chunk], [row[2] for row in chunk])
+        with conn:
+            conn.executemany(UPDATE_METRICS_SQL, [score + (row_id,) for score, row_id in zip(scores, ids)])
+        updated += len(chunk)
+        last_id = ids[-1]
+        if progress is not None:
+            progress(updated, total)
+    with conn:
+        rollups.rebuild(conn, TABLE_NAME)
+    return updated
+
+def _history_filters(is_correct=None, model_name=None):
+    """履歴の絞り込み条件をWHERE句とパラメータに変換する"""
+    conditions, params = [], []
+    if is_correct is not None:
+        conditions.append("is_correct = ?")
+        params.append(is_correct)
+    if model_name is not None:
+        conditions.append("model_name = ?")
+        params.append(model_name)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+def query_chat_history(is_correct=None, model_name=None, limit=20, offset=0, cursor=None):
+    """条件に一致する履歴を新しい順に1ページ分だけ取得する
+
+    絞り込み・並び替え・ページングはインデックスを使ってSQLite側で行い、必要な行だけを読み込む。
+
+    Args:
+        is_correct: 正確性で絞り込む（1.0 / 0.5 / 0.0、Noneの場合は絞り込まない）
+        model_name: モデル名で絞り込む
+        limit: 1ページの件数
+        offset: 先頭から読み飛ばす件数（cursorを指定した場合は無視）
+        cursor: 前ページ最終行の (timestamp, id)。指定するとその続きから取得する（キーセットページング）
+    """
+    where, params = _history_filters(is_correct, model_name)
+    if cursor is not None:
+        keyset = "(timestamp < ? OR (timestamp = ? AND id < ?))"
+        where = f"{where} AND {keyset}" if where else f"WHERE {keyset}"
+        # DataFrame から取り出した id は numpy.int64 のため、int に戻して整数として比較させる
+        params += [cursor[0], cursor[0], int(cursor[1])]
+        offset = 0
+    sql = f"SELECT * FROM {TABLE_NAME} {where} ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+    try:
+        df = pd.read_sql_query(sql, get_connection(), params=params + [int(limit), int(offset)])
         if 'is_correct' in df.columns:
-             df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce') # 数値に変換、失敗したらNaN
+            df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce')
         return df
     except sqlite3.Error as e:
         st.error(f"履歴の取得中にエラーが発生しました: {e}")
-        return pd.DataFrame() # 空のDataFrameを返す
-    finally:
-        if conn:
-            conn.close()
+        return pd.DataFrame()
+
+def count_chat_history(is_correct=None, model_name=None):
+    """条件に一致する履歴の件数を取得する"""
+    where, params = _history_filters(is_correct, model_name)
+    try:
+        return get_connection().execute(f"SELECT COUNT(*) FROM {TABLE_NAME} {where}", params).fetchone()[0]
+    except sqlite3.Error as e:
+        st.error(f"レコード数の取得中にエラーが発生しました: {e}")
+        return 0
+
+def get_metrics_rollup(metric=None):
+    """評価分析タブ用の集計値を集計テーブルから取得する（履歴テーブルは読まない）
+
+    Returns:
+        accuracy_counts, model_accuracy, stats を持つ辞書。metric を指定した場合は
+        その指標のヒストグラム（histogram, bin_labels）とモデルごとの平均（model_means）も含む
+    """
+    try:
+        conn = get_connection()
+        summary = {
+            "accuracy_counts": rollups.accuracy_counts(conn),
+            "model_accuracy": rollups.model_accuracy(conn),
+            "stats": rollups.metric_stats(conn),
+        }
+        if metric is not None:
+            summary["histogram"] = rollups.histogram(conn, metric)
+            summary["bin_labels"] = rollups.bin_labels(metric)
+            summary["model_means"] = rollups.metric_means_by_model(conn, metric)
+        return summary
+    except sqlite3.Error as e:
+        st.error(f"集計データの取得中にエラーが発生しました: {e}")
+        return {"accuracy_counts": {}, "model_accuracy": {}, "stats": {}}
+
+def get_response_lengths(limit_per_model=500):
+    """モデルごとの直近の応答の (モデル名, 単語数, 出力トークン数) を古い順に取得する"""
+    try:
+        return get_connection().execute(SELECT_RESPONSE_LENGTHS_SQL, (limit_per_model,)).fetchall()
+    except sqlite3.Error as e:
+        st.warning(f"応答の長さの取得に失敗しました: {e}")
+        return []
 
 def get_db_count():
     """データベース内のレコード数を取得する"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}")
-        count = c.fetchone()[0]
+        conn = get_connection()
+        count = conn.execute(COUNT_SQL).fetchone()[0]
         return count
     except sqlite3.Error as e:
         st.error(f"レコード数の取得中にエラーが発生しました: {e}")
         return 0
-    finally:
-        if conn:
-            conn.close()
 
 def clear_db():
     """データベースの全レコードを削除する"""
-    conn = None
     confirmed = st.session_state.get("confirm_clear", False)
 
     if not confirmed:
@@ -112,17 +411,16 @@ def clear_db():
         return False # 削除は実行されなかった
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"DELETE FROM {TABLE_NAME}")
-        conn.commit()
+        # 書き込み待ちのレコードが削除後に保存されないよう、先に書き込みを終わらせる
+        get_history_writer().flush(timeout=10)
+        conn = get_connection()
+        with conn:
+            conn.execute(DELETE_ALL_SQL)
+            rollups.clear(conn)
         st.success("データベースが正常にクリアされました。")
         st.session_state.confirm_clear = False # 確認状態をリセット
         return True # 削除成功
     except sqlite3.Error as e:
         st.error(f"データベースのクリア中にエラーが発生しました: {e}")
         st.session_state.confirm_clear = False # エラー時もリセット
-        return False # 削除失敗
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        return False # 削除失敗
\ No newline at end of file
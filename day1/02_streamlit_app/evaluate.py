@@ -0,0 +1,245 @@
+# evaluate.py
+# 質問と正解のセットに対して、設定された全モデルで回答を生成して評価するオフライン評価コマンド
+# 使い方: python evaluate.py --questions questions.jsonl [--models Gemma-2-2B] [--batch-size 8] [--concurrency 2]
+#
+# 質問ファイルは1行1件のJSON Lines（{"question": "...", "correct_answer": "..."}）。
+# 省略した場合はサンプルデータ（SAMPLE_QUESTIONS_DATA）の質問を使う。
+# 結果は --output のファイルに1件ずつ追記され、同じファイルを指定して再実行すると未処理の質問から再開する。
+#
+# Streamlitの外で実行するため、st.cache_resource の共有オブジェクトや session_state は使わず、
+# モデルマネージャはこのコマンドで作成する。応答キャッシュ・接頭辞キャッシュ・max_new_tokens の上限・
+# 投機的デコーディングは使わず、モデルの通常の生成を計測する。
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from config import MODEL_NAMES, MODEL_MEMORY_BUDGET_MB, TORCH_THREADS, TORCH_INTEROP_THREADS, CHAT_SYSTEM_PROMPT
+from database import init_db, insert_records
+from llm import build_prompt, generate_text, get_stop_sequences, load_model
+from metrics import calculate_metrics_batch
+from model_manager import ModelManager
+import common_path  # noqa: F401  day1/common の共有モジュールを import できるようにする
+from cpu_profile import configure_threads
+from latency import LatencyBreakdown
+
+METRIC_NAMES = ["bleu_score", "similarity_score", "word_count", "relevance_score"]
+
+
+def iter_questions(path=None):
+    """質問と正解を1件ずつ読み出す（ファイル全体をメモリに載せない）"""
+    if path is None:
+        from data import SAMPLE_QUESTIONS_DATA
+        for index, item in enumerate(SAMPLE_QUESTIONS_DATA):
+            yield index, item["question"], item.get("correct_answer", "")
+        return
+    with open(path, encoding="utf-8") as f:
+        index = 0
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            yield index, item["question"], item.get("correct_answer", "")
+            index += 1
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_results(path):
+    """結果ファイルを読み込み、(モデル, 質問番号) -> 結果 と バッチの記録を返す"""
+    items, batches = {}, []
+    if not os.path.exists(path):
+        return items, batches
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 書き込み途中で中断した最終行は無視する
+            if entry.get("type") == "batch":
+                batches.append(entry)
+            else:
+                items[(entry["model"], entry["index"])] = entry
+    return items, batches
+
+
+def open_results(path):
+    """結果ファイルを追記用に開く（中断で途中まで書かれた最終行があれば、追記する結果と混ざらないよう改行する）"""
+    torn = False
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+    output = open(path, "a", encoding="utf-8")
+    if torn:
+        output.write("\n")
+    return output
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))] if values else 0.0
+
+
+def distribution(values):
+    """平均・中央値・p95・最小・最大"""
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def evaluate_model(model_key, pipe, questions_path, output, done, args):
+    """1つのモデルで全ての質問に回答し、バッチごとに結果ファイルとDBへ書き込む"""
+    model_name = MODEL_NAMES[model_key]
+    pending = (item for item in iter_questions(questions_path) if (model_key, item[0]) not in done)
+    generation_kwargs = {
+        "max_new_tokens": args.max_new_tokens,
+        "do_sample": not args.greedy,
+        "temperature": args.temperature,
+        "top_p": args.top_p,
+    }
+    stop_sequences = get_stop_sequences(pipe)
+
+    def answer(item):
+        _, question, _ = item
+        latency = LatencyBreakdown()
+        start_time = time.time()
+        try:
+            # チャットページと同じ指示文を付けて生成する
+            response = generate_text(pipe, build_prompt(question, CHAT_SYSTEM_PROMPT), generation_kwargs, latency,
+                                     stop_sequences)
+        except Exception as e:
+            print(f"[{model_key}] 回答生成中にエラーが発生しました: {e}")
+            response = f"エラー: {str(e)}"
+        return response, time.time() - start_time, latency.as_dict()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="evaluate") as executor:
+        for batch in iter_batches(pending, args.batch_size):
+            batch_start = time.time()
+            responses = list(executor.map(answer, batch))  # 入力と同じ順序で返る
+            wall_time = time.time() - batch_start
+
+            answers = [response for response, _, _ in responses]
+            scores = calculate_metrics_batch(answers, [item[2] for item in batch])
+            entries, records = [], []
+            for (index, question, correct_answer), (response, latency, breakdown), score in zip(batch, responses, scores):
+                tokens = breakdown["output_tokens"]
+                if tokens is None:  # 生成に失敗した場合
+                    tokens = len(pipe.tokenizer(response, add_special_tokens=False).input_ids)
+                entry = {"model": model_key, "index": index, "latency": latency, "tokens": tokens,
+                         **dict(zip(METRIC_NAMES, score))}
+                entries.append(entry)
+                records.append({
+                    **breakdown,
+                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "model_name": model_name,
+                    "question": question,
+                    "answer": response,
+                    "feedback": "オフライン評価",
+                    "correct_answer": correct_answer,
+                    "is_correct": None,  # 人手の判定はないため未設定
+                    "response_time": latency,
+                    **dict(zip(METRIC_NAMES, score)),
+                })
+            if not args.no_save:
+                insert_records(records)
+
+            # 結果を追記してから次のバッチへ進む（中断時はここまでが再開時にスキップされる）
+            for entry in entries:
+                output.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            output.write(json.dumps({"type": "batch", "model": model_key, "size": len(batch),
+                                     "wall_time": wall_time, "tokens": sum(e["tokens"] for e in entries)}) + "\n")
+            output.flush()
+            os.fsync(output.fileno())
+            print(f"[{model_key}] {len(batch)} 件を処理しました（{wall_time:.1f}s）")
+
+
+def summarize(items, batches):
+    """モデルごとのスループット、レイテンシ、評価指標の分布を集計する"""
+    report = {}
+    for model_key in sorted({model for model, _ in items}):
+        results = [entry for (model, _), entry in items.items() if model == model_key]
+        model_batches = [batch for batch in batches if batch["model"] == model_key]
+        wall_time = sum(batch["wall_time"] for batch in model_batches)
+        latencies = [entry["latency"] for entry in results]
+        report[model_key] = {
+            "questions": len(results),
+            "tokens_per_second": sum(batch["tokens"] for batch in model_batches) / wall_time if wall_time else 0.0,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "metrics": {metric: distribution([entry[metric] for entry in results]) for metric in METRIC_NAMES},
+        }
+    return report
+
+
+def print_report(report):
+    for model_key, summary in report.items():
+        print(f"\n=== {model_key} ({summary['questions']} 件) ===")
+        print(f"スループット: {summary['tokens_per_second']:.1f} tokens/s")
+        print(f"レイテンシ: p50={summary['latency_p50']:.2f}s, p95={summary['latency_p95']:.2f}s")
+        for metric, stats in summary["metrics"].items():
+            print(f"  {metric:<17} mean={stats['mean']:.3f} p50={stats['p50']:.3f} p95={stats['p95']:.3f} "
+                  f"min={stats['min']:.3f} max={stats['max']:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="設定された全モデルで質問セットを評価します")
+    parser.add_argument("--questions", help="質問と正解のJSON Linesファイル（省略時はサンプルデータ）")
+    parser.add_argument("--models", nargs="*", choices=list(MODEL_NAMES), help="評価するモデル（省略時は全て）")
+    parser.add_argument("--output", default="eval_results.jsonl", help="結果ファイル（再実行時はここから再開）")
+    parser.add_argument("--report", help="集計結果を保存するJSONファイル")
+    parser.add_argument("--batch-size", type=int, default=8, help="まとめて処理・保存する質問数")
+    parser.add_argument("--concurrency", type=int, default=1, help="同時に生成するリクエスト数")
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--greedy", action="store_true", help="サンプリングせずに生成する")
+    parser.add_argument("--no-save", action="store_true", help="結果をchat_historyに保存しない")
+    args = parser.parse_args()
+
+    if not args.no_save:
+        init_db()
+    done, _ = load_results(args.output)
+    if done:
+        print(f"{args.output} から {len(done)} 件の結果を読み込みました。未処理の質問から再開します。")
+
+    configure_threads(TORCH_THREADS, TORCH_INTEROP_THREADS)
+    manager = ModelManager(
+        MODEL_NAMES,
+        lambda model_name: load_model(model_name, notify=lambda kind, message: print(message)),
+        max_memory_bytes=MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+    )
+    with open_results(args.output) as output:
+        for model_key in args.models or list(MODEL_NAMES):
+            # 評価中は解放させず、終わったら参照を残さない（次のモデルのロード時に解放できるように）
+            with manager.use(model_key) as pipe:
+                if pipe is None:
+                    print(f"[{model_key}] モデルをロードできなかったためスキップします。")
+                    continue
+                evaluate_model(model_key, pipe, args.questions, output, done, args)
+            del pipe
+
+    report = summarize(*load_results(args.output))
+    print_report(report)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
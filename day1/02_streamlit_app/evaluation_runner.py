@@ -0,0 +1,58 @@
+# evaluation_runner.py
+# 評価指標の計算（Janome・NLTK・TF-IDF）はPythonコードが中心でGILに縛られるため、
+# (回答, 正解) の組をシャードに分けてプロセスプールで並列に計算する
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import calculate_metrics_batch, get_tokenizer
+
+
+def _init_worker():
+    """ワーカープロセスの初期化。トークナイザー（辞書の読み込み）をプロセスごとに1度だけ作成する"""
+    get_tokenizer()
+
+
+def _score_shard(shard):
+    answers, correct_answers = shard
+    return calculate_metrics_batch(answers, correct_answers)
+
+
+class ParallelScorer:
+    """評価指標をプロセスプールで並列に計算する
+
+    calculate_metrics_batch と同じ呼び出し方ができるため、rescore_chat_history の score_batch に渡せる。
+    結果は入力と同じ順序で返す。
+
+    Args:
+        workers: ワーカープロセス数（Noneの場合はCPUコア数）
+        shard_size: 1つのワーカーにまとめて渡す組の数
+    """
+
+    def __init__(self, workers=None, shard_size=256):
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_size = max(1, int(shard_size))
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def __call__(self, answers, correct_answers):
+        answers, correct_answers = list(answers), list(correct_answers)
+        if len(answers) != len(correct_answers):
+            raise ValueError("answers と correct_answers の件数が一致しません")
+        shards = [
+            (answers[i:i + self.shard_size], correct_answers[i:i + self.shard_size])
+            for i in range(0, len(answers), self.shard_size)
+        ]
+        results = []
+        # mapは投入順に結果を返すため、シャードを結合すれば入力と同じ順序になる
+        for shard_scores in self.executor.map(_score_shard, shards):
+            results.extend(shard_scores)
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+        return False
@@ -0,0 +1,113 @@
+# generation_job.py
+# チャットページの回答生成をセッションごとのバックグラウンドスレッドで実行する。
+# スクリプトの実行スレッドは生成の完了を待たずに戻り、画面は生成途中のテキストを定期的に読み出して表示する。
+# このスレッドからは st.* や st.session_state を使わず、警告・エラーは notices に積んで画面側で表示する
+import logging
+import threading
+import time
+
+from transformers import TextStreamer
+
+import common_path  # noqa: F401  day1/common の共有モジュールを import できるようにする
+from latency import LatencyBreakdown
+from llm import collect_notices, generate_response, get_stop_sequences, prepare_generation
+from stopping import split_stop_sequences, safe_stream_length
+
+
+class _BufferStreamer(TextStreamer):
+    """デコードしたテキストを標準出力ではなくコールバックに渡すストリーマー"""
+
+    def __init__(self, tokenizer, on_text):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self._on_text = on_text
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self._on_text(text)
+
+
+class GenerationJob:
+    """1件の質問に対する回答の生成（作成と同時にバックグラウンドスレッドで開始する）
+
+    生成途中のテキストは partial_text、完了後の結果は answer・response_time・latency で参照する。
+    モデルロード・生成中の通知（{"type", "message"}）は notices に積まれる。
+    cancel() を呼ぶと次のトークンで生成を打ち切り、そこまでのテキストを回答にする。
+    """
+
+    def __init__(self, pipe, question, model_name, **generation_kwargs):
+        self.question = question
+        self.model_name = model_name
+        self.started_at = time.time()
+        self.answer = None
+        self.response_time = 0.0
+        self.latency = None
+        self._notices = []
+        self._pipe = pipe
+        # 共有オブジェクトの作成やドラフトモデルのロードは、呼び出し元（スクリプトの実行スレッド）で済ませる
+        prepare_generation(pipe)
+        self._generation_kwargs = generation_kwargs
+        # 特殊トークンの停止文字列はストリーマーに出力されないため、文字列の停止文字列だけを表示前に判定する
+        self._stop_strings = split_stop_sequences(pipe.tokenizer, get_stop_sequences(pipe))[1]
+        self._chunks = []
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._done_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-generation", daemon=True)
+        self._thread.start()
+
+    def _append(self, text):
+        with self._lock:
+            self._chunks.append(text)
+
+    def _run(self):
+        latency = LatencyBreakdown()
+        try:
+            with collect_notices(self._notices):
+                self.answer, self.response_time = generate_response(
+                    self._pipe, self.question,
+                    latency=latency,
+                    streamer=_BufferStreamer(self._pipe.tokenizer, self._append),
+                    cancel_event=self._cancel_event,
+                    **self._generation_kwargs,
+                )
+            self.latency = latency.as_dict()
+        except Exception as e:
+            logging.error(f"バックグラウンドでの回答生成中にエラーが発生しました: {e}")
+            self._notices.append({"type": "error", "message": f"回答生成中にエラーが発生しました: {e}"})
+            self.answer, self.response_time = f"エラー: {str(e)}", time.time() - self.started_at
+        finally:
+            self._pipe = None  # 完了後もセッションに残るジョブが、解放されたモデルを参照し続けないようにする
+            self._done_event.set()
+
+    @property
+    def done(self):
+        return self._done_event.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def notices(self):
+        """これまでの通知（{"type": "info" / "success" / "warning" / "error", "message"}）のコピー"""
+        return list(self._notices)
+
+    @property
+    def partial_text(self):
+        """これまでに生成されたテキスト（停止文字列とその途中になりうる末尾は含めない）"""
+        with self._lock:
+            text = "".join(self._chunks)
+        length, _ = safe_stream_length(text, self._stop_strings)
+        return text[:length]
+
+    def cancel(self):
+        """生成を打ち切る（既に完了している場合は何もしない）"""
+        self._cancel_event.set()
+
+    def wait(self, timeout=None):
+        """生成の完了を待つ（完了した場合はTrue）"""
+        return self._done_event.wait(timeout)
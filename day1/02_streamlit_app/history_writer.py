@@ -0,0 +1,194 @@
+# history_writer.py
+# チャット履歴の保存をリクエスト処理から切り離す、バッチ書き込み（ライトビハインド）キュー
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+
+class HistoryWriter:
+    """レコードを即座に受け付け、バックグラウンドスレッドでまとめて書き込むライター
+
+    受け付けたレコードはまずスピルファイル（JSON Lines）に追記してfsyncするため、
+    書き込み前にプロセスが落ちても次回起動時に再投入される。書き込みが完了したレコードは
+    スピルファイルに完了マーカーを追記し、未処理のレコードがなくなった時点でファイルを空にする。
+
+    バッチの書き込みは max_retries 回まで再試行し、それでも失敗した場合は1件ずつ書き込む。
+    1件でも書き込めないレコードはエラー内容とともに隔離ファイル（dead_letter_file）に移し、
+    1件の不正なレコードのために後続の書き込みが止まらないようにする。
+
+    Args:
+        write_batch: レコード(dict)のリストを受け取り、1トランザクションで保存する関数
+        spill_file: 未保存レコードを退避するファイルのパス
+        batch_size: 1回の書き込みでまとめる最大件数
+        flush_interval: 最初のレコードが届いてから後続を待つ最大時間（秒）
+        dead_letter_file: 書き込めなかったレコードの隔離先（JSON Lines、省略時はスピルファイル名 + ".dead"）
+        max_retries: 失敗したバッチを再試行する回数
+        retry_interval: 再試行までの待ち時間（秒）
+    """
+
+    def __init__(self, write_batch, spill_file, batch_size=50, flush_interval=0.5, dead_letter_file=None,
+                 max_retries=3, retry_interval=1.0):
+        self.write_batch = write_batch
+        self.spill_file = spill_file
+        self.dead_letter_file = dead_letter_file or f"{spill_file}.dead"
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.max_retries = max(0, int(max_retries))
+        self.retry_interval = float(retry_interval)
+        self._queue = queue.Queue()
+        self._spill_lock = threading.Lock()
+        self._pending = 0  # 受け付け済みで未書き込みの件数
+        self._idle = threading.Condition()
+        self.written_total = 0
+        self.failed_batches = 0
+        self.quarantined_total = 0
+
+        # 前回終了時に書き込めなかったレコードを再投入する
+        for record in self._load_unwritten():
+            self._enqueue(record)
+
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        """レコードを受け付ける（スピルファイルへの追記後すぐに戻る）"""
+        record = dict(record)
+        record.setdefault("_id", uuid.uuid4().hex)
+        # スピルファイルへの追記と未処理件数の更新を同時に行い、空にする処理と競合しないようにする
+        with self._idle:
+            self._append_spill({"record": record})
+            self._pending += 1
+        self._queue.put(record)
+        return record["_id"]
+
+    def _enqueue(self, record):
+        with self._idle:
+            self._pending += 1
+        self._queue.put(record)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def flush(self, timeout=None):
+        """受け付け済みのレコードが全て書き込まれるまで待つ。時間内に終わればTrue"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._idle:
+            while self._pending > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    # --- スピルファイル ---
+    def _append_spill(self, entry):
+        with self._spill_lock:
+            _append_line(self.spill_file, entry)
+
+    def _load_unwritten(self):
+        """スピルファイルから、完了マーカーのないレコードを読み出す"""
+        if not os.path.exists(self.spill_file):
+            return []
+        records, done = {}, set()
+        with open(self.spill_file, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 書き込み途中で落ちた最終行などは無視する
+                if "record" in entry:
+                    records[entry["record"]["_id"]] = entry["record"]
+                elif "done" in entry:
+                    done.update(entry["done"])
+        unwritten = [record for record_id, record in records.items() if record_id not in done]
+        if unwritten:
+            logging.info(f"スピルファイルから未保存のレコード {len(unwritten)} 件を再投入します。")
+        # 未処理分だけでファイルを作り直す
+        with self._spill_lock:
+            with open(self.spill_file, "w", encoding="utf-8") as f:
+                for record in unwritten:
+                    f.write(json.dumps({"record": record}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        return unwritten
+
+    # --- バックグラウンド処理 ---
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_with_retries(self, batch):
+        """バッチを書き込む（失敗した場合は max_retries 回まで再試行する）。書き込めればTrue"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.write_batch(batch)
+                return True
+            except Exception as e:
+                logging.error(f"履歴のバッチ書き込みに失敗しました（{len(batch)}件、{attempt + 1}回目）: {e}")
+                if attempt < self.max_retries:
+                    time.sleep(self.retry_interval)
+        return False
+
+    def _write_one_by_one(self, batch):
+        """1件ずつ書き込み、書き込めなかったレコードを隔離ファイルに移す。書き込めた件数を返す"""
+        written = 0
+        for record in batch:
+            try:
+                self.write_batch([record])
+                written += 1
+            except Exception as e:
+                logging.error(f"履歴のレコードを書き込めないため隔離します（_id={record['_id']}）: {e}")
+                # 完了マーカーより先に隔離ファイルへ書き、途中で落ちてもレコードを失わないようにする
+                _append_line(self.dead_letter_file, {"record": record, "error": str(e), "failed_at": time.time()})
+                self.quarantined_total += 1
+        return written
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if self._write_with_retries(batch):
+                written = len(batch)
+            else:
+                self.failed_batches += 1
+                written = self._write_one_by_one(batch)
+
+            self._append_spill({"done": [record["_id"] for record in batch]})
+            self.written_total += written
+            with self._idle:
+                self._pending -= len(batch)
+                if self._pending == 0:
+                    # 未処理がなくなったらスピルファイルを空にして肥大化を防ぐ
+                    with self._spill_lock:
+                        open(self.spill_file, "w").close()
+                    self._idle.notify_all()
+            logging.debug(f"履歴を {written} 件まとめて保存しました。")
+
+    def stats(self):
+        return {
+            "pending": self._pending,
+            "written_total": self.written_total,
+            "failed_batches": self.failed_batches,
+            "quarantined_total": self.quarantined_total,
+        }
+
+
+def _append_line(path, entry):
+    """JSON Lines のファイルに1行追記し、ディスクに書き出す"""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
@@ -1,42 +1,204 @@
 import torch
-from transformers import pipeline
+from transformers import pipeline, set_seed, StoppingCriteriaList
 import streamlit as st
 import time
 import logging
-from config import MODEL_NAMES
+import threading
+from contextlib import contextmanager
+from config import MODEL_NAMES, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_DB_FILE
+from config import PREFIX_CACHE_ENABLED, PREFIX_CACHE_MAX_MB, PREFIX_CACHE_MIN_TOKENS, MODEL_MEMORY_BUDGET_MB
+from config import TORCH_DTYPE, QUANTIZE_INT8, TORCH_THREADS, TORCH_INTEROP_THREADS
+from config import SPECULATIVE_ENABLED, SPECULATIVE_PAIRS, SPECULATIVE_ALLOW_UNIVERSAL, SPECULATIVE_BASELINE_EVERY
+from config import STOP_SEQUENCES, MODEL_STOP_SEQUENCES, ADAPTIVE_MAX_NEW_TOKENS, ADAPTIVE_TOKENS_QUANTILE
+from config import ADAPTIVE_TOKENS_MARGIN, ADAPTIVE_TOKENS_MIN, ADAPTIVE_TOKENS_MIN_SAMPLES, ADAPTIVE_TOKENS_WINDOW
+import common_path  # noqa: F401  day1/common の共有モジュールを import できるようにする
+from cpu_profile import select_dtype, configure_threads, quantize_int8
+from response_cache import ResponseCache, is_cacheable, make_cache_key
+from prefix_cache import PrefixKVCache, generate_with_prefix_cache
+from model_manager import ModelManager
+from latency import LatencyBreakdown, TokenTimer
+from speculative import SpeculativeDecoder
+from stopping import AdaptiveTokenBudget, stopping_kwargs, truncate_at_stop
+from database import get_response_lengths
 
 # ロギング設定
 logging.basicConfig(level=logging.DEBUG, filename='app.log', filemode='a',
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-@st.cache_resource
-def load_model(model_name):
-    """指定されたLLMモデルをロード"""
+# バックグラウンドスレッド（generation_job.py）では st.* や st.session_state を使えないため、
+# モデルロード・生成中の通知はスレッドごとの受け取り先に積み、画面側で表示する
+_notice_sink = threading.local()
+
+@contextmanager
+def collect_notices(notices):
+    """このスレッドでのモデルロード・回答生成の通知（{"type", "message"} のdict）を notices に積む"""
+    previous = getattr(_notice_sink, "notices", None)
+    _notice_sink.notices = notices
+    try:
+        yield notices
+    finally:
+        _notice_sink.notices = previous
+
+def _notify(kind, message, deferred=False):
+    """通知を表示する（collect_notices の中では表示せずに受け取り先に積む）
+
+    deferred=True の場合は、すぐに表示せず display_load_messages で表示するメッセージとして保存する。
+    """
+    notices = getattr(_notice_sink, "notices", None)
+    if notices is not None:
+        notices.append({"type": kind, "message": message})
+    elif deferred:
+        st.session_state.setdefault("load_messages", []).append({"type": kind, "message": message})
+    else:
+        getattr(st, kind)(message)
+
+def load_model(model_name, notify=None):
+    """指定されたLLMモデルをロード（ロード済みモデルの保持・解放はModelManagerが行う）
+
+    notify(kind, message) を渡すとロードの通知をそこに送る（省略時は画面に表示するメッセージとして保存する）。
+    """
+    if notify is None:
+        def notify(kind, message):
+            _notify(kind, message, deferred=True)
     try:
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        st.session_state.setdefault("load_messages", []).append(
-            {"type": "info", "message": f"モデル '{model_name}' を {device} にロード中..."}
-        )
+        notify("info", f"モデル '{model_name}' を {device} にロード中...")
+        # int8動的量子化はfloat32の重みに対して行うため、量子化する場合はfloat32で読み込む
+        quantize = QUANTIZE_INT8 and device == "cpu"
+        torch_dtype, dtype_info = select_dtype(device, "float32" if quantize else TORCH_DTYPE)
+        logging.info(f"使用dtype: {dtype_info}")
         pipe = pipeline(
             "text-generation",
             model=model_name,
-            model_kwargs={"torch_dtype": torch.bfloat16},
+            model_kwargs={"torch_dtype": torch_dtype},
             device=device
         )
+        if quantize:
+            pipe.model = quantize_int8(pipe.model)
+        profile = f"dtype={dtype_info['dtype']}, 量子化={'int8' if quantize else 'なし'}, スレッド数={torch.get_num_threads()}"
         # トークナイザーのchat_templateを確認
         has_chat_template = hasattr(pipe.tokenizer, 'chat_template') and pipe.tokenizer.chat_template is not None
-        st.session_state["load_messages"].append(
-            {"type": "success", "message": f"モデル '{model_name}' のロードに成功しました。Chatテンプレート: {has_chat_template}"}
-        )
-        logging.info(f"モデル '{model_name}' のロードに成功しました。Chatテンプレート: {has_chat_template}")
+        notify("success", f"モデル '{model_name}' のロードに成功しました。Chatテンプレート: {has_chat_template} ({profile})")
+        logging.info(f"モデル '{model_name}' のロードに成功しました。Chatテンプレート: {has_chat_template} ({profile})")
         return pipe
     except Exception as e:
-        st.session_state["load_messages"].append(
-            {"type": "error", "message": f"モデル '{model_name}' のロードに失敗しました: {e}"}
-        )
+        notify("error", f"モデル '{model_name}' のロードに失敗しました: {e}")
         logging.error(f"モデル '{model_name}' のロードに失敗しました: {e}")
         return None
 
+@st.cache_resource
+def get_model_manager():
+    """全セッションで共有するモデルマネージャを取得（モデルは初回利用時にロードされる）"""
+    # スレッド数はプロセス全体の設定のため、マネージャ作成時に1度だけ行う
+    threads = configure_threads(TORCH_THREADS, TORCH_INTEROP_THREADS)
+    logging.info(f"torchスレッド数を設定しました: {threads}")
+    manager = ModelManager(MODEL_NAMES, load_model, max_memory_bytes=MODEL_MEMORY_BUDGET_MB * 1024 * 1024)
+    # 解放したモデルを投機的デコーディングの組が参照し続けないよう、組を破棄する
+    manager.add_unload_listener(drop_speculative_decoders)
+    return manager
+
+@st.cache_resource
+def get_response_cache():
+    """全セッションで共有する応答キャッシュを取得"""
+    return ResponseCache(
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+        db_path=RESPONSE_CACHE_DB_FILE,
+    )
+
+@st.cache_resource
+def get_prefix_cache():
+    """全セッションで共有する接頭辞KVキャッシュを取得"""
+    return PrefixKVCache(
+        max_bytes=PREFIX_CACHE_MAX_MB * 1024 * 1024,
+        min_prefix_tokens=PREFIX_CACHE_MIN_TOKENS,
+    )
+
+@st.cache_resource
+def get_token_budget():
+    """全セッションで共有する、モデルごとの max_new_tokens の上限（初回にchat_historyの応答の長さから学習する）"""
+    budget = AdaptiveTokenBudget(
+        quantile=ADAPTIVE_TOKENS_QUANTILE,
+        margin=ADAPTIVE_TOKENS_MARGIN,
+        min_tokens=ADAPTIVE_TOKENS_MIN,
+        min_samples=ADAPTIVE_TOKENS_MIN_SAMPLES,
+        window=ADAPTIVE_TOKENS_WINDOW,
+    )
+    budget.seed(get_response_lengths(ADAPTIVE_TOKENS_WINDOW))
+    logging.info(f"max_new_tokens の上限を履歴から学習しました: {budget.stats()}")
+    return budget
+
+def get_model_key(pipe):
+    """pipeのモデルに対応する MODEL_NAMES のキー（設定にないモデルの場合はNone）"""
+    return next((key for key, name in MODEL_NAMES.items() if name == pipe.model.name_or_path), None)
+
+def get_stop_sequences(pipe):
+    """pipeのモデルで生成を打ち切る停止文字列（共通の設定 + モデルごとの設定）"""
+    return list(STOP_SEQUENCES) + MODEL_STOP_SEQUENCES.get(get_model_key(pipe), [])
+
+@st.cache_resource
+def get_speculative_decoders():
+    """全セッションで共有する、ターゲットのモデルキー -> SpeculativeDecoder の辞書"""
+    return {}
+
+def get_draft_key(model_key):
+    """投機的デコーディングで model_key と組にするドラフトモデルのキー（無効・未設定の場合はNone）"""
+    if not SPECULATIVE_ENABLED:
+        return None
+    pair = SPECULATIVE_PAIRS.get(model_key)
+    return pair["draft"] if pair is not None else None
+
+def drop_speculative_decoders(model_key):
+    """model_key をターゲットまたはドラフトにしている組を破棄する（モデルの解放時に呼ばれる）"""
+    decoders = get_speculative_decoders()
+    for target_key in list(decoders):
+        if model_key in (target_key, get_draft_key(target_key)):
+            decoders.pop(target_key, None)
+
+def get_speculative_decoder(pipe):
+    """pipeのモデルに設定されたドラフトモデルとの組を取得する（無効・未設定の場合はNone）"""
+    if not SPECULATIVE_ENABLED:
+        return None
+    target_key = get_model_key(pipe)
+    pair = SPECULATIVE_PAIRS.get(target_key)
+    if pair is None:
+        return None
+    decoders = get_speculative_decoders()
+    decoder = decoders.get(target_key)
+    # ターゲットモデルが解放・再ロードされた場合は組を作り直す
+    if decoder is None or decoder.target_model is not pipe.model:
+        # ドラフトモデルのロードのために、ターゲットのモデルが解放されないようにする
+        with get_model_manager().pinned(target_key):
+            draft_pipe = get_model_manager().get(pair["draft"])
+        if draft_pipe is None:
+            logging.warning(f"ドラフトモデル '{pair['draft']}' をロードできないため、通常の生成を行います。")
+            return None
+        decoder = SpeculativeDecoder(
+            pipe.model, pipe.tokenizer, draft_pipe.model, draft_pipe.tokenizer,
+            num_assistant_tokens=pair.get("num_assistant_tokens"),
+            allow_universal=SPECULATIVE_ALLOW_UNIVERSAL,
+            baseline_every=SPECULATIVE_BASELINE_EVERY,
+        )
+        logging.info(f"投機的デコーディング: {target_key} <- {pair['draft']} (mode={decoder.mode})")
+        decoders[target_key] = decoder
+    return decoder
+
+def get_speculative_stats():
+    """ターゲットのモデルキーごとの投機的デコーディングの動作モード・受理率・速度比"""
+    return {key: {"mode": decoder.mode, **decoder.stats.stats()} for key, decoder in get_speculative_decoders().items()}
+
+def prepare_generation(pipe):
+    """生成で使う共有オブジェクトを、スクリプトの実行スレッドで先に作成しておく
+
+    バックグラウンドスレッドで生成する場合に、初回作成時の履歴の読み込みやドラフトモデルのロードを
+    生成スレッド側で行わないようにする（作成済みの場合は何もしない）。
+    """
+    get_response_cache()
+    get_prefix_cache()
+    if ADAPTIVE_MAX_NEW_TOKENS:
+        get_token_budget()
+    get_speculative_decoder(pipe)
+
 def display_load_messages():
     """モデルロード時のメッセージを表示"""
     if "load_messages" in st.session_state:
@@ -49,68 +211,149 @@ def display_load_messages():
                 st.error(msg["message"])
         st.session_state["load_messages"] = []
 
-def generate_response(pipe, user_question):
-    """LLMを使用して質問に対する回答を生成"""
+def build_prompt(user_question, system_prompt=None):
+    """モデルに渡すプロンプト（system_prompt がある場合は質問の前に置く）"""
+    return f"{system_prompt}\n\n{user_question}" if system_prompt else user_question
+
+def generate_text(pipe, prompt_text, generation_kwargs, latency, stop_sequences=(), cancel_event=None, decoder=None):
+    """テンプレート適用・トークナイズ・生成・デコードを段階ごとに計測しながら実行し、生成部分のテキストを返す
+
+    応答キャッシュ・接頭辞キャッシュ・max_new_tokens の上限は使わず、st.* にも触れないため、
+    Streamlitの外（オフライン評価など）からも呼べる。
+    decoder（SpeculativeDecoder）を渡した場合は投機的デコーディングで生成する。
+    stop_sequences のいずれかが生成された時点、または cancel_event がセットされた時点で打ち切り、その手前までを返す。
+    """
+    tokenizer, model = pipe.tokenizer, pipe.model
+    # トークナイザーにchat_templateがあるか確認
+    has_chat_template = getattr(tokenizer, "chat_template", None) is not None
+    logging.debug(f"Chatテンプレート使用: {has_chat_template}")
+    if has_chat_template:
+        # Gemma-2-2Bなど、チャットテンプレート対応モデルの場合
+        with latency.stage("templating"):
+            text = tokenizer.apply_chat_template(
+                [{"role": "user", "content": prompt_text}], tokenize=False, add_generation_prompt=True
+            )
+        add_special_tokens = False  # BOSなどはテンプレートに含まれている
+    else:
+        # XGLM-564Mなど、チャットテンプレート非対応モデルの場合
+        text, add_special_tokens = prompt_text, True
+    with latency.stage("tokenization"):
+        inputs = tokenizer(text, return_tensors="pt", add_special_tokens=add_special_tokens).to(model.device)
+
+    generate = decoder.generate if decoder is not None else model.generate
+    eos_token_id, stop_criteria, stop_strings = stopping_kwargs(
+        model, tokenizer, stop_sequences, inputs.input_ids.shape[-1], cancel_event=cancel_event
+    )
+    timer = TokenTimer()
+    with torch.no_grad():
+        output_ids = generate(
+            **inputs,
+            stopping_criteria=StoppingCriteriaList([timer, *stop_criteria]),
+            eos_token_id=eos_token_id,
+            pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+            **generation_kwargs,
+        )
+    latency.record_generation(timer)
+    new_ids = output_ids[0][inputs.input_ids.shape[-1]:]
+    latency.input_tokens = inputs.input_ids.shape[-1]
+    latency.output_tokens = len(new_ids)
+
+    # 生成部分だけをデコードし、停止文字列で打ち切るため、出力からプロンプトや次のターンを取り除く処理は不要
+    with latency.stage("postprocess"):
+        return truncate_at_stop(tokenizer.decode(new_ids, skip_special_tokens=True), stop_strings).strip()
+
+def generate_response(pipe, user_question, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9, seed=None,
+                      system_prompt=None, latency=None, stop_sequences=None, streamer=None, cancel_event=None):
+    """LLMを使用して質問に対する回答を生成
+
+    stop_sequences（省略時は config.py の設定）のいずれかを生成した時点で打ち切る。
+    ADAPTIVE_MAX_NEW_TOKENS が有効な場合、max_new_tokens はモデルの過去の応答の長さから決めた上限までに抑える。
+    do_sample=False またはシード指定時は結果が決定的なため、応答キャッシュを利用する。
+    system_prompt（指示文や参考資料など、質問の前に置く共通部分）を指定した場合は、
+    その部分のKVキャッシュを接頭辞キャッシュから再利用する。
+    latency に LatencyBreakdown を渡すと、段階別の処理時間と入出力トークン数が記録される。
+    streamer（transformersのストリーマー）を渡すと生成途中のトークンが逐次書き込まれ、
+    cancel_event（threading.Event）をセットすると生成を打ち切ってそこまでの回答を返す（中止した回答はキャッシュしない）。
+    """
     if pipe is None:
         logging.error("モデルがロードされていません。")
         return "モデルがロードされていないため、回答を生成できません。", 0
+    if latency is None:
+        latency = LatencyBreakdown()
+    model_key = get_model_key(pipe)
+    # 生成中は、このモデルと組になるドラフトモデルを他のセッションのロードで解放させない
+    with get_model_manager().pinned(model_key, get_draft_key(model_key)):
+        return _generate_response(pipe, user_question, max_new_tokens, do_sample, temperature, top_p, seed,
+                                  system_prompt, latency, stop_sequences, streamer, cancel_event)
+
+def _generate_response(pipe, user_question, max_new_tokens, do_sample, temperature, top_p, seed, system_prompt,
+                       latency, stop_sequences, streamer, cancel_event):
     try:
         logging.debug(f"質問: {user_question}")
         start_time = time.time()
-        
-        # トークナイザーにchat_templateがあるか確認
-        has_chat_template = hasattr(pipe.tokenizer, 'chat_template') and pipe.tokenizer.chat_template is not None
-        logging.debug(f"Chatテンプレート使用: {has_chat_template}")
-
-        if has_chat_template:
-            # Gemma-2-2Bなど、チャットテンプレート対応モデルの場合
-            messages = [{"role": "user", "content": user_question}]
-            outputs = pipe(
-                messages,
-                max_new_tokens=512,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9
-            )
-            logging.debug(f"モデル出力（チャット形式）: {outputs}")
-            assistant_response = ""
-            if outputs and isinstance(outputs, list) and outputs[0].get("generated_text"):
-                generated_text = outputs[0]["generated_text"]
-                if isinstance(generated_text, list) and generated_text:
-                    last_message = generated_text[-1]
-                    if last_message.get("role") == "assistant":
-                        assistant_response = last_message.get("content", "").strip()
-                elif isinstance(generated_text, str):
-                    prompt_end = user_question
-                    response_start_index = generated_text.find(prompt_end) + len(prompt_end)
-                    assistant_response = generated_text[response_start_index:].strip()
-                    if "<start_of_turn>model" in assistant_response:
-                        assistant_response = assistant_response.split("<start_of_turn>model\n")[-1].strip()
-        else:
-            # XGLM-564Mなど、チャットテンプレート非対応モデルの場合
-            outputs = pipe(
-                user_question,
-                max_new_tokens=512,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9
-            )
-            logging.debug(f"モデル出力（プレーンテキスト）: {outputs}")
-            assistant_response = ""
-            if outputs and isinstance(outputs, list) and outputs[0].get("generated_text"):
-                assistant_response = outputs[0]["generated_text"].strip()
-                # プロンプト部分を除去（必要に応じて）
-                if user_question in assistant_response:
-                    assistant_response = assistant_response.replace(user_question, "").strip()
+        route = pipe.model.name_or_path
+        if stop_sequences is None:
+            stop_sequences = get_stop_sequences(pipe)
+        if ADAPTIVE_MAX_NEW_TOKENS:
+            max_new_tokens = get_token_budget().budget(route, max_new_tokens)
+
+        generation_params = {
+            "max_new_tokens": max_new_tokens,
+            "do_sample": do_sample,
+            "temperature": temperature,
+            "top_p": top_p,
+            "seed": seed,
+        }
+        cache_key = None
+        if is_cacheable(generation_params):
+            cache_key = make_cache_key(pipe.model.name_or_path, user_question,
+                                       {**generation_params, "system_prompt": system_prompt,
+                                        "stop_sequences": stop_sequences})
+            cached_response = get_response_cache().get(cache_key)
+            if cached_response is not None:
+                response_time = time.time() - start_time
+                logging.info(f"応答キャッシュにヒット: 時間={response_time:.4f}s")
+                return cached_response, response_time
+        if seed is not None:
+            set_seed(seed)
+        generation_kwargs = {k: v for k, v in generation_params.items() if k != "seed"}
+        if streamer is not None:
+            generation_kwargs["streamer"] = streamer
+
+        assistant_response = None
+        if system_prompt and PREFIX_CACHE_ENABLED:
+            # 共通接頭辞のKVキャッシュを再利用して生成（非対応のモデル・キャッシュ形式の場合は通常の生成に戻る）
+            try:
+                assistant_response, prefix_hit = generate_with_prefix_cache(
+                    pipe.model, pipe.tokenizer, get_prefix_cache(), user_question, system_prompt,
+                    latency=latency, stop_sequences=stop_sequences, cancel_event=cancel_event, **generation_kwargs
+                )
+                logging.debug(f"接頭辞KVキャッシュ: hit={prefix_hit}, stats={get_prefix_cache().stats()}")
+            except Exception as e:
+                logging.warning(f"接頭辞KVキャッシュを利用できないため、通常の生成を行います: {e}")
+                assistant_response = None
+
+        if assistant_response is None:
+            assistant_response = generate_text(pipe, build_prompt(user_question, system_prompt), generation_kwargs,
+                                               latency, stop_sequences, cancel_event, get_speculative_decoder(pipe))
+            logging.debug(f"モデル出力: {assistant_response}")
+        cancelled = cancel_event is not None and cancel_event.is_set()
+        if cancelled:
+            logging.info("回答の生成を中止しました。")
+        elif ADAPTIVE_MAX_NEW_TOKENS:
+            get_token_budget().observe(route, latency.output_tokens)
 
+        if assistant_response and cache_key is not None and not cancelled:
+            get_response_cache().set(cache_key, assistant_response)
         if not assistant_response:
-            st.warning("回答の抽出に失敗しました。")
+            _notify("warning", "回答の抽出に失敗しました。")
             assistant_response = "回答を生成できませんでした。"
             logging.warning("回答の抽出に失敗しました。")
         response_time = time.time() - start_time
-        logging.info(f"回答生成完了: 時間={response_time:.2f}s, 回答={assistant_response}")
+        logging.info(f"回答生成完了: 時間={response_time:.2f}s, 内訳={latency.timing_dict()}, "
+                     f"トークン数={latency.input_tokens}->{latency.output_tokens}, 回答={assistant_response}")
         return assistant_response, response_time
     except Exception as e:
-        st.error(f"回答生成中にエラーが発生しました: {e}")
+        _notify("error", f"回答生成中にエラーが発生しました: {e}")
         logging.error(f"回答生成中にエラーが発生しました: {e}")
         return f"エラー: {str(e)}", 0
\ No newline at end of file
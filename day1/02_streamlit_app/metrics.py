@@ -3,19 +3,20 @@ import streamlit as st
 import nltk
 from janome.tokenizer import Tokenizer
 import re
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 
 # NLTKのヘルパー関数（エラー時フォールバック付き）
 try:
     nltk.download('punkt', quiet=True)
     from nltk.translate.bleu_score import sentence_bleu as nltk_sentence_bleu
-    from nltk.tokenize import word_tokenize as nltk_word_tokenize
     print("NLTK loaded successfully.") # デバッグ用
 except Exception as e:
     st.warning(f"NLTKの初期化中にエラーが発生しました: {e}\n簡易的な代替関数を使用します。")
-    def nltk_word_tokenize(text):
-        return text.split()
     def nltk_sentence_bleu(references, candidate):
         # 簡易BLEUスコア（完全一致/部分一致）
         ref_words = set(references[0])
@@ -26,6 +27,41 @@ except Exception as e:
         f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
         return f1 # F1スコアを返す（簡易的な代替）
 
+# --- Janomeトークナイザー ---
+# Tokenizer() の生成は辞書の読み込みを伴い、トークナイズ自体よりはるかに重いため、プロセスで1つを共有する
+TOKEN_CACHE_MAX_ENTRIES = 4096
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+_token_cache = OrderedDict()  # テキストのハッシュ -> トークン（表層形）のタプル
+_token_cache_lock = threading.Lock()
+
+def get_tokenizer():
+    """共有のJanomeトークナイザーを取得する（初回呼び出し時に生成）"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                _tokenizer = Tokenizer()
+    return _tokenizer
+
+def tokenize(text):
+    """テキストを分かち書きしたトークンのタプルを返す（同じテキストは上限付きキャッシュから返す）"""
+    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    with _token_cache_lock:
+        tokens = _token_cache.get(key)
+        if tokens is not None:
+            _token_cache.move_to_end(key)
+            return tokens
+    tokenizer = get_tokenizer()
+    with _tokenizer_lock:  # 同じインスタンスを複数スレッドから同時に使わない
+        tokens = tuple(tokenizer.tokenize(text, wakati=True))
+    with _token_cache_lock:
+        _token_cache[key] = tokens
+        while len(_token_cache) > TOKEN_CACHE_MAX_ENTRIES:
+            _token_cache.popitem(last=False)
+    return tokens
+
 def initialize_nltk():
     """NLTKのデータダウンロードを試みる関数"""
     try:
@@ -45,27 +81,16 @@ def calculate_metrics(answer, correct_answer):
         return bleu_score, similarity_score, word_count, relevance_score
 
     # 単語数のカウント
-    tokenizer = Tokenizer()
-    tokens = list(tokenizer.tokenize(answer))  # ← list() でイテレータをリストに変換
-    word_count = len(tokens)
+    answer_tokens = tokenize(answer)
+    word_count = len(answer_tokens)
 
     # 正解がある場合のみBLEUと類似度を計算
     if correct_answer:
         answer_lower = answer.lower()
         correct_answer_lower = correct_answer.lower()
 
-        # BLEU スコアの計算
-        try:
-            reference = [nltk_word_tokenize(correct_answer_lower)]
-            candidate = nltk_word_tokenize(answer_lower)
-            # ゼロ除算エラーを防ぐ
-            if candidate:
-                bleu_score = nltk_sentence_bleu(reference, candidate, weights=(0.25, 0.25, 0.25, 0.25)) # 4-gram BLEU
-            else:
-                bleu_score = 0.0
-        except Exception as e:
-            # st.warning(f"BLEUスコア計算エラー: {e}")
-            bleu_score = 0.0 # エラー時は0
+        # BLEU スコアの計算（単語数と同じJanomeのトークンを使う。空白区切りでない日本語も単語単位で比較できる）
+        bleu_score = _bleu_score(answer_tokens, tokenize(correct_answer))
 
         # コサイン類似度の計算
         try:
@@ -81,20 +106,98 @@ def calculate_metrics(answer, correct_answer):
             similarity_score = 0.0 # エラー時は0
 
         # 関連性スコア（キーワードの一致率などで簡易的に計算）
-        try:
-            answer_words = set(re.findall(r'\w+', answer_lower))
-            correct_words = set(re.findall(r'\w+', correct_answer_lower))
-            if len(correct_words) > 0:
-                common_words = answer_words.intersection(correct_words)
-                relevance_score = len(common_words) / len(correct_words)
-            else:
-                relevance_score = 0.0
-        except Exception as e:
-            # st.warning(f"関連性スコア計算エラー: {e}")
-            relevance_score = 0.0 # エラー時は0
+        relevance_score = _relevance_score(answer_lower, correct_answer_lower)
 
     return bleu_score, similarity_score, word_count, relevance_score
 
+def _bleu_score(answer_tokens, reference_tokens):
+    """トークン列から4-gram BLEUスコアを計算する"""
+    try:
+        reference = [[token.lower() for token in reference_tokens]]
+        candidate = [token.lower() for token in answer_tokens]
+        # ゼロ除算エラーを防ぐ
+        if not candidate:
+            return 0.0
+        return nltk_sentence_bleu(reference, candidate, weights=(0.25, 0.25, 0.25, 0.25)) # 4-gram BLEU
+    except Exception:
+        return 0.0 # エラー時は0
+
+def _relevance_score(answer_lower, correct_answer_lower):
+    """正解に含まれる単語のうち、回答にも含まれる単語の割合"""
+    try:
+        answer_words = set(re.findall(r'\w+', answer_lower))
+        correct_words = set(re.findall(r'\w+', correct_answer_lower))
+        if not correct_words:
+            return 0.0
+        return len(answer_words & correct_words) / len(correct_words)
+    except Exception:
+        return 0.0 # エラー時は0
+
+def calculate_metrics_batch(answers, correct_answers):
+    """複数の回答と正解の組から評価指標をまとめて計算する
+
+    語の出現回数は全ての組を合わせて1度だけ数え、組ごとのコサイン類似度を疎行列演算でまとめて求める。
+    結果は calculate_metrics を1件ずつ呼んだ場合と同じになる（組の分け方にもよらない）。
+
+    Returns:
+        (bleu_score, similarity_score, word_count, relevance_score) のタプルのリスト（入力と同じ順序）
+    """
+    answers = [answer or "" for answer in answers]
+    correct_answers = [correct_answer or "" for correct_answer in correct_answers]
+    if len(answers) != len(correct_answers):
+        raise ValueError("answers と correct_answers の件数が一致しません")
+    n = len(answers)
+    answers_lower = [answer.lower() for answer in answers]
+    corrects_lower = [correct_answer.lower() for correct_answer in correct_answers]
+
+    # 回答と正解の両方が空でない組だけを類似度の対象にする
+    similarity_scores = np.zeros(n)
+    paired = [i for i in range(n) if answers_lower[i].strip() and corrects_lower[i].strip()]
+    if paired:
+        similarity_scores[paired] = _pairwise_tfidf_similarity(
+            [answers_lower[i] for i in paired], [corrects_lower[i] for i in paired]
+        )
+
+    results = []
+    for i in range(n):
+        if not answers[i]:
+            results.append((0.0, 0.0, 0, 0.0))
+            continue
+        answer_tokens = tokenize(answers[i])
+        if not correct_answers[i]:
+            results.append((0.0, 0.0, len(answer_tokens), 0.0))
+            continue
+        results.append((
+            _bleu_score(answer_tokens, tokenize(correct_answers[i])),
+            float(similarity_scores[i]),
+            len(answer_tokens),
+            _relevance_score(answers_lower[i], corrects_lower[i]),
+        ))
+    return results
+
+def _pairwise_tfidf_similarity(answers_lower, corrects_lower):
+    """組ごとに TfidfVectorizer を学習した場合（calculate_metrics と同じ）のコサイン類似度をまとめて計算する
+
+    2文書で学習した smooth IDF は、両方に現れる語で 1、片方だけに現れる語で 1 + ln(3/2) になる。
+    そのため組ごとに学習し直さなくても、共通の語彙で数えた出現回数に語ごとの IDF を掛ければ同じベクトルになる。
+    """
+    try:
+        counts = CountVectorizer().fit_transform(answers_lower + corrects_lower).tocsr().astype(float)
+    except ValueError:
+        return np.zeros(len(answers_lower))  # 語彙が空（記号のみなど）
+    answer_counts, correct_counts = counts[:len(answers_lower)], counts[len(answers_lower):]
+    shared = (answer_counts > 0).multiply(correct_counts > 0)
+    idf = 1.0 + np.log(1.5)
+
+    def weighted_norms(matrix):
+        # 片方だけに現れる語は idf、両方に現れる語は 1 を掛けた TF-IDF ベクトルの長さ
+        weighted = matrix * idf - matrix.multiply(shared) * (idf - 1.0)
+        return np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+
+    dots = np.asarray(answer_counts.multiply(correct_counts).sum(axis=1)).ravel()
+    norms = weighted_norms(answer_counts) * weighted_norms(correct_counts)
+    return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
 def get_metrics_descriptions():
     """評価指標の説明を返す"""
     return {
@@ -0,0 +1,193 @@
+# model_manager.py
+# モデルを初回利用時にロードし、メモリ予算を超える場合は最も長く使われていないモデルを解放する
+import gc
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+
+def estimate_model_bytes(pipe):
+    """パイプラインが保持するモデルのパラメータとバッファのメモリ量（バイト）を計算する"""
+    model = getattr(pipe, "model", pipe)
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ModelManager:
+    """メモリ予算付きの遅延ロード・LRU方式のモデルマネージャ
+
+    マネージャのロックは管理情報の更新の間だけ保持し、モデルのロード（from_pretrained）はモデルごとの
+    ロックで行うため、あるモデルのロード中も、ロード済みの別のモデルはすぐに取得できる。
+    pin() / pinned() で使用中としたモデル（生成中のモデルや投機的デコーディングの組など）は解放しない。
+    解放したモデルへの参照が他に残っている間は、そのメモリ量も使用中として予算に数える。
+
+    Args:
+        model_names: モデルキー -> Hugging Faceのモデル名 の辞書
+        loader: モデル名を受け取りパイプラインを返す関数（失敗時はNoneを返す）
+        max_memory_bytes: 同時に保持するモデルの合計メモリ量の上限（バイト）
+    """
+
+    def __init__(self, model_names, loader, max_memory_bytes):
+        self.model_names = dict(model_names)
+        self.loader = loader
+        self.max_memory_bytes = int(max_memory_bytes)
+        self._models = OrderedDict()  # model_key -> pipe（末尾ほど最近使用）
+        self._sizes = {}              # model_key -> 最後にロードした時のメモリ量（解放後も見積もりに使う）
+        self._load_times = {}         # model_key -> 最後のロード時間（秒）
+        self._pins = {}               # model_key -> 使用中の数（0より大きい間は解放しない）
+        self._released = []           # 解放したが他から参照が残っているモデル: (model_key, weakref)
+        self._unload_listeners = []   # 解放時に呼ぶ関数（モデルへの参照を持つキャッシュを消すため）
+        self._lock = threading.Lock()
+        self._load_locks = {}         # model_key -> ロード中のロック（同じモデルを二重にロードしない）
+
+    def get(self, model_key):
+        """モデルを取得する。未ロードの場合はロードし、必要なら他のモデルを解放する"""
+        if model_key not in self.model_names:
+            raise KeyError(f"未知のモデルです: {model_key}")
+        with self._lock:
+            pipe = self._models.get(model_key)
+            if pipe is not None:
+                self._models.move_to_end(model_key)
+                return pipe
+            load_lock = self._load_locks.setdefault(model_key, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                pipe = self._models.get(model_key)
+                if pipe is not None:  # 待っている間に別のスレッドがロードした
+                    self._models.move_to_end(model_key)
+                    return pipe
+                # 以前ロードしたことがあればサイズが分かるので、ロード前に空きを作ってピークメモリを抑える
+                evicted = self._evict_for(self._sizes.get(model_key, 0), keep=model_key)
+            self._release(evicted)
+
+            start_time = time.time()
+            pipe = self.loader(self.model_names[model_key])
+            if pipe is None:
+                return None
+            load_time = time.time() - start_time
+            size = estimate_model_bytes(pipe)
+            with self._lock:
+                self._load_times[model_key] = load_time
+                self._sizes[model_key] = size
+                self._models[model_key] = pipe
+                # 実際のサイズで予算を超えた場合は、今ロードしたモデル以外を解放する
+                evicted = self._evict_for(0, keep=model_key)
+            logging.info(f"モデル '{model_key}' をロードしました: 時間={load_time:.2f}s, メモリ={size / 1024 ** 2:.0f}MB")
+            self._release(evicted)
+            return pipe
+
+    def pin(self, model_key):
+        """モデルを使用中にする（unpin() されるまで解放しない）"""
+        with self._lock:
+            self._pins[model_key] = self._pins.get(model_key, 0) + 1
+
+    def unpin(self, model_key):
+        with self._lock:
+            count = self._pins.get(model_key, 0) - 1
+            if count > 0:
+                self._pins[model_key] = count
+            else:
+                self._pins.pop(model_key, None)
+
+    @contextmanager
+    def pinned(self, *model_keys):
+        """with ブロックの間、指定したモデルを解放しない（None のキーは無視する）"""
+        keys = [key for key in model_keys if key is not None]
+        for key in keys:
+            self.pin(key)
+        try:
+            yield
+        finally:
+            for key in keys:
+                self.unpin(key)
+
+    @contextmanager
+    def use(self, model_key):
+        """モデルを取得し、with ブロックの間は解放しない（ロードに失敗した場合は None）"""
+        with self.pinned(model_key):
+            yield self.get(model_key)
+
+    def add_unload_listener(self, listener):
+        """モデルの解放時に listener(model_key) を呼ぶ（モデルへの参照を持つキャッシュを消すために使う）"""
+        self._unload_listeners.append(listener)
+
+    def _evict_for(self, incoming_bytes, keep):
+        """incoming_bytes 分の空きができるまで、使用中でないモデルを最も長く使われていないものから外す
+
+        マネージャのロックを保持した状態で呼び、外したモデルの (キー, pipe) のリストを返す
+        （実際の解放はロックの外で _release で行う）。
+        """
+        evicted = []
+        while self._models and self._loaded_bytes() + incoming_bytes > self.max_memory_bytes:
+            evict_key = next((key for key in self._models if key != keep and not self._pins.get(key)), None)
+            if evict_key is None:
+                break
+            evicted.append((evict_key, self._models.pop(evict_key)))
+        return evicted
+
+    def _release(self, evicted):
+        """外したモデルへの参照を消してメモリを解放する（evicted のリストは空にする）"""
+        if not evicted:
+            return
+        for model_key, _ in evicted:
+            for listener in self._unload_listeners:
+                try:
+                    listener(model_key)
+                except Exception as e:
+                    logging.warning(f"モデル '{model_key}' の解放時の処理に失敗しました: {e}")
+        refs = [(model_key, weakref.ref(getattr(pipe, "model", pipe))) for model_key, pipe in evicted]
+        evicted.clear()  # 呼び出し元のリストにも参照を残さない
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        for model_key, ref in refs:
+            if ref() is None:
+                logging.info(f"モデル '{model_key}' をメモリから解放しました。")
+            else:
+                # 他から参照が残っている間は、予算の計算にも含める
+                logging.warning(f"モデル '{model_key}' は他から参照されているため、メモリがまだ解放されていません。")
+                with self._lock:
+                    self._released.append((model_key, ref))
+
+    def _loaded_bytes(self):
+        self._released = [(key, ref) for key, ref in self._released if ref() is not None]
+        loaded = sum(self._sizes.get(key, 0) for key in self._models)
+        return loaded + sum(self._sizes.get(key, 0) for key, _ in self._released)
+
+    def unload(self, model_key):
+        """モデルを解放する（使用中の場合は解放せずに False を返す）"""
+        with self._lock:
+            if self._pins.get(model_key):
+                logging.warning(f"モデル '{model_key}' は使用中のため解放しません。")
+                return False
+            evicted = [(model_key, self._models.pop(model_key))] if model_key in self._models else []
+        self._release(evicted)
+        return True
+
+    def is_loaded(self, model_key):
+        return model_key in self._models
+
+    def get_load_time(self, model_key):
+        """最後にロードした時のロード時間（秒）。未ロードの場合はNone"""
+        return self._load_times.get(model_key)
+
+    def stats(self):
+        """ロード済みモデル、メモリ使用量、ロード時間を返す"""
+        with self._lock:
+            return {
+                "loaded": list(self._models.keys()),
+                "loaded_bytes": self._loaded_bytes(),
+                "max_memory_bytes": self.max_memory_bytes,
+                "pinned": [key for key, count in self._pins.items() if count],
+                "released_pending": [key for key, _ in self._released],
+                "sizes": dict(self._sizes),
+                "load_times": dict(self._load_times),
+            }
@@ -0,0 +1,171 @@
+# prefix_cache.py
+# 共通のプロンプト接頭辞（システムプロンプトや参考資料ブロック）のKVキャッシュを保持し、
+# リクエストをまたいで再利用することでプリフィル（接頭辞の再エンコード）を省略する
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache, StoppingCriteriaList
+
+import common_path  # noqa: F401  day1/common の共有モジュールを import できるようにする
+from latency import LatencyBreakdown, TokenTimer
+from stopping import stopping_kwargs, truncate_at_stop
+
+# チャットテンプレートから質問部分の位置を特定するための目印
+_QUESTION_PLACEHOLDER = "\u0000QUESTION\u0000"
+
+
+def cache_nbytes(past_key_values):
+    """KVキャッシュが使用しているメモリ量（バイト）を概算する"""
+    layers = past_key_values.to_legacy_cache() if hasattr(past_key_values, "to_legacy_cache") else past_key_values
+    total = 0
+    for layer in layers:
+        for tensor in layer:
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class PrefixKVCache:
+    """プロンプト接頭辞ごとのKVキャッシュを、メモリ上限付きのLRUで保持する
+
+    Args:
+        max_bytes: 保持するKVキャッシュの合計サイズの上限（バイト）
+        min_prefix_tokens: これより短い接頭辞はキャッシュしない（効果より管理コストが大きいため）
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, min_prefix_tokens=32):
+        self.max_bytes = int(max_bytes)
+        self.min_prefix_tokens = int(min_prefix_tokens)
+        self._entries = OrderedDict()  # (model_key, token_ids) -> (past_key_values, nbytes)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_prefill_tokens = 0
+
+    def get(self, model_key, prefix_ids):
+        """接頭辞のKVキャッシュを取得する（生成で書き換えられないようコピーを返す）"""
+        key = (model_key, tuple(prefix_ids))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_prefill_tokens += len(prefix_ids)
+            past_key_values = entry[0]
+        return copy.deepcopy(past_key_values)
+
+    def put(self, model_key, prefix_ids, past_key_values):
+        """接頭辞のKVキャッシュを保存する。上限を超える分は最も古く使われたものから削除"""
+        nbytes = cache_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            return
+        key = (model_key, tuple(prefix_ids))
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (past_key_values, nbytes)
+            self._total_bytes += nbytes
+            while self._total_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        """ヒット数・ミス数・保持件数・使用メモリを返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "saved_prefill_tokens": self.saved_prefill_tokens,
+            }
+
+
+def split_prompt(tokenizer, question, system_prompt):
+    """プロンプトを「共通の接頭辞」と「質問ごとに変わる部分」のテキストに分割する
+
+    チャットテンプレートがある場合は、質問の位置に目印を入れてテンプレートを適用し、その位置で分割する。
+    Gemmaなどsystemロールに対応しないテンプレートもあるため、システムプロンプトはユーザー発話の先頭に置く。
+    """
+    has_chat_template = getattr(tokenizer, "chat_template", None) is not None
+    if has_chat_template:
+        messages = [{"role": "user", "content": f"{system_prompt}\n\n{_QUESTION_PLACEHOLDER}"}]
+        rendered = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        prefix_text, suffix_text = rendered.split(_QUESTION_PLACEHOLDER, 1)
+        return prefix_text, question + suffix_text, False
+    # テンプレートがない場合は、トークナイザーに特殊トークン（BOSなど）を付けさせる
+    return f"{system_prompt}\n\n", question, True
+
+
+def generate_with_prefix_cache(model, tokenizer, prefix_cache, question, system_prompt, latency=None,
+                               stop_sequences=(), cancel_event=None, **generation_kwargs):
+    """共通接頭辞のKVキャッシュを再利用して生成する
+
+    latency に LatencyBreakdown を渡すと段階別の処理時間を記録する（接頭辞のエンコードはプリフィルに含める）。
+    stop_sequences のいずれかを生成した時点、または cancel_event がセットされた時点で打ち切る。
+
+    Returns:
+        (生成テキスト, 接頭辞キャッシュにヒットしたか)。接頭辞が短すぎる場合は (None, False) を返す
+    """
+    if latency is None:
+        latency = LatencyBreakdown()
+    with latency.stage("templating"):
+        prefix_text, suffix_text, add_special_tokens = split_prompt(tokenizer, question, system_prompt)
+    with latency.stage("tokenization"):
+        prefix_ids = tokenizer(prefix_text, add_special_tokens=add_special_tokens, return_tensors="pt").input_ids
+        if prefix_ids.shape[-1] < prefix_cache.min_prefix_tokens:
+            return None, False
+        suffix_ids = tokenizer(suffix_text, add_special_tokens=False, return_tensors="pt").input_ids
+
+    device = model.device
+    model_key = getattr(model, "name_or_path", str(id(model)))
+    prefix_list = prefix_ids[0].tolist()
+    past_key_values = prefix_cache.get(model_key, prefix_list)
+    hit = past_key_values is not None
+    if not hit:
+        # 接頭辞だけを1回エンコードしてKVキャッシュを作成し、保存する
+        start = time.time()
+        with torch.no_grad():
+            outputs = model(prefix_ids.to(device), past_key_values=DynamicCache(), use_cache=True)
+        prefix_cache.put(model_key, prefix_list, outputs.past_key_values)
+        past_key_values = copy.deepcopy(outputs.past_key_values)
+        latency.add("prefill", time.time() - start)
+        logging.info(f"接頭辞のKVキャッシュを作成しました: tokens={len(prefix_list)}, 時間={time.time() - start:.2f}s")
+
+    input_ids = torch.cat([prefix_ids, suffix_ids], dim=-1).to(device)
+    eos_token_id, stop_criteria, stop_strings = stopping_kwargs(
+        model, tokenizer, stop_sequences, input_ids.shape[-1], cancel_event=cancel_event
+    )
+    timer = TokenTimer()
+    with torch.no_grad():
+        output_ids = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            stopping_criteria=StoppingCriteriaList([timer, *stop_criteria]),
+            eos_token_id=eos_token_id,
+            pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+            **generation_kwargs,
+        )
+    latency.record_generation(timer)
+    new_ids = output_ids[0][input_ids.shape[-1]:]
+    latency.input_tokens = input_ids.shape[-1]
+    latency.output_tokens = len(new_ids)
+    with latency.stage("postprocess"):
+        text = truncate_at_stop(tokenizer.decode(new_ids, skip_special_tokens=True), stop_strings)
+    return text.strip(), hit
@@ -0,0 +1,35 @@
+# rescore.py
+# 保存済みのチャット履歴の評価指標をまとめて再計算するコマンド
+# 使い方: python rescore.py [--chunk-size 1000] [--workers 8]
+import argparse
+import time
+
+from database import init_db, rescore_chat_history
+from evaluation_runner import ParallelScorer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chat_history の評価指標をチャンク単位で再計算します")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="1回に読み出して書き戻す件数")
+    parser.add_argument("--workers", type=int, default=1, help="計算に使うプロセス数（2以上でプロセスプールを使用）")
+    parser.add_argument("--shard-size", type=int, default=256, help="1つのワーカーにまとめて渡す件数")
+    args = parser.parse_args()
+
+    init_db()
+    start_time = time.time()
+
+    def report(done, total):
+        print(f"{done}/{total} 件を再計算しました（{time.time() - start_time:.1f}s）")
+
+    if args.workers > 1:
+        # 全ワーカーに仕事が行き渡るよう、1チャンクを少なくともワーカー数分のシャードにする
+        chunk_size = max(args.chunk_size, args.workers * args.shard_size)
+        with ParallelScorer(workers=args.workers, shard_size=args.shard_size) as scorer:
+            updated = rescore_chat_history(chunk_size=chunk_size, progress=report, score_batch=scorer)
+    else:
+        updated = rescore_chat_history(chunk_size=args.chunk_size, progress=report)
+    print(f"完了: {updated} 件（{time.time() - start_time:.1f}s）")
+
+
+if __name__ == "__main__":
+    main()
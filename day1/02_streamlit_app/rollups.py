@@ -0,0 +1,208 @@
+# rollups.py
+# 評価分析タブ用の集計テーブル（モデル×時間バケットごとの件数・合計・二乗和・ヒストグラム）
+# レコード保存時に差分だけ加算するため、分析タブは履歴の件数に関係なく集計テーブルだけを読めばよい
+import math
+from bisect import bisect_right
+
+# 集計する指標と、ヒストグラムの各ビンの下限値
+SCORE_BINS = [i / 10 for i in range(10)]  # 0.0, 0.1, ..., 0.9（1.0は最後のビンに含める）
+HISTOGRAM_BINS = {
+    "response_time": [0, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60],
+    "bleu_score": SCORE_BINS,
+    "similarity_score": SCORE_BINS,
+    "word_count": [0, 10, 25, 50, 100, 200, 400, 800],
+    "relevance_score": SCORE_BINS,
+    "efficiency_score": [0, 0.1, 0.25, 0.5, 1, 2, 5],
+}
+ROLLUP_METRICS = list(HISTOGRAM_BINS)
+
+STATS_TABLE = "metrics_rollup"
+HISTOGRAM_TABLE = "metrics_histogram"
+ACCURACY_TABLE = "accuracy_rollup"
+
+SCHEMAS = [
+    f'''
+    CREATE TABLE IF NOT EXISTS {STATS_TABLE}
+    (model_name TEXT NOT NULL,
+     bucket TEXT NOT NULL,        -- 時間バケット（"YYYY-MM-DD HH:00"）
+     metric TEXT NOT NULL,
+     n INTEGER NOT NULL,
+     total REAL NOT NULL,
+     total_sq REAL NOT NULL,
+     min_value REAL,
+     max_value REAL,
+     PRIMARY KEY (model_name, bucket, metric))
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS {HISTOGRAM_TABLE}
+    (model_name TEXT NOT NULL,
+     bucket TEXT NOT NULL,
+     metric TEXT NOT NULL,
+     bin INTEGER NOT NULL,        -- HISTOGRAM_BINS[metric] のインデックス
+     n INTEGER NOT NULL,
+     PRIMARY KEY (model_name, bucket, metric, bin))
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS {ACCURACY_TABLE}
+    (model_name TEXT NOT NULL,
+     bucket TEXT NOT NULL,
+     is_correct REAL NOT NULL,
+     n INTEGER NOT NULL,
+     PRIMARY KEY (model_name, bucket, is_correct))
+    ''',
+]
+
+UPSERT_STATS_SQL = f'''
+INSERT INTO {STATS_TABLE} (model_name, bucket, metric, n, total, total_sq, min_value, max_value)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (model_name, bucket, metric) DO UPDATE SET
+    n = n + excluded.n,
+    total = total + excluded.total,
+    total_sq = total_sq + excluded.total_sq,
+    min_value = MIN(min_value, excluded.min_value),
+    max_value = MAX(max_value, excluded.max_value)
+'''
+UPSERT_HISTOGRAM_SQL = f'''
+INSERT INTO {HISTOGRAM_TABLE} (model_name, bucket, metric, bin, n) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (model_name, bucket, metric, bin) DO UPDATE SET n = n + excluded.n
+'''
+UPSERT_ACCURACY_SQL = f'''
+INSERT INTO {ACCURACY_TABLE} (model_name, bucket, is_correct, n) VALUES (?, ?, ?, ?)
+ON CONFLICT (model_name, bucket, is_correct) DO UPDATE SET n = n + excluded.n
+'''
+
+
+def time_bucket(timestamp):
+    """"YYYY-MM-DD HH:MM:SS" 形式のタイムスタンプを1時間単位のバケットに丸める"""
+    return f"{str(timestamp)[:13]}:00"
+
+
+def histogram_bin(metric, value):
+    """値が入るヒストグラムのビン番号を返す（範囲外は両端のビンに入れる）"""
+    edges = HISTOGRAM_BINS[metric]
+    return min(max(bisect_right(edges, value) - 1, 0), len(edges) - 1)
+
+
+def bin_labels(metric):
+    """ヒストグラムの各ビンの表示用ラベル"""
+    edges = HISTOGRAM_BINS[metric]
+    uppers = edges[1:] + [None]
+    return [f"{low:g}-{high:g}" if high is not None else f"{low:g}-" for low, high in zip(edges, uppers)]
+
+
+def create_tables(conn):
+    for schema in SCHEMAS:
+        conn.execute(schema)
+
+
+def apply(conn, rows):
+    """保存したレコードの値を集計テーブルに加算する（呼び出し側のトランザクション内で実行すること）
+
+    Args:
+        rows: model_name, timestamp, is_correct と各指標をキーに持つdictのリスト。
+              is_correct が未設定のレコードは分析対象外のため集計しない
+    """
+    stats, histogram, accuracy = {}, {}, {}
+    for row in rows:
+        if row.get("is_correct") is None:
+            continue
+        model_name = row.get("model_name") or ""
+        bucket = time_bucket(row["timestamp"])
+        accuracy_key = (model_name, bucket, float(row["is_correct"]))
+        accuracy[accuracy_key] = accuracy.get(accuracy_key, 0) + 1
+
+        values = {metric: row.get(metric) for metric in ROLLUP_METRICS}
+        if values["response_time"] is not None:
+            values["efficiency_score"] = row["is_correct"] / (values["response_time"] + 0.1)
+        for metric, value in values.items():
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            value = float(value)
+            key = (model_name, bucket, metric)
+            n, total, total_sq, low, high = stats.get(key, (0, 0.0, 0.0, value, value))
+            stats[key] = (n + 1, total + value, total_sq + value * value, min(low, value), max(high, value))
+            bin_key = key + (histogram_bin(metric, value),)
+            histogram[bin_key] = histogram.get(bin_key, 0) + 1
+
+    conn.executemany(UPSERT_STATS_SQL, [key + value for key, value in stats.items()])
+    conn.executemany(UPSERT_HISTOGRAM_SQL, [key + (n,) for key, n in histogram.items()])
+    conn.executemany(UPSERT_ACCURACY_SQL, [key + (n,) for key, n in accuracy.items()])
+
+
+def clear(conn):
+    for table in (STATS_TABLE, HISTOGRAM_TABLE, ACCURACY_TABLE):
+        conn.execute(f"DELETE FROM {table}")
+
+
+def rebuild(conn, history_table):
+    """履歴テーブル全体から集計テーブルを作り直す（既存DBの移行や再計算後に使う）"""
+    clear(conn)
+    cursor = conn.execute(
+        f"SELECT model_name, timestamp, is_correct, {', '.join(m for m in ROLLUP_METRICS if m != 'efficiency_score')} "
+        f"FROM {history_table}"
+    )
+    columns = [description[0] for description in cursor.description]
+    while True:
+        chunk = cursor.fetchmany(1000)
+        if not chunk:
+            break
+        apply(conn, [dict(zip(columns, row)) for row in chunk])
+
+
+def is_empty(conn):
+    return conn.execute(f"SELECT 1 FROM {ACCURACY_TABLE} LIMIT 1").fetchone() is None
+
+
+# --- 読み出し（全てバケットを合算したモデル単位・全体の値を返す） ---
+def accuracy_counts(conn):
+    """正確性の値ごとの件数 {is_correct: 件数}"""
+    rows = conn.execute(f"SELECT is_correct, SUM(n) FROM {ACCURACY_TABLE} GROUP BY is_correct").fetchall()
+    return {is_correct: n for is_correct, n in rows}
+
+
+def model_accuracy(conn):
+    """モデルごとの正確性の平均 {model_name: 平均}"""
+    rows = conn.execute(
+        f"SELECT model_name, SUM(is_correct * n) / SUM(n) FROM {ACCURACY_TABLE} GROUP BY model_name"
+    ).fetchall()
+    return dict(rows)
+
+
+def metric_stats(conn, model_name=None):
+    """指標ごとの件数・平均・標準偏差・最小・最大 {metric: {...}}"""
+    where, params = ("WHERE model_name = ?", [model_name]) if model_name is not None else ("", [])
+    rows = conn.execute(
+        f"SELECT metric, SUM(n), SUM(total), SUM(total_sq), MIN(min_value), MAX(max_value) "
+        f"FROM {STATS_TABLE} {where} GROUP BY metric",
+        params,
+    ).fetchall()
+    stats = {}
+    for metric, n, total, total_sq, low, high in rows:
+        mean = total / n
+        # 標本標準偏差（pandasのdescribeと同じ）。丸め誤差で負にならないよう0で切る
+        variance = max(total_sq - n * mean * mean, 0.0) / (n - 1) if n > 1 else float("nan")
+        stats[metric] = {"count": n, "mean": mean, "std": math.sqrt(variance), "min": low, "max": high}
+    return stats
+
+
+def metric_means_by_model(conn, metric):
+    """モデルごとの指標の平均 {model_name: 平均}"""
+    rows = conn.execute(
+        f"SELECT model_name, SUM(total) / SUM(n) FROM {STATS_TABLE} WHERE metric = ? GROUP BY model_name",
+        (metric,),
+    ).fetchall()
+    return dict(rows)
+
+
+def histogram(conn, metric, model_name=None):
+    """指標のヒストグラム（ビンのラベル順の件数リスト）"""
+    where, params = "WHERE metric = ?", [metric]
+    if model_name is not None:
+        where += " AND model_name = ?"
+        params.append(model_name)
+    rows = conn.execute(f"SELECT bin, SUM(n) FROM {HISTOGRAM_TABLE} {where} GROUP BY bin", params).fetchall()
+    counts = [0] * len(HISTOGRAM_BINS[metric])
+    for bin_index, n in rows:
+        if 0 <= bin_index < len(counts):
+            counts[bin_index] = n
+    return counts
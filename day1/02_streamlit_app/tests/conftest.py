@@ -0,0 +1,74 @@
+import os
+import sys
+
+import pytest
+import torch
+from transformers import BatchEncoding, LlamaConfig, LlamaForCausalLM
+
+# テストからアプリのモジュール（database.py など）を import できるようにする
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+class ByteTokenizer:
+    """モデルをダウンロードせずに生成を試すためのトークナイザー: UTF-8の1バイトを1トークンにする
+
+    id 0〜2 は特殊トークン（pad・BOS・EOS）で、バイト b は id b + 3 になる。チャットテンプレートは持たない。
+    """
+
+    special_tokens = ["<pad>", "<s>", "</s>"]
+    pad_token_id, bos_token_id, eos_token_id = 0, 1, 2
+    chat_template = None
+    vocab_size = 256 + 3
+
+    @property
+    def all_special_tokens(self):
+        return list(self.special_tokens)
+
+    def get_added_vocab(self):
+        return {}
+
+    def convert_tokens_to_ids(self, token):
+        return self.special_tokens.index(token)
+
+    def encode(self, text, add_special_tokens=True):
+        ids = [byte + 3 for byte in text.encode("utf-8")]
+        return [self.bos_token_id] + ids if add_special_tokens else ids
+
+    def __call__(self, text, add_special_tokens=True, return_tensors=None):
+        ids = self.encode(text, add_special_tokens)
+        if return_tensors == "pt":
+            ids = torch.tensor([ids])
+            return BatchEncoding({"input_ids": ids, "attention_mask": torch.ones_like(ids)})
+        return BatchEncoding({"input_ids": ids})
+
+    def decode(self, ids, skip_special_tokens=False):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        data, text = bytearray(), ""
+        for token_id in ids:
+            if token_id >= 3:
+                data.append(token_id - 3)
+            elif not skip_special_tokens:
+                text += data.decode("utf-8", errors="ignore") + self.special_tokens[token_id]
+                data = bytearray()
+        return text + data.decode("utf-8", errors="ignore")
+
+    def batch_decode(self, rows, skip_special_tokens=False):
+        return [self.decode(row, skip_special_tokens) for row in rows]
+
+
+@pytest.fixture
+def tokenizer():
+    return ByteTokenizer()
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    """ランダムな重みの小さなLlama（出力の中身ではなく、生成経路どうしの一致を確かめるために使う）"""
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=ByteTokenizer.vocab_size, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=1024,
+        pad_token_id=0, bos_token_id=1, eos_token_id=2,
+    )
+    return LlamaForCausalLM(config).eval()
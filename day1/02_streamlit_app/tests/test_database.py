@@ -0,0 +1,113 @@
+import gc
+import sqlite3
+import threading
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """一時ファイルのDBに接続先を切り替えて初期化する"""
+    manager = database.ConnectionManager(str(tmp_path / "test.db"))
+    monkeypatch.setattr(database, "connection_manager", manager)
+    database.init_db()
+    yield manager
+    manager.close_all()
+
+
+def make_record(i, model_name="model-a", is_correct=1.0):
+    return {
+        "timestamp": f"2026-01-01 {i % 24:02d}:00:00",
+        "model_name": model_name,
+        "question": f"質問{i}",
+        "answer": f"回答{i}",
+        "feedback": "",
+        "correct_answer": "",
+        "is_correct": is_correct,
+        "response_time": 1.0,
+        "bleu_score": 0.5,
+        "similarity_score": 0.5,
+        "word_count": 3,
+        "relevance_score": 0.5,
+    }
+
+
+def test_insert_records_sets_db_write_time_on_inserted_rows_only(db):
+    conn = database.get_connection()
+    # 集計テーブルに行がある状態で追加する（last_insert_rowid() が集計テーブルの行を指す状況）
+    database.insert_records([make_record(i) for i in range(52)])
+    with conn:
+        conn.execute("UPDATE chat_history SET db_write_time = NULL")
+
+    database.insert_records([make_record(i, model_name="model-b") for i in range(5)])
+
+    rows = conn.execute("SELECT model_name, db_write_time FROM chat_history ORDER BY id").fetchall()
+    assert len(rows) == 57
+    assert all(write_time is None for model_name, write_time in rows if model_name == "model-a")
+    assert all(write_time is not None and write_time >= 0 for model_name, write_time in rows if model_name == "model-b")
+
+
+def test_insert_records_updates_rollups(db):
+    database.insert_records([make_record(0, is_correct=1.0), make_record(1, is_correct=0.0)])
+
+    summary = database.get_metrics_rollup("bleu_score")
+    assert summary["accuracy_counts"] == {1.0: 1, 0.0: 1}
+    assert summary["stats"]["bleu_score"]["count"] == 2
+
+
+def test_connections_are_closed_when_their_thread_exits(tmp_path):
+    manager = database.ConnectionManager(str(tmp_path / "test.db"))
+    connections = []
+
+    def use_connection():
+        conn = manager.get()
+        assert manager.get() is conn  # 同じスレッドでは使い回す
+        conn.execute("SELECT 1")
+        connections.append(conn)
+
+    # Streamlitの再実行のように、毎回新しいスレッドから接続を使う
+    for _ in range(20):
+        thread = threading.Thread(target=use_connection)
+        thread.start()
+        thread.join()
+    gc.collect()
+
+    assert manager.open_count() == 0
+    for conn in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")  # 閉じた接続
+    main_conn = manager.get()
+    assert manager.open_count() == 1
+    manager.close_all()
+    assert manager.open_count() == 0
+    with pytest.raises(sqlite3.ProgrammingError):
+        main_conn.execute("SELECT 1")
+
+
+def test_keyset_and_offset_paging_return_the_same_rows(db):
+    # 同じ timestamp の行を含める（i と i+24 は同時刻）
+    database.insert_records([
+        make_record(i, model_name="model-a" if i % 3 else "model-b", is_correct=1.0 if i % 2 else 0.0)
+        for i in range(40)
+    ])
+    expected = [row_id for (row_id,) in database.get_connection().execute(
+        "SELECT id FROM chat_history WHERE model_name = 'model-a' ORDER BY timestamp DESC, id DESC")]
+
+    by_offset, by_cursor, cursor = [], [], None
+    for offset in range(0, len(expected) + 7, 7):
+        by_offset += database.query_chat_history(model_name="model-a", limit=7, offset=offset)["id"].tolist()
+    while True:
+        # cursor を指定した場合、offset は無視される
+        page = database.query_chat_history(model_name="model-a", limit=7, offset=0 if cursor is None else 999,
+                                           cursor=cursor)
+        if page.empty:
+            break
+        by_cursor += page["id"].tolist()
+        cursor = (page["timestamp"].iloc[-1], page["id"].iloc[-1])
+
+    assert by_offset == by_cursor == expected
+    assert database.count_chat_history(model_name="model-a") == len(expected) == 26
+    assert database.count_chat_history(is_correct=1.0, model_name="model-a") == 13
+    assert database.count_chat_history() == 40
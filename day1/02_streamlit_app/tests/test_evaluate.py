@@ -0,0 +1,85 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import evaluate
+from evaluate import METRIC_NAMES, evaluate_model, load_results, open_results, summarize
+
+
+def result(model, index, latency, **metrics):
+    return {"model": model, "index": index, "latency": latency, "tokens": 10,
+            **{name: metrics.get(name, 0.0) for name in METRIC_NAMES}}
+
+
+def write_results(path, entries, tail=""):
+    path.write_text("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries) + tail,
+                    encoding="utf-8")
+
+
+def test_load_results_ignores_torn_last_line(tmp_path):
+    path = tmp_path / "results.jsonl"
+    write_results(path, [
+        result("a", 0, 1.0),
+        result("a", 1, 2.0),
+        {"type": "batch", "model": "a", "size": 2, "wall_time": 3.0, "tokens": 20},
+        result("b", 0, 4.0),
+    ], tail='{"model": "b", "index": 1, "lat')
+
+    items, batches = load_results(str(path))
+
+    assert sorted(items) == [("a", 0), ("a", 1), ("b", 0)]
+    assert items[("a", 1)]["latency"] == 2.0
+    assert batches == [{"type": "batch", "model": "a", "size": 2, "wall_time": 3.0, "tokens": 20}]
+    assert load_results(str(tmp_path / "missing.jsonl")) == ({}, [])
+
+
+def test_summarize():
+    items = {("a", i): result("a", i, float(i + 1), bleu_score=i / 10) for i in range(5)}
+    items[("b", 0)] = result("b", 0, 9.0)
+    batches = [
+        {"type": "batch", "model": "a", "size": 3, "wall_time": 2.0, "tokens": 30},
+        {"type": "batch", "model": "a", "size": 2, "wall_time": 3.0, "tokens": 20},
+        {"type": "batch", "model": "b", "size": 1, "wall_time": 0.0, "tokens": 10},
+    ]
+
+    report = summarize(items, batches)
+
+    assert list(report) == ["a", "b"]
+    assert report["a"]["questions"] == 5
+    assert report["a"]["tokens_per_second"] == pytest.approx(50 / 5.0)
+    assert (report["a"]["latency_p50"], report["a"]["latency_p95"]) == (3.0, 4.0)
+    assert report["a"]["metrics"]["bleu_score"] == pytest.approx(
+        {"mean": 0.2, "p50": 0.2, "p95": 0.3, "min": 0.0, "max": 0.4})
+    assert report["b"]["tokens_per_second"] == 0.0  # 経過時間が記録されていない場合
+
+
+def test_resume_skips_answered_questions(tmp_path, monkeypatch):
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text("".join(json.dumps({"question": f"質問{i}", "correct_answer": f"正解{i}"}, ensure_ascii=False)
+                                 + "\n" for i in range(5)), encoding="utf-8")
+    output_path = tmp_path / "results.jsonl"
+    # 前回は1件目と3件目まで処理して中断した
+    write_results(output_path, [result("Gemma-2-2B", 0, 1.0), result("Gemma-2-2B", 2, 1.0)], tail='{"model": ')
+    generated = []
+
+    def fake_generate_text(pipe, prompt_text, generation_kwargs, latency, stop_sequences=(), *args):
+        generated.append(prompt_text.rsplit("\n\n", 1)[-1])
+        latency.output_tokens = 7
+        return f"{prompt_text}への回答"
+
+    monkeypatch.setattr(evaluate, "generate_text", fake_generate_text)
+    monkeypatch.setattr(evaluate, "calculate_metrics_batch", lambda answers, references: [(0.5, 0.5, 3, 0.5)] * len(answers))
+    pipe = SimpleNamespace(model=SimpleNamespace(name_or_path="google/gemma-2-2b-jpn-it"))
+    args = SimpleNamespace(max_new_tokens=32, greedy=True, temperature=0.7, top_p=0.9, batch_size=2, concurrency=2,
+                           no_save=True)
+
+    done, _ = load_results(str(output_path))
+    with open_results(str(output_path)) as output:
+        evaluate_model("Gemma-2-2B", pipe, str(questions), output, done, args)
+
+    assert generated == ["質問1", "質問3", "質問4"]
+    items, batches = load_results(str(output_path))
+    assert sorted(index for _, index in items) == [0, 1, 2, 3, 4]
+    assert items[("Gemma-2-2B", 3)]["tokens"] == 7
+    assert [(batch["size"], batch["tokens"]) for batch in batches] == [(2, 14), (1, 7)]
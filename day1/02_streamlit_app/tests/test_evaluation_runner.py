@@ -0,0 +1,40 @@
+import pytest
+
+from evaluation_runner import ParallelScorer
+from metrics import calculate_metrics_batch
+
+ANSWERS = [
+    "BM25は単語の出現頻度と文書の長さで文書を順位付けする手法です。",
+    "RRF combines ranked lists by reciprocal rank.",
+    "",
+    "同じ回答です",
+    "回答だけがある",
+    "ベクトル検索は埋め込みの近さで文書を探します。",
+    "!!!",
+]
+CORRECT_ANSWERS = [
+    "BM25は出現頻度と文書長に基づく検索スコアです。",
+    "Reciprocal Rank Fusion (RRF) merges rankings.",
+    "正解だけがある",
+    "同じ回答です",
+    "",
+    "埋め込みベクトルの類似度で文書を検索する方法です。",
+    "???",
+]
+
+
+@pytest.mark.parametrize("shard_size", [1, 3, 100])
+def test_sharded_scores_match_serial_scores(shard_size):
+    serial = calculate_metrics_batch(ANSWERS, CORRECT_ANSWERS)
+    with ParallelScorer(workers=2, shard_size=shard_size) as scorer:
+        sharded = scorer(ANSWERS, CORRECT_ANSWERS)
+
+    # シャードの分け方によらず、入力と同じ順序で同じ値になる
+    assert sharded == pytest.approx(serial, abs=1e-12)
+
+
+def test_empty_input_and_mismatched_lengths():
+    with ParallelScorer(workers=1) as scorer:
+        assert scorer([], []) == []
+        with pytest.raises(ValueError):
+            scorer(["回答"], [])
@@ -0,0 +1,103 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import generation_job
+import llm
+from generation_job import GenerationJob
+
+
+class StubGeneration:
+    """generate_response の代わり: steps の各要素をストリーマーに流し、区切りごとに proceed を待つ"""
+
+    def __init__(self, steps, answer="回答", error=None):
+        self.steps = steps
+        self.answer = answer
+        self.error = error
+        self.proceed = threading.Semaphore(0)
+        self.streamed = threading.Semaphore(0)
+        self.kwargs = None
+
+    def __call__(self, pipe, question, latency=None, streamer=None, cancel_event=None, **kwargs):
+        self.kwargs = kwargs
+        for text in self.steps:
+            streamer.on_finalized_text(text)
+            self.streamed.release()
+            # 次を流す前に、テストが partial_text を確認するのを待つ（中止された場合はすぐに打ち切る）
+            while not self.proceed.acquire(timeout=0.01):
+                if cancel_event.is_set():
+                    return "中止までの回答", 0.5
+        if self.error is not None:
+            llm._notify("warning", "回答の抽出に失敗しました。")
+            raise self.error
+        return self.answer, 1.5
+
+    def step(self):
+        assert self.streamed.acquire(timeout=5)
+
+
+@pytest.fixture
+def make_job(monkeypatch, tokenizer):
+    """StubGeneration で生成する GenerationJob を作る関数（停止文字列は XGLM-564M の設定を使う）"""
+    monkeypatch.setattr(generation_job, "prepare_generation", lambda pipe: None)
+    pipe = SimpleNamespace(tokenizer=tokenizer, model=SimpleNamespace(name_or_path="facebook/xglm-564M"))
+
+    def make(stub, **kwargs):
+        monkeypatch.setattr(generation_job, "generate_response", stub)
+        return GenerationJob(pipe, "質問", "facebook/xglm-564M", **kwargs)
+
+    return make
+
+
+def test_partial_text_holds_back_partial_stop_string(make_job):
+    stub = StubGeneration(["BM25は", "単語の頻度です。", "質", "問: 次の質問"], answer="BM25は単語の頻度です。")
+    job = make_job(stub, system_prompt="指示")
+
+    stub.step()
+    assert job.partial_text == "BM25は"
+    stub.proceed.release()
+    stub.step()
+    stub.proceed.release()
+    stub.step()
+    # 「質」は停止文字列「質問:」の先頭かもしれないため、続きが届くまで表示しない
+    assert job.partial_text == "BM25は単語の頻度です。"
+    stub.proceed.release()
+    stub.step()
+    assert job.partial_text == "BM25は単語の頻度です。"
+    assert not job.done
+    stub.proceed.release()
+
+    assert job.wait(timeout=5)
+    assert (job.answer, job.response_time, job.cancelled, job.notices) == ("BM25は単語の頻度です。", 1.5, False, [])
+    assert job.latency is not None
+    assert stub.kwargs == {"system_prompt": "指示"}
+    assert job._pipe is None  # 完了後はモデルを参照しない
+
+
+def test_cancel_stops_generation(make_job):
+    stub = StubGeneration(["途中", "まで"])
+    job = make_job(stub)
+    stub.step()
+
+    job.cancel()
+
+    assert job.wait(timeout=5)
+    assert job.cancelled
+    assert job.answer == "中止までの回答"
+    assert job.partial_text == "途中"
+
+
+def test_error_is_reported_through_notices(make_job):
+    stub = StubGeneration([], error=RuntimeError("out of memory"))
+    job = make_job(stub)
+
+    assert job.wait(timeout=5)
+    assert job.answer == "エラー: out of memory"
+    assert job.response_time > 0
+    # 生成スレッドからの通知は st.* ではなく notices に積まれる
+    assert job.notices == [
+        {"type": "warning", "message": "回答の抽出に失敗しました。"},
+        {"type": "error", "message": "回答生成中にエラーが発生しました: out of memory"},
+    ]
+    assert job.latency is None
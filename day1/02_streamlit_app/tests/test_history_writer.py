@@ -0,0 +1,110 @@
+import json
+import threading
+
+from history_writer import HistoryWriter
+
+
+class FakeStore:
+    """write_batch の代わり: 書き込まれたレコードを保持し、fail_ids のレコードを含むバッチは失敗させる"""
+
+    def __init__(self, fail_ids=(), fail_times=0):
+        self.records = []
+        self.calls = []
+        self.fail_ids = set(fail_ids)
+        self.fail_times = fail_times  # 最初の fail_times 回は内容によらず失敗させる
+        self.release = threading.Event()
+        self.release.set()
+
+    def write_batch(self, batch):
+        self.release.wait(5)
+        self.calls.append([record["_id"] for record in batch])
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise RuntimeError("database is locked")
+        if any(record["_id"] in self.fail_ids for record in batch):
+            raise ValueError("invalid record")
+        self.records.extend(batch)
+
+
+def make_writer(store, tmp_path, **kwargs):
+    kwargs = {"batch_size": 10, "flush_interval": 0.05, "retry_interval": 0, **kwargs}
+    return HistoryWriter(store.write_batch, str(tmp_path / "spill.jsonl"),
+                         dead_letter_file=str(tmp_path / "dead.jsonl"), **kwargs)
+
+
+def read_lines(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()] if path.exists() else []
+
+
+def test_submitted_record_is_spilled_before_write(tmp_path):
+    store = FakeStore()
+    store.release.clear()
+    writer = make_writer(store, tmp_path)
+    record_id = writer.submit({"question": "質問"})
+
+    # 書き込みが終わる前から、レコードはスピルファイルに残っている
+    assert read_lines(tmp_path / "spill.jsonl") == [{"record": {"question": "質問", "_id": record_id}}]
+    assert writer.pending == 1
+    store.release.set()
+    assert writer.flush(timeout=5)
+    assert [record["_id"] for record in store.records] == [record_id]
+    # 未処理がなくなったらスピルファイルを空にする
+    assert (tmp_path / "spill.jsonl").read_text() == ""
+
+
+def test_replays_records_without_done_marker(tmp_path):
+    lines = [
+        {"record": {"_id": "a", "question": "1"}},
+        {"record": {"_id": "b", "question": "2"}},
+        {"record": {"_id": "c", "question": "3"}},
+        {"done": ["a"]},
+        {"record": {"_id": "d", "question": "4"}},
+        {"done": ["c"]},
+    ]
+    spill = tmp_path / "spill.jsonl"
+    # 最終行は書き込み途中で落ちた不完全な行
+    spill.write_text("".join(json.dumps(line) + "\n" for line in lines) + '{"record": {"_id": "e", "qu',
+                     encoding="utf-8")
+    store = FakeStore()
+    store.release.clear()
+    writer = make_writer(store, tmp_path)
+
+    # 完了マーカーのないレコードだけでスピルファイルを作り直し、再投入する
+    assert [entry["record"]["_id"] for entry in read_lines(spill)] == ["b", "d"]
+    store.release.set()
+    assert writer.flush(timeout=5)
+    assert sorted(record["_id"] for record in store.records) == ["b", "d"]
+    assert spill.read_text() == ""
+
+
+def test_transient_failure_is_retried(tmp_path):
+    store = FakeStore(fail_times=2)
+    writer = make_writer(store, tmp_path, max_retries=3)
+    record_id = writer.submit({"question": "質問"})
+
+    assert writer.flush(timeout=5)
+    assert [record["_id"] for record in store.records] == [record_id]
+    assert writer.stats()["failed_batches"] == 0
+    assert not (tmp_path / "dead.jsonl").exists()
+
+
+def test_bad_record_is_quarantined_after_retries(tmp_path):
+    store = FakeStore()
+    store.release.clear()
+    writer = make_writer(store, tmp_path, max_retries=2, flush_interval=0.5)
+    ids = [writer.submit({"question": str(i)}) for i in range(3)]
+    store.fail_ids = {ids[1]}
+    store.release.set()
+
+    assert writer.flush(timeout=5)
+    # バッチは最初の1回と再試行2回で諦め、1件ずつ書き込む
+    assert store.calls[:3] == [ids] * 3
+    assert store.calls[3:] == [[record_id] for record_id in ids]
+    assert [record["_id"] for record in store.records] == [ids[0], ids[2]]
+    dead = read_lines(tmp_path / "dead.jsonl")
+    assert [(entry["record"]["_id"], entry["error"]) for entry in dead] == [(ids[1], "invalid record")]
+    assert writer.stats() == {"pending": 0, "written_total": 2, "failed_batches": 1, "quarantined_total": 1}
+
+    # 隔離したレコードは再起動しても再投入しない
+    restarted = make_writer(FakeStore(), tmp_path)
+    assert restarted.pending == 0
@@ -0,0 +1,39 @@
+import pytest
+
+from metrics import calculate_metrics, calculate_metrics_batch
+
+PAIRS = [
+    ("BM25は単語の出現頻度と文書の長さで文書を順位付けする手法です。", "BM25は出現頻度と文書長に基づく検索スコアです。"),
+    ("RRF combines ranked lists by reciprocal rank.", "Reciprocal Rank Fusion (RRF) merges rankings."),
+    ("The the THE answer answer", "the answer"),
+    ("同じ回答です", "同じ回答です"),
+    ("まったく関係のない文章", "Completely unrelated text"),
+    ("", "正解だけがある"),
+    ("回答だけがある", ""),
+    ("!!!", "???"),
+    (None, None),
+]
+
+
+def test_batch_matches_per_row_metrics():
+    answers, correct_answers = zip(*PAIRS)
+    batch = calculate_metrics_batch(answers, correct_answers)
+
+    assert len(batch) == len(PAIRS)
+    for scores, (answer, correct_answer) in zip(batch, PAIRS):
+        assert scores == pytest.approx(calculate_metrics(answer, correct_answer), abs=1e-12)
+
+
+def test_batch_similarity_does_not_depend_on_other_pairs():
+    answers, correct_answers = zip(*PAIRS)
+    batch = calculate_metrics_batch(answers, correct_answers)
+
+    # 1組だけで計算しても、他の組と一緒に計算しても同じ値になる
+    assert calculate_metrics_batch(answers[:1], correct_answers[:1])[0] == pytest.approx(batch[0], abs=1e-12)
+    assert batch[3][1] == pytest.approx(1.0)
+    assert batch[4][1] == 0.0
+
+
+def test_batch_rejects_mismatched_lengths():
+    with pytest.raises(ValueError):
+        calculate_metrics_batch(["回答"], [])
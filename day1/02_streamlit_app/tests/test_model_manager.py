@@ -0,0 +1,126 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from model_manager import ModelManager, estimate_model_bytes
+
+MODEL_NAMES = {"a": "model-a", "b": "model-b", "c": "model-c"}
+MODEL_BYTES = 1000 * 4  # 1000個のfloat32のパラメータ
+
+
+class FakePipe:
+    def __init__(self, name):
+        self.name = name
+        self.model = torch.nn.Linear(1000, 1, bias=False)
+
+
+def make_manager(max_models=1, loader=None):
+    return ModelManager(MODEL_NAMES, loader or FakePipe, max_memory_bytes=MODEL_BYTES * max_models)
+
+
+def test_estimate_model_bytes():
+    assert estimate_model_bytes(FakePipe("a")) == MODEL_BYTES
+
+
+def test_evicts_least_recently_used_model():
+    manager = make_manager(max_models=2)
+    manager.get("a")
+    manager.get("b")
+    manager.get("a")  # b が最も長く使われていない
+    manager.get("c")
+    assert manager.stats()["loaded"] == ["a", "c"]
+
+
+def test_cache_hit_does_not_wait_for_another_models_load():
+    loading = threading.Event()
+    finish_load = threading.Event()
+
+    def loader(name):
+        if name == "model-b":
+            loading.set()
+            finish_load.wait(5)
+        return FakePipe(name)
+
+    manager = make_manager(max_models=2, loader=loader)
+    pipe_a = manager.get("a")
+    thread = threading.Thread(target=manager.get, args=("b",))
+    thread.start()
+    assert loading.wait(5)
+    start = time.perf_counter()
+    assert manager.get("a") is pipe_a  # b のロード中でもすぐに返る
+    assert time.perf_counter() - start < 1
+    finish_load.set()
+    thread.join()
+    assert manager.stats()["loaded"] == ["a", "b"]
+
+
+def test_concurrent_gets_load_a_model_once():
+    calls = []
+
+    def loader(name):
+        calls.append(name)
+        time.sleep(0.05)
+        return FakePipe(name)
+
+    manager = make_manager(loader=loader)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.get("a"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == ["model-a"]
+    assert all(pipe is results[0] for pipe in results)
+
+
+def test_pinned_model_is_not_evicted():
+    manager = make_manager(max_models=1)
+    manager.get("a")
+    with manager.pinned("a"):
+        manager.get("b")  # 予算を超えても a は解放しない
+        assert set(manager.stats()["loaded"]) == {"a", "b"}
+        assert manager.unload("a") is False
+    manager.get("c")
+    assert manager.stats()["loaded"] == ["c"]
+
+
+def test_use_pins_while_in_block():
+    manager = make_manager(max_models=1)
+    with manager.use("a") as pipe:
+        assert pipe.name == "model-a"
+        assert manager.stats()["pinned"] == ["a"]
+    assert manager.stats()["pinned"] == []
+
+
+def test_released_model_still_referenced_counts_against_budget():
+    manager = make_manager(max_models=2)
+    held = manager.get("a")
+    assert manager.unload("a") is True
+    stats = manager.stats()
+    assert stats["loaded"] == []
+    assert stats["released_pending"] == ["a"]
+    assert stats["loaded_bytes"] == MODEL_BYTES
+
+    del held
+    stats = manager.stats()
+    assert stats["released_pending"] == []
+    assert stats["loaded_bytes"] == 0
+
+
+def test_unload_listeners_drop_external_references():
+    manager = make_manager(max_models=1)
+    cache = {"a": manager.get("a")}  # 投機的デコーディングの組のように、モデルを参照するキャッシュ
+    manager.add_unload_listener(lambda key: cache.pop(key, None))
+    manager.get("b")
+    stats = manager.stats()
+    assert cache == {}
+    assert stats["loaded"] == ["b"]
+    assert stats["released_pending"] == []
+    assert stats["loaded_bytes"] == MODEL_BYTES
+
+
+def test_unknown_model_key():
+    with pytest.raises(KeyError):
+        make_manager().get("unknown")
@@ -0,0 +1,60 @@
+import torch
+
+from prefix_cache import PrefixKVCache, cache_nbytes, generate_with_prefix_cache
+
+SYSTEM_PROMPT = "あなたは講義の内容について日本語で簡潔に答えるアシスタントです。"
+GENERATION_KWARGS = {"max_new_tokens": 12, "do_sample": False}
+
+
+def generate_without_cache(model, tokenizer, question, system_prompt):
+    """接頭辞キャッシュを使わずに、同じプロンプトから生成したテキスト"""
+    input_ids = torch.tensor([tokenizer.encode(f"{system_prompt}\n\n") + tokenizer.encode(question, False)])
+    with torch.no_grad():
+        output_ids = model.generate(input_ids, attention_mask=torch.ones_like(input_ids),
+                                    pad_token_id=tokenizer.pad_token_id, **GENERATION_KWARGS)
+    return tokenizer.decode(output_ids[0][input_ids.shape[-1]:], skip_special_tokens=True).strip()
+
+
+def test_second_call_hits_and_matches_uncached_generation(tiny_model, tokenizer):
+    cache = PrefixKVCache(min_prefix_tokens=32)
+    results = [
+        generate_with_prefix_cache(tiny_model, tokenizer, cache, question, SYSTEM_PROMPT, **GENERATION_KWARGS)
+        for question in ("BM25とは何ですか？", "RRFとは何ですか？")
+    ]
+
+    assert [hit for _, hit in results] == [False, True]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["saved_prefill_tokens"] == len(tokenizer.encode(f"{SYSTEM_PROMPT}\n\n"))
+    for (text, _), question in zip(results, ("BM25とは何ですか？", "RRFとは何ですか？")):
+        assert text == generate_without_cache(tiny_model, tokenizer, question, SYSTEM_PROMPT)
+
+
+def test_cached_prefix_is_not_modified_by_generation(tiny_model, tokenizer):
+    cache = PrefixKVCache(min_prefix_tokens=32)
+    generate_with_prefix_cache(tiny_model, tokenizer, cache, "質問1", SYSTEM_PROMPT, **GENERATION_KWARGS)
+    nbytes = cache.stats()["bytes"]
+    first, _ = generate_with_prefix_cache(tiny_model, tokenizer, cache, "質問2", SYSTEM_PROMPT, **GENERATION_KWARGS)
+    again, hit = generate_with_prefix_cache(tiny_model, tokenizer, cache, "質問2", SYSTEM_PROMPT, **GENERATION_KWARGS)
+
+    assert hit and again == first
+    assert cache.stats()["bytes"] == nbytes
+
+
+def test_short_prefix_is_not_cached(tiny_model, tokenizer):
+    cache = PrefixKVCache(min_prefix_tokens=32)
+    assert generate_with_prefix_cache(tiny_model, tokenizer, cache, "質問", "短い指示", **GENERATION_KWARGS) == (None, False)
+    assert cache.stats()["entries"] == 0
+
+
+def test_evicts_least_recently_used_prefix(tiny_model, tokenizer):
+    prompts = [f"{SYSTEM_PROMPT}（{i}）" for i in range(3)]
+    with torch.no_grad():
+        nbytes = cache_nbytes(tiny_model(torch.tensor([tokenizer.encode(f"{prompts[0]}\n\n")])).past_key_values)
+    cache = PrefixKVCache(max_bytes=nbytes * 2, min_prefix_tokens=32)
+    for prompt in (prompts[0], prompts[1], prompts[0], prompts[2]):
+        generate_with_prefix_cache(tiny_model, tokenizer, cache, "質問", prompt, **GENERATION_KWARGS)
+
+    assert cache.stats()["entries"] == 2
+    assert generate_with_prefix_cache(tiny_model, tokenizer, cache, "質問", prompts[0], **GENERATION_KWARGS)[1]
+    assert not generate_with_prefix_cache(tiny_model, tokenizer, cache, "質問", prompts[1], **GENERATION_KWARGS)[1]
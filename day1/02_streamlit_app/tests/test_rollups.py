@@ -0,0 +1,84 @@
+import math
+import sqlite3
+
+import pytest
+
+import rollups
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    rollups.create_tables(conn)
+    yield conn
+    conn.close()
+
+
+def make_row(timestamp, response_time, bleu_score, model_name="model-a", is_correct=1.0):
+    return {"model_name": model_name, "timestamp": timestamp, "is_correct": is_correct,
+            "response_time": response_time, "bleu_score": bleu_score}
+
+
+def test_time_bucket_and_histogram_bin():
+    assert rollups.time_bucket("2026-01-01 12:34:56") == "2026-01-01 12:00"
+    assert rollups.histogram_bin("bleu_score", 0.0) == 0
+    assert rollups.histogram_bin("bleu_score", 0.35) == 3
+    assert rollups.histogram_bin("bleu_score", 1.0) == 9  # 1.0 は最後のビンに含める
+    assert rollups.histogram_bin("response_time", -1) == 0  # 範囲外は両端のビン
+    assert rollups.histogram_bin("response_time", 1000) == len(rollups.HISTOGRAM_BINS["response_time"]) - 1
+    assert rollups.bin_labels("efficiency_score")[-1] == "5-"
+
+
+def test_stats_match_direct_computation_across_batches(conn):
+    rows = [
+        make_row("2026-01-01 10:00:00", 0.4, 0.2),
+        make_row("2026-01-01 10:30:00", 1.5, 0.6, is_correct=0.0),
+        make_row("2026-01-01 11:05:00", 3.0, 0.9, is_correct=0.5),
+        make_row("2026-01-01 11:10:00", 2.0, float("nan")),  # NaN の指標は集計しない
+        make_row("2026-01-01 11:20:00", 9.0, 0.1, is_correct=None),  # is_correct 未設定は対象外
+    ]
+    # 2回に分けて加算しても、まとめて計算した値と一致する
+    rollups.apply(conn, rows[:2])
+    rollups.apply(conn, rows[2:])
+
+    response_times = [0.4, 1.5, 3.0, 2.0]
+    stats = rollups.metric_stats(conn)["response_time"]
+    mean = sum(response_times) / len(response_times)
+    std = math.sqrt(sum((x - mean) ** 2 for x in response_times) / (len(response_times) - 1))
+    assert stats["count"] == 4
+    assert stats["mean"] == pytest.approx(mean)
+    assert stats["std"] == pytest.approx(std)
+    assert (stats["min"], stats["max"]) == (0.4, 3.0)
+    assert rollups.metric_stats(conn)["bleu_score"]["count"] == 3
+
+    efficiency = [1.0 / 0.5, 0.0 / 1.6, 0.5 / 3.1, 1.0 / 2.1]
+    assert rollups.metric_stats(conn)["efficiency_score"]["mean"] == pytest.approx(sum(efficiency) / 4)
+
+    assert rollups.accuracy_counts(conn) == {0.0: 1, 0.5: 1, 1.0: 2}
+    assert rollups.model_accuracy(conn)["model-a"] == pytest.approx(2.5 / 4)
+    assert rollups.histogram(conn, "response_time") == [1, 0, 1, 1, 1, 0, 0, 0, 0, 0, 0]
+
+
+def test_single_value_std_is_nan_and_models_are_separate(conn):
+    rollups.apply(conn, [make_row("2026-01-01 10:00:00", 1.0, 0.5),
+                         make_row("2026-01-01 10:00:00", 3.0, 0.5, model_name="model-b")])
+    assert math.isnan(rollups.metric_stats(conn, "model-a")["response_time"]["std"])
+    assert rollups.metric_means_by_model(conn, "response_time") == {"model-a": 1.0, "model-b": 3.0}
+    assert sum(rollups.histogram(conn, "bleu_score", model_name="model-b")) == 1
+
+
+def test_rebuild_matches_incremental(conn):
+    conn.execute("CREATE TABLE history (model_name TEXT, timestamp TEXT, is_correct REAL, response_time REAL, "
+                 "bleu_score REAL, similarity_score REAL, word_count INTEGER, relevance_score REAL)")
+    rows = [make_row(f"2026-01-01 {i % 24:02d}:00:00", 0.1 * i, (i % 10) / 10, is_correct=float(i % 2))
+            for i in range(50)]
+    conn.executemany("INSERT INTO history (model_name, timestamp, is_correct, response_time, bleu_score) "
+                     "VALUES (:model_name, :timestamp, :is_correct, :response_time, :bleu_score)", rows)
+    rollups.apply(conn, rows)
+    incremental = rollups.metric_stats(conn)
+    rollups.rebuild(conn, "history")
+    rebuilt = rollups.metric_stats(conn)
+    assert rebuilt.keys() == incremental.keys()
+    for metric, stats in incremental.items():
+        for key, value in stats.items():
+            assert rebuilt[metric][key] == pytest.approx(value, nan_ok=True)
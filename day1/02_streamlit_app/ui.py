@@ -1,11 +1,12 @@
 import streamlit as st
 import pandas as pd
 import time
-from database import save_to_db, get_chat_history, get_db_count, clear_db
-from llm import generate_response
+import sqlite3
+from database import save_to_db_async, get_db_count, clear_db, query_chat_history, count_chat_history, get_metrics_rollup, rescore_chat_history
+from generation_job import GenerationJob
 from data import create_sample_evaluation_data
 from metrics import get_metrics_descriptions
-from config import MODEL_NAMES
+from config import MODEL_NAMES, CHAT_STREAM_REFRESH_SECONDS, CHAT_SYSTEM_PROMPT
 
 # カスタムCSS
 st.markdown(
@@ -74,7 +75,7 @@ st.markdown(
 )
 
 # チャットページ
-def display_chat_page(models):
+def display_chat_page(model_manager):
     """チャットページのUIを表示"""
     st.title("💬 AIチャット")
     st.markdown("質問を入力してAIと対話しましょう！")
@@ -94,8 +95,14 @@ def display_chat_page(models):
         st.warning("注意: XGLM-564Mは日本語の会話性能がGemma-2-2Bに比べて低い場合があります。最適な結果を得るにはGemma-2-2Bをお勧めします。")
 
 
-    # モデル取得
-    pipe = models.get(selected_model_key)
+    # モデル取得（未ロードの場合はここで初めてロードする）
+    if model_manager.is_loaded(selected_model_key):
+        pipe = model_manager.get(selected_model_key)
+    else:
+        with st.spinner(f"モデル '{selected_model_key}' をロード中..."):
+            pipe = model_manager.get(selected_model_key)
+        if pipe:
+            st.success(f"{selected_model_key}モデルの読み込みに成功しました。(ロード時間: {model_manager.get_load_time(selected_model_key):.1f}秒)")
     if not pipe:
         st.error(f"モデル '{selected_model_key}' がロードされていません。")
         return
@@ -128,19 +135,24 @@ def display_chat_page(models):
         if not user_question.strip():
             st.warning("質問を入力してください。")
             return
+        previous_job = st.session_state.get("generation_job")
+        if previous_job is not None:
+            previous_job.cancel()  # 前の質問の生成が続いている場合は打ち切る
         st.session_state.current_question = user_question
         st.session_state.current_answer = ""
+        st.session_state.latency = None
+        st.session_state.generation_cancelled = False
+        st.session_state.generation_notices = []
         st.session_state.feedback_given = False
         st.session_state.selected_model = model_name
+        # 生成はバックグラウンドスレッドで行い、このスクリプトの実行は完了を待たずに戻る
+        st.session_state.generation_job = GenerationJob(pipe, user_question, model_name,
+                                                         system_prompt=CHAT_SYSTEM_PROMPT)
 
-        with st.spinner("回答を生成中..."):
-            try:
-                answer, response_time = generate_response(pipe, user_question)
-                st.session_state.current_answer = answer
-                st.session_state.response_time = response_time
-                st.rerun()
-            except Exception as e:
-                st.error(f"回答生成中にエラーが発生しました: {e}")
+    # 生成中の回答を表示（完了するとアプリ全体を再実行して、下の回答表示に切り替わる）
+    if st.session_state.get("generation_job") is not None:
+        display_generation_progress()
+        return
 
     # 回答表示
     if st.session_state.current_question and st.session_state.current_answer:
@@ -148,7 +160,11 @@ def display_chat_page(models):
             st.markdown("<div class='chat-card'>", unsafe_allow_html=True)
             st.markdown(f"### 回答 (モデル: {selected_model_key})")
             st.markdown(st.session_state.current_answer)
+            display_notices(st.session_state.pop("generation_notices", []))
+            if st.session_state.get("generation_cancelled"):
+                st.caption("⏹ 生成を中止したため、途中までの回答です。")
             st.info(f"応答時間: {st.session_state.response_time:.2f}秒")
+            display_latency_breakdown(st.session_state.get("latency"))
             st.markdown("</div>", unsafe_allow_html=True)
 
             if not st.session_state.feedback_given:
@@ -158,9 +174,63 @@ def display_chat_page(models):
                     st.session_state.current_question = ""
                     st.session_state.current_answer = ""
                     st.session_state.response_time = 0.0
+                    st.session_state.latency = None
+                    st.session_state.generation_cancelled = False
                     st.session_state.feedback_given = False
                     st.rerun()
 
+@st.fragment(run_every=CHAT_STREAM_REFRESH_SECONDS)
+def display_generation_progress():
+    """生成途中の回答を定期的に読み出して表示する
+
+    このフラグメントだけが一定間隔で再実行されるため、生成を待つ間セッションのスクリプト実行スレッドを占有しない。
+    """
+    job = st.session_state.get("generation_job")
+    if job is None:
+        return
+    if job.done:
+        st.session_state.current_answer = job.answer
+        st.session_state.response_time = job.response_time
+        st.session_state.latency = job.latency
+        st.session_state.generation_cancelled = job.cancelled
+        st.session_state.generation_notices = job.notices
+        st.session_state.generation_job = None
+        st.rerun()
+
+    with st.container():
+        st.markdown("<div class='chat-card'>", unsafe_allow_html=True)
+        st.markdown("### 回答を生成中...")
+        display_notices(job.notices)
+        st.markdown(job.partial_text + "▌")
+        st.caption(f"経過時間: {job.elapsed:.1f}秒")
+        st.markdown("</div>", unsafe_allow_html=True)
+    if job.cancelled:
+        st.caption("生成を中止しています...")
+    elif st.button("⏹ 生成を中止", key="cancel_generation"):
+        job.cancel()
+
+def display_notices(notices):
+    """バックグラウンドの生成で発生した通知（ドラフトモデルのロード・警告・エラー）を表示"""
+    for notice in notices:
+        getattr(st, notice["type"])(notice["message"])
+
+def display_latency_breakdown(latency):
+    """応答時間の段階別の内訳を表示"""
+    if not latency or latency.get("input_tokens") is None:
+        return  # 応答キャッシュから返した場合などは内訳がない
+    stage_labels = {
+        "templating_time": "テンプレート",
+        "tokenization_time": "トークナイズ",
+        "prefill_time": "プリフィル",
+        "decode_time": "デコード",
+        "postprocess_time": "後処理",
+    }
+    parts = [f"{label} {latency[key]:.3f}s" for key, label in stage_labels.items() if latency.get(key) is not None]
+    per_token = latency.get("decode_time_per_token")
+    if per_token:
+        parts.append(f"{per_token * 1000:.1f}ms/トークン")
+    st.caption(f"内訳: {' / '.join(parts)}（入力 {latency['input_tokens']} トークン → 出力 {latency['output_tokens']} トークン）")
+
 def display_feedback_form():
     """フィードバック入力フォーム"""
     with st.container():
@@ -191,7 +261,8 @@ def display_feedback_form():
                 if feedback_comment:
                     combined_feedback += f": {feedback_comment}"
 
-                save_to_db(
+                # 評価指標の計算と保存はバックグラウンドで行い、画面はすぐに戻す
+                save_to_db_async(
                     st.session_state.selected_model,
                     st.session_state.current_question,
                     st.session_state.current_answer,
@@ -199,6 +270,7 @@ def display_feedback_form():
                     correct_answer,
                     is_correct,
                     st.session_state.response_time,
+                    latency=st.session_state.get("latency"),
                 )
                 st.session_state.feedback_given = True
                 st.success("フィードバックが保存されました！")
@@ -209,19 +281,17 @@ def display_feedback_form():
 def display_history_page():
     """履歴閲覧ページのUI"""
     st.title("📜 チャット履歴")
-    history_df = get_chat_history()
-
-    if history_df.empty:
+    if get_db_count() == 0:
         st.info("まだチャット履歴がありません。")
         return
 
     tab1, tab2 = st.tabs(["履歴リスト", "評価分析"])
     with tab1:
-        display_history_list(history_df)
+        display_history_list()
     with tab2:
-        display_metrics_analysis(history_df)
+        display_metrics_analysis()
 
-def display_history_list(history_df):
+def display_history_list():
     """履歴リストを表示"""
     st.markdown("### 履歴リスト")
     filter_options = {
@@ -236,24 +306,21 @@ def display_history_list(history_df):
         horizontal=True
     )
 
+    # 絞り込みとページングはDB側で行い、表示する1ページ分だけを読み込む
     filter_value = filter_options[display_option]
-    if filter_value is not None:
-        filtered_df = history_df[history_df["is_correct"].notna() & (history_df["is_correct"] == filter_value)]
-    else:
-        filtered_df = history_df
+    total_items = count_chat_history(is_correct=filter_value)
 
-    if filtered_df.empty:
+    if total_items == 0:
         st.info("選択した条件に一致する履歴はありません。")
         return
 
     items_per_page = 5
-    total_items = len(filtered_df)
     total_pages = (total_items + items_per_page - 1) // items_per_page
     current_page = st.number_input('ページ', min_value=1, max_value=total_pages, value=1, step=1)
 
     start_idx = (current_page - 1) * items_per_page
     end_idx = start_idx + items_per_page
-    paginated_df = filtered_df.iloc[start_idx:end_idx]
+    paginated_df = query_chat_history(is_correct=filter_value, limit=items_per_page, offset=start_idx)
 
     for i, row in paginated_df.iterrows():
         with st.expander(f"{row['timestamp']} - Q: {row['question'][:50] if row['question'] else 'N/A'}..."):
@@ -277,71 +344,56 @@ def display_history_list(history_df):
 
     st.caption(f"{total_items} 件中 {start_idx+1} - {min(end_idx, total_items)} 件を表示")
 
-def display_metrics_analysis(history_df):
-    """評価指標の分析結果を表示"""
+def display_metrics_analysis():
+    """評価指標の分析結果を表示（保存時に更新される集計テーブルだけを読む）"""
     st.markdown("### 評価指標の分析")
-    analysis_df = history_df.dropna(subset=['is_correct'])
-    if analysis_df.empty:
+    summary = get_metrics_rollup()
+    if not summary["accuracy_counts"]:
         st.warning("分析可能な評価データがありません。")
         return
 
     accuracy_labels = {1.0: '正確', 0.5: '部分的に正確', 0.0: '不正確'}
-    analysis_df['正確性'] = analysis_df['is_correct'].map(accuracy_labels)
 
     st.markdown("#### 正確性の分布")
-    accuracy_counts = analysis_df['正確性'].value_counts()
-    if not accuracy_counts.empty:
-        st.bar_chart(accuracy_counts)
-    else:
-        st.info("正確性データがありません。")
+    accuracy_counts = pd.Series({
+        accuracy_labels.get(value, str(value)): n for value, n in summary["accuracy_counts"].items()
+    })
+    st.bar_chart(accuracy_counts)
 
     st.markdown("#### モデルごとの正確性")
-    if 'model_name' in analysis_df.columns:
-        model_accuracy = analysis_df.groupby('model_name')['is_correct'].mean()
-        st.bar_chart(model_accuracy)
+    st.bar_chart(pd.Series(summary["model_accuracy"], name="is_correct"))
 
-    st.markdown("#### 応答時間と指標の関係")
-    metric_options = ["bleu_score", "similarity_score", "relevance_score", "word_count"]
-    valid_metric_options = [m for m in metric_options if m in analysis_df.columns and analysis_df[m].notna().any()]
+    st.markdown("#### 指標の分布")
+    metric_options = ["bleu_score", "similarity_score", "relevance_score", "word_count", "response_time"]
+    valid_metric_options = [m for m in metric_options if m in summary["stats"]]
     if valid_metric_options:
         metric_option = st.selectbox(
-            "比較する指標",
+            "表示する指標",
             valid_metric_options,
             key="metric_select"
         )
-        chart_data = analysis_df[['response_time', metric_option, '正確性']].dropna()
-        if not chart_data.empty:
-            st.scatter_chart(
-                chart_data,
-                x='response_time',
-                y=metric_option,
-                color='正確性',
-            )
-        else:
-            st.info(f"選択された指標 ({metric_option}) のデータがありません。")
+        metric_summary = get_metrics_rollup(metric_option)
+        histogram = pd.Series(metric_summary["histogram"], index=metric_summary["bin_labels"], name="件数")
+        st.bar_chart(histogram)
+        st.caption("モデルごとの平均")
+        st.bar_chart(pd.Series(metric_summary["model_means"], name=metric_option))
     else:
         st.info("比較可能な指標データがありません。")
 
     st.markdown("#### 評価指標の統計")
     stats_cols = ['response_time', 'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
-    valid_stats_cols = [c for c in stats_cols if c in analysis_df.columns and analysis_df[c].notna().any()]
+    valid_stats_cols = [c for c in stats_cols if c in summary["stats"]]
     if valid_stats_cols:
-        metrics_stats = analysis_df[valid_stats_cols].describe()
+        metrics_stats = pd.DataFrame({c: summary["stats"][c] for c in valid_stats_cols})
         st.dataframe(metrics_stats)
     else:
         st.info("統計情報を計算できるデータがありません。")
 
     st.markdown("#### 効率性スコア")
-    if 'response_time' in analysis_df.columns and analysis_df['response_time'].notna().any():
-        analysis_df['efficiency_score'] = analysis_df['is_correct'] / (analysis_df['response_time'].fillna(0) + 0.1)
-        if 'id' in analysis_df.columns:
-            top_efficiency = analysis_df.sort_values('efficiency_score', ascending=False).head(10)
-            if not top_efficiency.empty:
-                st.bar_chart(top_efficiency.set_index('id')['efficiency_score'])
-            else:
-                st.info("効率性スコアデータがありません。")
-        else:
-            st.bar_chart(analysis_df.sort_values('efficiency_score', ascending=False).head(10)['efficiency_score'])
+    efficiency_summary = get_metrics_rollup("efficiency_score")
+    if efficiency_summary.get("model_means"):
+        st.caption("モデルごとの平均効率性スコア")
+        st.bar_chart(pd.Series(efficiency_summary["model_means"], name="efficiency_score"))
     else:
         st.info("応答時間データがありません。")
 
@@ -352,7 +404,7 @@ def display_data_page():
     count = get_db_count()
     st.write(f"データベースに **{count} 件** のレコードがあります。")
 
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     with col1:
         if st.button("📥 サンプルデータを追加", key="create_samples"):
             create_sample_evaluation_data()
@@ -361,6 +413,16 @@ def display_data_page():
         if st.button("🗑 データベースをクリア", key="clear_db_button"):
             if clear_db():
                 st.rerun()
+    with col3:
+        if st.button("🔁 評価指標を再計算", key="rescore_button"):
+            progress_bar = st.progress(0.0, text="評価指標を再計算しています...")
+            try:
+                updated = rescore_chat_history(
+                    progress=lambda done, total: progress_bar.progress(min(done / max(total, 1), 1.0))
+                )
+                st.success(f"{updated} 件の評価指標を再計算しました。")
+            except sqlite3.Error as e:
+                st.error(f"評価指標の再計算中にエラーが発生しました: {e}")
 
     st.markdown("### 評価指標の説明")
     metrics_info = get_metrics_descriptions()
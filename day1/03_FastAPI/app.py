@@ -1,15 +1,31 @@
 import os
+import json
+import sqlite3
+from contextlib import closing
+import asyncio
+import threading
 import torch
-from transformers import pipeline
+from transformers import pipeline, set_seed, TextStreamer, StoppingCriteriaList
 import time
 import traceback
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict
 import uvicorn
 import nest_asyncio
 from pyngrok import ngrok
+import common_path  # noqa: F401  day1/common の共有モジュールを import できるようにする
+from batching import BatchScheduler
+from worker_pool import InferencePool, QueueFullError
+from response_cache import ResponseCache, is_cacheable, make_cache_key
+from cpu_profile import select_dtype, configure_threads, quantize_int8
+from latency import LatencyBreakdown, TokenTimer, STAGES
+from prometheus import Registry, RequestMetricsMiddleware
+from speculative import SpeculativeDecoder
+from stopping import AdaptiveTokenBudget, DEFAULT_STOP_SEQUENCES, split_stop_sequences, stopping_kwargs
+from stopping import truncate_at_stop, safe_stream_length
 
 # --- 設定 ---
 # モデル名を設定
@@ -20,6 +36,37 @@ print(f"モデル名を設定: {MODEL_NAME}")
 class Config:
     def __init__(self, model_name=MODEL_NAME):
         self.MODEL_NAME = model_name
+        # バッチ推論の設定（同時リクエストをまとめる最大件数と待ち時間）
+        self.BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 8))
+        self.BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 20))
+        # 推論ワーカーの設定（同時に推論するワーカー数と、推論開始を待てるリクエスト数の上限）
+        self.INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 1))
+        self.MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", 32))
+        # 応答キャッシュの設定（do_sample=False またはシード固定のリクエストのみ対象）
+        self.CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 1024))
+        self.CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", 3600))
+        self.CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH")  # 指定するとSQLiteにも保存
+        # CPU推論の設定
+        self.TORCH_DTYPE = os.environ.get("TORCH_DTYPE", "auto")  # auto / float32 / bfloat16 / float16
+        self.QUANTIZE_INT8 = os.environ.get("QUANTIZE_INT8", "0").lower() in ("1", "true", "yes")  # CPU時にLinear層をint8動的量子化
+        self.TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0)) or None  # ワーカーあたりのintra-opスレッド数（未指定ならコア数/ワーカー数）
+        self.TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", 0)) or None
+        # 投機的デコーディングの設定（ドラフトモデルを指定すると有効。例: facebook/xglm-564M）
+        self.DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME") or None
+        self.NUM_ASSISTANT_TOKENS = int(os.environ.get("NUM_ASSISTANT_TOKENS", 5))
+        self.SPECULATIVE_ALLOW_UNIVERSAL = os.environ.get("SPECULATIVE_ALLOW_UNIVERSAL", "1").lower() in ("1", "true", "yes")
+        self.SPECULATIVE_BASELINE_EVERY = int(os.environ.get("SPECULATIVE_BASELINE_EVERY", 0))
+        # 生成を打ち切る停止文字列（JSONの文字列リスト。リクエストの stop で上書きできる）
+        self.STOP_SEQUENCES = json.loads(os.environ.get("STOP_SEQUENCES", json.dumps(DEFAULT_STOP_SEQUENCES)))
+        # 過去の応答トークン数からエンドポイントごとに max_new_tokens の上限を決める
+        self.ADAPTIVE_MAX_NEW_TOKENS = os.environ.get("ADAPTIVE_MAX_NEW_TOKENS", "1").lower() in ("1", "true", "yes")
+        self.ADAPTIVE_TOKENS_QUANTILE = float(os.environ.get("ADAPTIVE_TOKENS_QUANTILE", 0.95))
+        self.ADAPTIVE_TOKENS_MARGIN = float(os.environ.get("ADAPTIVE_TOKENS_MARGIN", 1.25))
+        self.ADAPTIVE_TOKENS_MIN = int(os.environ.get("ADAPTIVE_TOKENS_MIN", 64))
+        self.ADAPTIVE_TOKENS_MIN_SAMPLES = int(os.environ.get("ADAPTIVE_TOKENS_MIN_SAMPLES", 20))
+        self.ADAPTIVE_TOKENS_WINDOW = int(os.environ.get("ADAPTIVE_TOKENS_WINDOW", 500))
+        # 上限の初期値に使うchat_historyのDB（例: ../02_streamlit_app/chat_feedback.db）
+        self.HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH")
 
 config = Config(MODEL_NAME)
 
@@ -51,14 +98,152 @@ class SimpleGenerationRequest(BaseModel):
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    seed: Optional[int] = None  # 指定するとサンプリング時も結果が固定され、キャッシュ対象になる
+    stop: Optional[List[str]] = None  # 停止文字列（省略時はサーバーの設定 STOP_SEQUENCES）
 
 class GenerationResponse(BaseModel):
     generated_text: str
     response_time: float
+    batch_size: Optional[int] = None  # まとめて推論されたリクエスト数
+    queue_wait_time: Optional[float] = None  # 推論開始までの待ち時間（秒）
+    cached: bool = False  # 応答キャッシュから返したかどうか
+    latency: Optional[Dict[str, float]] = None  # 段階別の処理時間（秒）: tokenization_time, prefill_time など
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
 
 # --- モデル関連の関数 ---
 # モデルのグローバル変数
 model = None
+# バッチスケジューラのグローバル変数
+batcher = None
+# ドラフトモデルとの組（投機的デコーディングを使わない場合はNone）
+speculative_decoder = None
+# 推論時のdtype・量子化・スレッド数の設定内容（/healthで報告する）
+inference_profile = {
+    "threads": configure_threads(config.TORCH_THREADS, config.TORCH_INTEROP_THREADS, config.INFERENCE_WORKERS),
+}
+
+def init_inference_worker():
+    """推論ワーカースレッドの初期化（スレッドごとにintra-opスレッド数を設定する）"""
+    configure_threads(config.TORCH_THREADS, None, config.INFERENCE_WORKERS)
+
+# 推論専用のワーカープール（イベントループを止めないよう、推論はすべてここで実行する）
+inference_pool = InferencePool(
+    max_workers=config.INFERENCE_WORKERS,
+    max_queue_size=config.MAX_QUEUE_SIZE,
+    initializer=init_inference_worker,
+)
+# モデル読み込みの状態
+model_load_lock = threading.Lock()
+model_loading = False
+# 決定的な生成の応答キャッシュ
+response_cache = ResponseCache(
+    max_entries=config.CACHE_MAX_ENTRIES,
+    ttl_seconds=config.CACHE_TTL_SECONDS,
+    db_path=config.CACHE_DB_PATH,
+)
+
+# エンドポイントごとの max_new_tokens の上限（応答ごとの出力トークン数から学習する）
+token_budget = AdaptiveTokenBudget(
+    quantile=config.ADAPTIVE_TOKENS_QUANTILE,
+    margin=config.ADAPTIVE_TOKENS_MARGIN,
+    min_tokens=config.ADAPTIVE_TOKENS_MIN,
+    min_samples=config.ADAPTIVE_TOKENS_MIN_SAMPLES,
+    window=config.ADAPTIVE_TOKENS_WINDOW,
+)
+GENERATION_ENDPOINTS = ("generate", "generate_stream")
+
+def seed_token_budget(db_path):
+    """chat_historyに保存された同じモデルの応答の長さを、全エンドポイントの上限の初期値として読み込む"""
+    try:
+        with closing(sqlite3.connect(db_path)) as conn:
+            rows = conn.execute(
+                "SELECT word_count, output_tokens FROM chat_history "
+                "WHERE model_name = ? AND (word_count IS NOT NULL OR output_tokens IS NOT NULL) "
+                "ORDER BY id DESC LIMIT ?",
+                (config.MODEL_NAME, config.ADAPTIVE_TOKENS_WINDOW),
+            ).fetchall()
+    except sqlite3.Error as e:
+        print(f"応答の長さの履歴を読み込めませんでした: {e}")
+        return
+    rows.reverse()  # 古い順に記録する
+    for endpoint in GENERATION_ENDPOINTS:
+        token_budget.seed((endpoint, words, tokens) for words, tokens in rows)
+    print(f"max_new_tokens の上限の初期値を {len(rows)} 件の履歴から学習しました: {token_budget.stats()}")
+
+if config.ADAPTIVE_MAX_NEW_TOKENS and config.HISTORY_DB_PATH:
+    seed_token_budget(config.HISTORY_DB_PATH)
+
+# --- メトリクス（/metrics でPrometheusのテキスト形式として公開する） ---
+metrics_registry = Registry()
+stage_duration = metrics_registry.histogram(
+    "llm_stage_duration_seconds", "リクエスト処理の段階別の所要時間（秒）", ["endpoint", "stage"]
+)
+decode_time_per_token = metrics_registry.histogram(
+    "llm_decode_seconds_per_token", "1トークンあたりのデコード時間（秒）", ["endpoint"],
+    buckets=(0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1),
+)
+input_tokens_total = metrics_registry.counter("llm_input_tokens_total", "プロンプトのトークン数の合計", ["endpoint"])
+output_tokens_total = metrics_registry.counter("llm_output_tokens_total", "生成したトークン数の合計", ["endpoint"])
+generation_tokens_per_second = metrics_registry.histogram(
+    "llm_generation_tokens_per_second", "リクエストごとの生成速度（出力トークン数 / (プリフィル + デコード時間)）",
+    ["endpoint"], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+request_duration = metrics_registry.histogram(
+    "http_request_duration_seconds", "エンドポイントごとのリクエスト処理時間（レスポンス本文の送信完了まで）",
+    ["endpoint", "method", "status"],
+)
+requests_in_flight = metrics_registry.gauge("http_requests_in_flight", "処理中のHTTPリクエスト数")
+app.add_middleware(RequestMetricsMiddleware, in_flight=requests_in_flight, duration=request_duration)
+model_load_seconds = metrics_registry.gauge("llm_model_load_seconds", "最後にモデルの読み込みにかかった時間（秒）")
+
+def process_rss_bytes():
+    """プロセスの現在の常駐メモリ量（バイト）。取得できない環境ではNone"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+metrics_registry.gauge("process_resident_memory_bytes", "プロセスの常駐メモリ量（バイト）").set_function(process_rss_bytes)
+
+# 推論キューと応答キャッシュの値は、/metrics の出力時に読み出す
+metrics_registry.gauge("inference_queue_depth", "推論開始を待っているリクエスト数").set_function(
+    lambda: inference_pool.stats()["queued"])
+metrics_registry.gauge("inference_running", "推論中のリクエスト数").set_function(
+    lambda: inference_pool.stats()["running"])
+metrics_registry.counter("inference_rejected_total", "キューが満杯のため拒否したリクエスト数").set_function(
+    lambda: inference_pool.stats()["rejected_total"])
+metrics_registry.counter("response_cache_hits_total", "応答キャッシュのヒット数").set_function(
+    lambda: response_cache.stats()["hits"])
+metrics_registry.counter("response_cache_misses_total", "応答キャッシュのミス数").set_function(
+    lambda: response_cache.stats()["misses"])
+metrics_registry.gauge("response_cache_hit_ratio", "応答キャッシュのヒット率").set_function(
+    lambda: response_cache.stats()["hit_ratio"])
+max_new_tokens_budget = metrics_registry.gauge(
+    "llm_max_new_tokens_budget", "過去の応答の長さから決めた max_new_tokens の上限", ["endpoint"])
+for _endpoint in GENERATION_ENDPOINTS:
+    max_new_tokens_budget.set_function(
+        lambda endpoint=_endpoint: token_budget.stats().get(endpoint, {}).get("budget"), endpoint=_endpoint)
+metrics_registry.gauge("speculative_acceptance_rate", "投機的デコーディングでドラフトの提案が受理された割合").set_function(
+    lambda: speculative_decoder.stats.stats()["acceptance_rate"] if speculative_decoder else None)
+metrics_registry.gauge("speculative_speedup", "投機的デコーディングの通常の生成に対する速度比").set_function(
+    lambda: speculative_decoder.stats.stats()["speedup"] if speculative_decoder else None)
+
+def observe_latency(endpoint, breakdown):
+    """1リクエスト分の段階別の処理時間とトークン数をメトリクスに記録する"""
+    for stage in STAGES:
+        if stage in breakdown.timings:
+            stage_duration.observe(breakdown.timings[stage], endpoint=endpoint, stage=stage)
+    if breakdown.decode_time_per_token is not None:
+        decode_time_per_token.observe(breakdown.decode_time_per_token, endpoint=endpoint)
+    if breakdown.input_tokens is not None:
+        input_tokens_total.inc(breakdown.input_tokens, endpoint=endpoint)
+    if breakdown.output_tokens is not None:
+        output_tokens_total.inc(breakdown.output_tokens, endpoint=endpoint)
+        generation_time = breakdown.timings.get("prefill", 0.0) + breakdown.timings.get("decode", 0.0)
+        if generation_time > 0:
+            generation_tokens_per_second.observe(breakdown.output_tokens / generation_time, endpoint=endpoint)
 
 def load_model():
     """推論用のLLMモデルを読み込む"""
@@ -66,13 +251,31 @@ def load_model():
     try:
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"使用デバイス: {device}")
+        # int8動的量子化はfloat32の重みに対して行うため、量子化する場合はfloat32で読み込む
+        quantize = config.QUANTIZE_INT8 and device == "cpu"
+        torch_dtype, dtype_info = select_dtype(device, "float32" if quantize else config.TORCH_DTYPE)
+        print(f"使用dtype: {dtype_info}")
         pipe = pipeline(
             "text-generation",
             model=config.MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
+            model_kwargs={"torch_dtype": torch_dtype},
             device=device
         )
+        if quantize:
+            pipe.model = quantize_int8(pipe.model)
+            print("Linear層をint8に動的量子化しました。")
+        inference_profile.update({
+            "device": device,
+            "dtype": dtype_info,
+            "quantization": "int8-dynamic" if quantize else None,
+        })
+        # バッチ推論ではプロンプト長を揃える必要があるため、パディングを設定する
+        if pipe.tokenizer.pad_token is None:
+            pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+        pipe.tokenizer.padding_side = "left"  # デコーダモデルは左側をパディング
         print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
+        if config.DRAFT_MODEL_NAME:
+            load_draft_model(pipe, device, torch_dtype)
         model = pipe  # グローバル変数を更新
         return pipe
     except Exception as e:
@@ -81,65 +284,226 @@ def load_model():
         traceback.print_exc()  # 詳細なエラー情報を出力
         return None
 
-def extract_assistant_response(outputs, user_prompt):
-    """モデルの出力からアシスタントの応答を抽出する"""
-    assistant_response = ""
+def load_draft_model(pipe, device, torch_dtype):
+    """投機的デコーディング用のドラフトモデルを読み込み、ターゲットモデルとの組を作成する"""
+    global speculative_decoder
     try:
-        if outputs and isinstance(outputs, list) and len(outputs) > 0 and outputs[0].get("generated_text"):
-            generated_output = outputs[0]["generated_text"]
-            
-            if isinstance(generated_output, list):
-                # メッセージフォーマットの場合
-                if len(generated_output) > 0:
-                    last_message = generated_output[-1]
-                    if isinstance(last_message, dict) and last_message.get("role") == "assistant":
-                        assistant_response = last_message.get("content", "").strip()
-                    else:
-                        # 予期しないリスト形式の場合は最後の要素を文字列として試行
-                        print(f"警告: 最後のメッセージの形式が予期しないリスト形式です: {last_message}")
-                        assistant_response = str(last_message).strip()
-
-            elif isinstance(generated_output, str):
-                # 文字列形式の場合
-                full_text = generated_output
-                
-                # 単純なプロンプト入力の場合、プロンプト後の全てを抽出
-                if user_prompt:
-                    prompt_end_index = full_text.find(user_prompt)
-                    if prompt_end_index != -1:
-                        prompt_end_pos = prompt_end_index + len(user_prompt)
-                        assistant_response = full_text[prompt_end_pos:].strip()
-                    else:
-                        # 元のプロンプトが見つからない場合は、生成されたテキストをそのまま返す
-                        assistant_response = full_text
-                else:
-                    assistant_response = full_text
-            else:
-                print(f"警告: 予期しない出力タイプ: {type(generated_output)}")
-                assistant_response = str(generated_output).strip()  # 文字列に変換
+        draft = pipeline("text-generation", model=config.DRAFT_MODEL_NAME,
+                         model_kwargs={"torch_dtype": torch_dtype}, device=device)
+    except Exception as e:
+        # ドラフトモデルが使えなくても、通常の生成でサービスは継続する
+        print(f"ドラフトモデル '{config.DRAFT_MODEL_NAME}' の読み込みに失敗したため、通常の生成を行います: {e}")
+        return
+    speculative_decoder = SpeculativeDecoder(
+        pipe.model, pipe.tokenizer, draft.model, draft.tokenizer,
+        num_assistant_tokens=config.NUM_ASSISTANT_TOKENS,
+        allow_universal=config.SPECULATIVE_ALLOW_UNIVERSAL,
+        baseline_every=config.SPECULATIVE_BASELINE_EVERY,
+    )
+    inference_profile["speculative"] = {"draft_model": config.DRAFT_MODEL_NAME, "mode": speculative_decoder.mode}
+    print(f"投機的デコーディング: draft={config.DRAFT_MODEL_NAME}, mode={speculative_decoder.mode}")
+
+def get_generate():
+    """生成に使う関数（ドラフトモデルとの組があれば投機的デコーディング）"""
+    return speculative_decoder.generate if speculative_decoder is not None else model.model.generate
+
+def run_generation_batch(prompts, generation_kwargs):
+    """複数のプロンプトをまとめて推論し、プロンプトごとに (生成テキスト, LatencyBreakdown) を返す
+
+    トークナイズ・プリフィル・デコードを個別に計測するため、パイプラインを通さずにgenerateを呼び出す。
+    生成部分だけをデコードし、停止文字列の手前で切り取る。
+    """
+    if model is None:
+        raise RuntimeError("モデルが読み込まれていません")
+    generation_kwargs = dict(generation_kwargs)
+    seed = generation_kwargs.pop("seed", None)
+    stop_sequences = generation_kwargs.pop("stop_sequences", ())
+    if seed is not None:
+        set_seed(seed)  # 同じシードのリクエストだけが同じバッチにまとめられる
+    print(f"バッチ推論を開始: batch_size={len(prompts)}")
+    tokenizer = model.tokenizer
+    breakdown = LatencyBreakdown()
+    with breakdown.stage("tokenization"):
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.model.device)
+    eos_token_id, stop_criteria, stop_strings = stopping_kwargs(
+        model.model, tokenizer, stop_sequences, inputs.input_ids.shape[-1]
+    )
+    timer = TokenTimer()
+    with torch.no_grad():
+        output_ids = get_generate()(
+            **inputs,
+            stopping_criteria=StoppingCriteriaList([timer, *stop_criteria]),
+            eos_token_id=eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            **generation_kwargs,
+        )
+    breakdown.record_generation(timer)
+    new_ids = output_ids[:, inputs.input_ids.shape[-1]:]
+    with breakdown.stage("postprocess"):
+        texts = [truncate_at_stop(text, stop_strings).strip()
+                 for text in tokenizer.batch_decode(new_ids, skip_special_tokens=True)]
+    print("バッチ推論が完了しました。")
+
+    results = []
+    for i, text in enumerate(texts):
+        # プリフィル・デコードはバッチ全体で共有した時間、トークン数はリクエストごとの値
+        request_breakdown = breakdown.copy()
+        request_breakdown.input_tokens = int(inputs.attention_mask[i].sum())
+        request_breakdown.output_tokens = int((new_ids[i] != tokenizer.pad_token_id).sum())
+        results.append((text, request_breakdown))
+    return results
+
+class AsyncQueueStreamer(TextStreamer):
+    """ワーカースレッドでデコードしたテキストを、イベントループの asyncio.Queue に渡すストリーマー
+
+    キューへの追加は call_soon_threadsafe でイベントループに任せるため、受け取る側はスレッドを使わずに
+    await queue.get() で待てる。終了の None は generate() の end() ではなく close() で積むため、
+    生成後に記録する処理時間・トークン数は受け取る側が None を受け取った時点で揃っている。
+    """
+
+    def __init__(self, tokenizer, loop):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.error = None
+
+    def _put(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            pass  # イベントループが終了している（サーバーの停止中）
 
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self._put(text)
+
+    def close(self):
+        """ストリームの終了を受け取る側に知らせる"""
+        self._put(None)
+
+def run_streaming_generation(prompt, generation_kwargs, streamer, cancel_event, ticket, breakdown):
+    """ワーカースレッドでトークンを逐次生成し、streamerに書き込む（段階別の処理時間をbreakdownに記録する）"""
+    ticket.start()
+    try:
+        if cancel_event.is_set():
+            # 待っている間にクライアントが切断した場合は生成しない
+            return
+        generation_kwargs = dict(generation_kwargs)
+        seed = generation_kwargs.pop("seed", None)
+        stop_sequences = generation_kwargs.pop("stop_sequences", ())
+        if seed is not None:
+            set_seed(seed)
+        with breakdown.stage("tokenization"):
+            inputs = model.tokenizer(prompt, return_tensors="pt").to(model.model.device)
+        breakdown.input_tokens = inputs.input_ids.shape[-1]
+        eos_token_id, stop_criteria, _ = stopping_kwargs(
+            model.model, model.tokenizer, stop_sequences, inputs.input_ids.shape[-1], cancel_event=cancel_event
+        )
+        timer = TokenTimer()
+        get_generate()(
+            **inputs,
+            streamer=streamer,
+            stopping_criteria=StoppingCriteriaList([timer, *stop_criteria]),
+            eos_token_id=eos_token_id,
+            pad_token_id=model.tokenizer.pad_token_id,
+            **generation_kwargs,
+        )
+        breakdown.record_generation(timer)
+        breakdown.output_tokens = timer.generated_tokens
     except Exception as e:
-        print(f"応答の抽出中にエラーが発生しました: {e}")
+        print(f"ストリーミング生成中にエラーが発生しました: {e}")
         traceback.print_exc()
-        assistant_response = "応答の抽出に失敗しました。"  # エラーメッセージを設定
-
-    if not assistant_response:
-        print("警告: アシスタントの応答を抽出できませんでした。完全な出力:", outputs)
-        # デフォルトまたはエラー応答を返す
-        assistant_response = "応答を生成できませんでした。"
+        streamer.error = e
+    finally:
+        streamer.close()  # 待機中の受け取り側を終了させる
+        ticket.release()
+
+def format_sse(data, event=None):
+    """サーバー送信イベント(SSE)形式のメッセージを作成する"""
+    message = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    if event:
+        message = f"event: {event}\n" + message
+    return message
+
+def get_batcher():
+    """バッチスケジューラを取得する（未作成の場合は作成）"""
+    global batcher
+    if batcher is None:
+        batcher = BatchScheduler(
+            run_generation_batch,
+            # 投機的デコーディングはバッチサイズ1でのみ動作するため、ドラフトモデル使用時はまとめない
+            max_batch_size=1 if config.DRAFT_MODEL_NAME else config.BATCH_MAX_SIZE,
+            max_wait_ms=config.BATCH_MAX_WAIT_MS,
+            executor=inference_pool.executor,
+            max_concurrent_batches=inference_pool.max_workers,
+        )
+    return batcher
+
+def get_generation_params(request, endpoint):
+    """リクエストから生成パラメータを取り出す
+
+    max_new_tokens はエンドポイントの過去の応答の長さから決めた上限までに抑える。
+    停止文字列はバッチのまとめ方の判定とキャッシュキーに使うため、タプルにする。
+    """
+    max_new_tokens = request.max_new_tokens
+    if config.ADAPTIVE_MAX_NEW_TOKENS:
+        max_new_tokens = token_budget.budget(endpoint, max_new_tokens)
+    return {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": request.do_sample,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+        "seed": request.seed,
+        "stop_sequences": tuple(request.stop if request.stop is not None else config.STOP_SEQUENCES),
+    }
+
+def admit_request():
+    """推論キューにリクエストを受け付ける。満杯の場合は待たせずに429を返す"""
+    try:
+        return inference_pool.admit()
+    except QueueFullError as e:
+        print(f"リクエストを拒否しました: {e}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+
+async def ensure_model_loaded(endpoint_name):
+    """モデルが未読み込みの場合、イベントループを止めずに読み込みを試みる"""
+    if model is not None:
+        return
+    if model_loading:
+        raise HTTPException(status_code=503, detail="モデルを読み込み中です。しばらくしてからもう一度お試しください。",
+                            headers={"Retry-After": "10"})
+    print(f"{endpoint_name}エンドポイント: モデルが読み込まれていません。読み込みを試みます...")
+    await asyncio.get_running_loop().run_in_executor(None, load_model_task)  # 再度読み込みを試みる
+    if model is None:
+        print(f"{endpoint_name}エンドポイント: モデルの読み込みに失敗しました。")
+        raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
 
-    return assistant_response
+# 生成結果が空だった場合に返す文言（キャッシュには保存しない）
+FALLBACK_RESPONSE = "応答を生成できませんでした。"
 
 # --- FastAPIエンドポイント定義 ---
 @app.on_event("startup")
 async def startup_event():
-    """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
+    """起動時にモデルの初期化を開始"""
+    # 読み込み中も/healthに応答できるよう、モデルはイベントループ外のスレッドで読み込む
+    asyncio.get_running_loop().run_in_executor(None, startup_load_model)
+    get_batcher().start()
+
+def startup_load_model():
+    """起動時のモデル読み込み（バックグラウンドスレッドで実行）"""
+    load_model_task()
     if model is None:
         print("警告: 起動時にモデルの初期化に失敗しました")
     else:
         print("起動時にモデルの初期化が完了しました。")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時にバッチスケジューラとワーカープールを停止"""
+    if batcher is not None:
+        await batcher.stop()
+    inference_pool.shutdown()
+
 @app.get("/")
 async def root():
     """基本的なAPIチェック用のルートエンドポイント"""
@@ -150,41 +514,67 @@ async def health_check():
     """ヘルスチェックエンドポイント"""
     global model
     if model is None:
-        return {"status": "error", "message": "No model loaded"}
-
-    return {"status": "ok", "model": config.MODEL_NAME}
+        if model_loading:
+            return {"status": "loading", "message": "Model is loading",
+                    "queue": inference_pool.stats(), "cache": response_cache.stats()}
+        return {"status": "error", "message": "No model loaded",
+                "queue": inference_pool.stats(), "cache": response_cache.stats()}
+
+    status = {"status": "ok", "model": config.MODEL_NAME, "profile": inference_profile,
+              "queue": inference_pool.stats(), "cache": response_cache.stats()}
+    if speculative_decoder is not None:
+        status["speculative"] = speculative_decoder.stats.stats()
+    if config.ADAPTIVE_MAX_NEW_TOKENS:
+        status["token_budget"] = token_budget.stats()
+    return status
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheusのテキスト形式でメトリクスを返す"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # 簡略化されたエンドポイント
 @app.post("/generate", response_model=GenerationResponse)
 async def generate_simple(request: SimpleGenerationRequest):
     """単純なプロンプト入力に基づいてテキストを生成"""
-    global model
-
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+    start_time = time.time()
+    generation_params = get_generation_params(request, "generate")
+
+    # 決定的な生成はキャッシュを確認し、ヒットすればモデルを呼ばずに返す。
+    # max_new_tokens の上限は履歴とともに変わるため、キーには呼び出し元が指定した値を使う
+    cache_key = None
+    if is_cacheable(generation_params):
+        cache_key = make_cache_key(config.MODEL_NAME, request.prompt,
+                                   {**generation_params, "max_new_tokens": request.max_new_tokens})
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            print("応答キャッシュにヒットしました。")
+            return GenerationResponse(
+                generated_text=cached_response,
+                response_time=time.time() - start_time,
+                cached=True
+            )
+
+    await ensure_model_loaded("generate")
+    ticket = admit_request()
 
     try:
-        start_time = time.time()
         print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
 
-        # プロンプトテキストで直接応答を生成
-        print("モデル推論を開始...")
-        outputs = model(
-            request.prompt,
-            max_new_tokens=request.max_new_tokens,
-            do_sample=request.do_sample,
-            temperature=request.temperature,
-            top_p=request.top_p,
-        )
-        print("モデル推論が完了しました。")
-
-        # アシスタント応答を抽出
-        assistant_response = extract_assistant_response(outputs, request.prompt)
-        print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
+        # 同時に届いた他のリクエストとまとめてバッチ推論する
+        with ticket:
+            (assistant_response, breakdown), batch_size = await get_batcher().submit(
+                request.prompt, generation_params, ticket=ticket
+            )
+
+        observe_latency("generate", breakdown)
+        token_budget.observe("generate", breakdown.output_tokens)
+        print(f"アシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
+        if not assistant_response:
+            print("警告: 生成結果が空でした。")
+            assistant_response = FALLBACK_RESPONSE
+        elif cache_key is not None:
+            response_cache.set(cache_key, assistant_response)
 
         end_time = time.time()
         response_time = end_time - start_time
@@ -192,7 +582,12 @@ async def generate_simple(request: SimpleGenerationRequest):
 
         return GenerationResponse(
             generated_text=assistant_response,
-            response_time=response_time
+            response_time=response_time,
+            batch_size=batch_size,
+            queue_wait_time=ticket.wait_time,
+            latency=breakdown.timing_dict(),
+            input_tokens=breakdown.input_tokens,
+            output_tokens=breakdown.output_tokens,
         )
 
     except Exception as e:
@@ -200,17 +595,107 @@ async def generate_simple(request: SimpleGenerationRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
 
+# ストリーミングエンドポイント
+@app.post("/generate/stream")
+async def generate_stream(request: SimpleGenerationRequest):
+    """生成されたトークンをサーバー送信イベント(SSE)として逐次返す"""
+    await ensure_model_loaded("generate/stream")
+    ticket = admit_request()
+
+    print(f"ストリーミングリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")
+    streamer = AsyncQueueStreamer(model.tokenizer, asyncio.get_running_loop())
+    cancel_event = threading.Event()
+    generation_kwargs = get_generation_params(request, "generate_stream")
+    # 特殊トークンの停止文字列はストリーマーに出力されないため、文字列の停止文字列だけを送信前に判定する
+    _, stop_strings = split_stop_sequences(model.tokenizer, generation_kwargs["stop_sequences"])
+    breakdown = LatencyBreakdown()
+    start_time = time.time()
+    # 生成自体は推論ワーカープールで実行する（ワーカーが空くまではキューで待つ）
+    try:
+        inference_pool.executor.submit(
+            run_streaming_generation, request.prompt, generation_kwargs, streamer, cancel_event, ticket, breakdown
+        )
+    except RuntimeError as e:
+        # 停止処理中などでワーカープールに投入できない場合は、受付を取り消して待ち行列の数を戻す
+        ticket.release()
+        raise HTTPException(status_code=503, detail=f"推論ワーカーを利用できません: {e}")
+
+    async def event_generator():
+        received = ""  # 受け取った全テキスト
+        sent_length = 0  # クライアントに送信済みの文字数
+        stopped = False
+        first_token_time = None
+        try:
+            while True:
+                # ワーカーがキューに積むのを待つ（待機中のリクエストがスレッドを占有しない）
+                text = await streamer.queue.get()
+                if text is None:
+                    break
+                if not text or stopped:
+                    continue  # 停止文字列の後に届いた分は送らない（生成はすぐに止まる）
+                received += text
+                # 停止文字列の先頭の一部かもしれない末尾は、続きが届くまで送らずに保留する
+                safe_length, stopped = safe_stream_length(received, stop_strings)
+                if safe_length > sent_length:
+                    if first_token_time is None:
+                        first_token_time = time.time() - start_time
+                    yield format_sse({"token": received[sent_length:safe_length]})
+                    sent_length = safe_length
+
+            if streamer.error is not None:
+                yield format_sse({"detail": f"応答の生成中にエラーが発生しました: {streamer.error}"}, event="error")
+                return
+
+            with breakdown.stage("postprocess"):
+                generated_text = truncate_at_stop(received, stop_strings)
+            if len(generated_text) > sent_length:
+                # 停止文字列にならなかった保留分を送る
+                yield format_sse({"token": generated_text[sent_length:]})
+            generated_text = generated_text.strip()
+            response_time = time.time() - start_time
+            print(f"ストリーミング応答生成時間: {response_time:.2f}秒")
+            observe_latency("generate_stream", breakdown)
+            token_budget.observe("generate_stream", breakdown.output_tokens)
+            yield format_sse({
+                "generated_text": generated_text,
+                "response_time": response_time,
+                "time_to_first_token": first_token_time,
+                "queue_wait_time": ticket.wait_time,
+                "latency": breakdown.timing_dict(),
+                "input_tokens": breakdown.input_tokens,
+                "output_tokens": breakdown.output_tokens,
+            }, event="done")
+        finally:
+            # クライアントが途中で切断した場合も生成を打ち切る
+            cancel_event.set()
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 def load_model_task():
     """モデルを読み込むバックグラウンドタスク"""
-    global model
-    print("load_model_task: モデルの読み込みを開始...")
-    # load_model関数を呼び出し、結果をグローバル変数に設定
-    loaded_pipe = load_model()
-    if loaded_pipe:
-        model = loaded_pipe  # グローバル変数を更新
-        print("load_model_task: モデルの読み込みが完了しました。")
-    else:
-        print("load_model_task: モデルの読み込みに失敗しました。")
+    global model, model_loading
+    # 複数のスレッドから同時に呼ばれても読み込みは1回だけ行う
+    with model_load_lock:
+        if model is not None:
+            return
+        model_loading = True
+        try:
+            print("load_model_task: モデルの読み込みを開始...")
+            load_start = time.time()
+            # load_model関数を呼び出し、結果をグローバル変数に設定
+            loaded_pipe = load_model()
+            if loaded_pipe:
+                model = loaded_pipe  # グローバル変数を更新
+                model_load_seconds.set(time.time() - load_start)
+                print("load_model_task: モデルの読み込みが完了しました。")
+            else:
+                print("load_model_task: モデルの読み込みに失敗しました。")
+        finally:
+            model_loading = False
 
 print("FastAPIエンドポイントを定義しました。")
 
@@ -0,0 +1,152 @@
+# batching.py
+# 同時に届いた生成リクエストを一定の時間窓でまとめ、1回のバッチ推論として実行するスケジューラ
+import asyncio
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+
+@dataclass
+class PendingRequest:
+    """バッチ待ちのリクエスト1件分の情報"""
+    prompt: str
+    generation_kwargs: Dict[str, Any]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.time)
+    ticket: Optional[Any] = None  # worker_pool.Ticket（推論開始時にstart()を呼ぶ）
+
+
+class BatchScheduler:
+    """同時リクエストを時間窓とバッチサイズ上限でまとめて推論するスケジューラ
+
+    Args:
+        run_batch: (prompts, generation_kwargs) を受け取り、プロンプトごとの出力リストを返す同期関数
+        max_batch_size: 1バッチにまとめる最大リクエスト数
+        max_wait_ms: 最初のリクエストが届いてから後続を待つ最大時間（ミリ秒）
+        executor: run_batchを実行するExecutor（Noneの場合はイベントループのデフォルト）
+        max_concurrent_batches: 同時に実行するバッチ数の上限（通常はワーカー数と合わせる）
+    """
+
+    def __init__(self, run_batch: Callable[[List[str], Dict[str, Any]], List[Any]],
+                 max_batch_size: int = 8, max_wait_ms: float = 20.0, executor=None,
+                 max_concurrent_batches: int = 1):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.executor = executor
+        self.max_concurrent_batches = max(1, int(max_concurrent_batches))
+        self._queue: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._worker_task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._worker_task is not None and not self._worker_task.done()
+
+    def start(self):
+        """バッチ処理ループを開始する（イベントループ上で呼び出すこと）"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._worker_task = asyncio.get_running_loop().create_task(self._worker())
+        print(f"バッチスケジューラを開始: max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait * 1000:.0f}")
+
+    async def stop(self):
+        """バッチ処理ループを停止し、待機中のリクエストをキャンセルする"""
+        if self._worker_task is not None:
+            self._worker_task.cancel()
+            try:
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+            self._worker_task = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                pending = self._queue.get_nowait()
+                if not pending.future.done():
+                    pending.future.cancel()
+
+    async def submit(self, prompt: str, generation_kwargs: Dict[str, Any], ticket=None):
+        """リクエストをキューに積み、自分の分の推論結果を待つ
+
+        Returns:
+            (outputs, batch_size): パイプラインの出力とまとめて実行されたバッチのサイズ
+        """
+        if not self.running:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(PendingRequest(prompt, dict(generation_kwargs), future, ticket=ticket))
+        return await future
+
+    async def _collect_batch(self) -> List[PendingRequest]:
+        """最初の1件が届いてから、時間窓が閉じるかバッチが埋まるまでリクエストを集める"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # 空いているワーカーがある時だけ次のバッチを集める（空くまでの間もリクエストは溜まり続ける）
+            await self._slots.acquire()
+            try:
+                batch = await self._collect_batch()
+            except BaseException:
+                self._slots.release()
+                raise
+            loop.create_task(self._dispatch(batch))
+
+    async def _dispatch(self, batch: List[PendingRequest]):
+        try:
+            # 生成パラメータが異なるリクエストは同じ呼び出しにできないため、パラメータごとに分ける
+            groups: Dict[tuple, List[PendingRequest]] = {}
+            for pending in batch:
+                key = tuple(sorted(pending.generation_kwargs.items()))
+                groups.setdefault(key, []).append(pending)
+            for group in groups.values():
+                await self._run_group(group)
+        finally:
+            self._slots.release()
+
+    async def _run_group(self, group: List[PendingRequest]):
+        # 待っている間にクライアントが切断したリクエストは除外する
+        group = [pending for pending in group if not pending.future.done()]
+        if not group:
+            return
+        loop = asyncio.get_running_loop()
+        prompts = [pending.prompt for pending in group]
+        generation_kwargs = group[0].generation_kwargs
+
+        def run():
+            # ワーカーが実際に処理を始めた時点を待ち時間の終わりとして記録する
+            for pending in group:
+                if pending.ticket is not None:
+                    pending.ticket.start()
+            return self.run_batch(prompts, generation_kwargs)
+
+        try:
+            outputs = await loop.run_in_executor(self.executor, run)
+            if len(outputs) != len(group):
+                raise RuntimeError(f"バッチ出力数が一致しません: 入力={len(group)}, 出力={len(outputs)}")
+        except Exception as e:
+            print(f"バッチ推論中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            for pending in group:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+
+        for pending, output in zip(group, outputs):
+            if not pending.future.done():
+                pending.future.set_result((output, len(group)))
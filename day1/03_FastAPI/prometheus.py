@@ -0,0 +1,189 @@
+# prometheus.py
+# 外部ライブラリやサービスを使わずに、Prometheusのテキスト形式でメトリクスを公開するための最小限の実装
+import math
+import threading
+import time
+
+# 秒単位の処理時間向けのデフォルトのバケット
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} のラベルは {self.labelnames} を指定してください: {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def set_function(self, function, **labels):
+        """出力時に function() を呼んで値を取得する（他のオブジェクトが管理している値の公開用）"""
+        self._functions[self._key(labels)] = function
+
+    def _current_values(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, function in self._functions.items():
+            value = function()
+            if value is not None:
+                values[key] = value
+        return values
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}"
+                for key, value in self._current_values().items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """増加のみする累積値"""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counterは減らせません")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """増減する現在値"""
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """値の分布（バケットごとの累積件数・合計・件数）"""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for upper, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(upper)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """メトリクスを登録し、まとめてテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+class RequestMetricsMiddleware:
+    """全HTTPリクエストの処理中の件数と処理時間を記録するASGIミドルウェア
+
+    アプリの呼び出し全体を try/finally で囲むため、レスポンス本文を送り終えた場合だけでなく、
+    本文の送信前にクライアントが切断した場合や例外で終わった場合も、必ず処理中の件数を戻して処理時間を記録する。
+    ルートのパス（/generate など）をラベルにし、未定義のパスは "unmatched" にまとめる。
+
+    Args:
+        in_flight: 処理中の件数の Gauge
+        duration: endpoint・method・status のラベルを持つ処理時間の Histogram
+    """
+
+    def __init__(self, app, in_flight, duration):
+        self.app = app
+        self.in_flight = in_flight
+        self.duration = duration
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = "500"  # レスポンスを開始する前に例外・切断で終わった場合
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        self.in_flight.inc()
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.in_flight.dec()
+            # ルーティング後は scope にマッチしたルートが入る
+            endpoint = getattr(scope.get("route"), "path", "unmatched")
+            self.duration.observe(time.perf_counter() - start_time, endpoint=endpoint,
+                                  method=scope.get("method", ""), status=status)
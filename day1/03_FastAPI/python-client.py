@@ -17,6 +17,7 @@ class LLMClient:
         """
         self.api_url = api_url.rstrip('/')
         self.session = requests.Session()
+        self.last_stream_result = None
     
     def health_check(self):
         """
@@ -28,7 +29,7 @@ class LLMClient:
         response = self.session.get(f"{self.api_url}/health")
         return response.json()
     
-    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, seed=None):
         """
         テキスト生成
         
@@ -38,6 +39,7 @@ class LLMClient:
             temperature (float, optional): 温度パラメータ
             top_p (float, optional): top-p サンプリングのパラメータ
             do_sample (bool, optional): サンプリングを行うかどうか
+            seed (int, optional): 乱数シード（指定すると結果が固定され、サーバー側でキャッシュされます）
         
         Returns:
             dict: 生成結果
@@ -47,7 +49,8 @@ class LLMClient:
             "max_new_tokens": max_new_tokens,
             "temperature": temperature,
             "top_p": top_p,
-            "do_sample": do_sample
+            "do_sample": do_sample,
+            "seed": seed
         }
         
         start_time = time.time()
@@ -64,6 +67,59 @@ class LLMClient:
         else:
             raise Exception(f"API error: {response.status_code} - {response.text}")
 
+    def generate_stream(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, seed=None):
+        """
+        ストリーミングテキスト生成
+
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            seed (int, optional): 乱数シード（指定すると結果が固定されます。サーバー側でキャッシュされるのは非ストリーミングの /generate だけで、ストリーミングの応答はキャッシュされません）
+
+        Yields:
+            str: 生成されたテキスト片（完了時の結果は last_stream_result に保存されます）
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample,
+            "seed": seed
+        }
+
+        self.last_stream_result = None
+        start_time = time.time()
+        with self.session.post(
+            f"{self.api_url}/generate/stream",
+            json=payload,
+            stream=True
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"API error: {response.status_code} - {response.text}")
+            response.encoding = "utf-8"
+
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    # 空行はイベントの区切り
+                    event = None
+                    continue
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):].strip())
+                    if event == "done":
+                        data["total_request_time"] = time.time() - start_time
+                        self.last_stream_result = data
+                        return
+                    if event == "error":
+                        raise Exception(f"API error: {data.get('detail')}")
+                    yield data["token"]
+
 # 使用例
 if __name__ == "__main__":
     # ngrok URLを設定（実際のURLに置き換えてください）
@@ -84,4 +140,17 @@ if __name__ == "__main__":
     ])
     print(f"Response: {result['generated_text']}")
     print(f"Model processing time: {result['response_time']:.2f}s")
-    print(f"Total request time: {result['total_request_time']:.2f}s")    
\ No newline at end of file
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    if result.get("latency"):
+        print(f"Latency breakdown: {result['latency']} (tokens: {result['input_tokens']} -> {result['output_tokens']})")
+    print()
+
+    # ストリーミング
+    print("Streaming question:")
+    for token in client.generate_stream("AIについて100文字で教えてください"):
+        print(token, end="", flush=True)
+    print()
+    stream_result = client.last_stream_result
+    if stream_result and stream_result.get("time_to_first_token") is not None:
+        print(f"Time to first token: {stream_result['time_to_first_token']:.2f}s")
+        print(f"Total request time: {stream_result['total_request_time']:.2f}s")    
\ No newline at end of file
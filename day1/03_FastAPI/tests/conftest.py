@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# テストからアプリのモジュール（batching.py など）を import できるようにする
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """app.py のモジュール（モデルは読み込まない）。応答キャッシュと max_new_tokens の上限はテストごとに作り直す
+
+    TestClient を with で使うと起動時のモデル読み込みが走るため、テストでは with を使わずに呼ぶ。
+    """
+    import app
+    from response_cache import ResponseCache
+    from stopping import AdaptiveTokenBudget
+
+    monkeypatch.setattr(app, "model", None)
+    monkeypatch.setattr(app, "response_cache", ResponseCache(max_entries=16))
+    monkeypatch.setattr(app, "token_budget", AdaptiveTokenBudget(min_tokens=1, min_samples=1))
+    return app
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+from fastapi.testclient import TestClient
+from transformers import BatchEncoding
+
+import common_path  # noqa: F401  day1/common の共有モジュールを import できるようにする
+from latency import LatencyBreakdown
+from worker_pool import InferencePool
+
+
+class StubBatcher:
+    """バッチスケジューラの代わり: モデルを呼ばずに固定の回答を返し、受け取った max_new_tokens を記録する"""
+
+    def __init__(self):
+        self.max_new_tokens = []
+
+    async def submit(self, prompt, generation_params, ticket=None):
+        ticket.start()
+        self.max_new_tokens.append(generation_params["max_new_tokens"])
+        breakdown = LatencyBreakdown()
+        breakdown.input_tokens, breakdown.output_tokens = 5, 10
+        return (f"{prompt}への回答", breakdown), 1
+
+
+def test_cache_key_uses_requested_max_new_tokens(api, monkeypatch):
+    batcher = StubBatcher()
+    monkeypatch.setattr(api, "get_batcher", lambda: batcher)
+    monkeypatch.setattr(api, "model", object())
+    client = TestClient(api.app)
+    body = {"prompt": "質問", "max_new_tokens": 256, "do_sample": False}
+
+    first = client.post("/generate", json=body).json()
+    # 1件目の応答の長さから上限が変わっても、同じリクエストはキャッシュにヒットする
+    assert api.token_budget.budget("generate", 256) < 256
+    second = client.post("/generate", json=body).json()
+    third = client.post("/generate", json={**body, "max_new_tokens": 128}).json()
+
+    assert (first["cached"], second["cached"], third["cached"]) == (False, True, False)
+    assert second["generated_text"] == first["generated_text"] == "質問への回答"
+    # 生成には上限で抑えた値を使う
+    assert batcher.max_new_tokens == [256, api.token_budget.budget("generate", 128)]
+
+
+class StubTokenizer:
+    """1文字を1トークンにするトークナイザー（特殊トークンは pad と EOS だけ）"""
+
+    pad_token_id, eos_token_id = 0, 1
+    all_special_tokens = ["<pad>", "</s>"]
+
+    def __init__(self):
+        self._vocab = {token: i for i, token in enumerate(self.all_special_tokens)}
+
+    def get_added_vocab(self):
+        return {}
+
+    def encode(self, text):
+        return [self._vocab.setdefault(char, len(self._vocab)) for char in text]
+
+    def __call__(self, text, return_tensors=None, **kwargs):
+        ids = self.encode(text)
+        if return_tensors != "pt":
+            return BatchEncoding({"input_ids": ids, "attention_mask": [1] * len(ids)})
+        input_ids = torch.tensor([ids])
+        return BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        tokens = {token_id: token for token, token_id in self._vocab.items()}
+        skipped = {self.pad_token_id, self.eos_token_id} if skip_special_tokens else set()
+        return "".join(tokens[int(token_id)] for token_id in ids if int(token_id) not in skipped)
+
+    def batch_decode(self, rows, skip_special_tokens=False):
+        return [self.decode(row, skip_special_tokens) for row in rows]
+
+
+class StubModel:
+    """generate の代わり: answer を1文字ずつストリーマーに渡し、停止条件が成り立った時点で止める"""
+
+    device = "cpu"
+    generation_config = SimpleNamespace(eos_token_id=StubTokenizer.eos_token_id)
+
+    def __init__(self, tokenizer, answer, step_delay=0.0):
+        self.tokenizer = tokenizer
+        self.answer = answer
+        self.step_delay = step_delay
+        self.generated_tokens = 0
+
+    def generate(self, input_ids, attention_mask=None, streamer=None, stopping_criteria=None,
+                 max_new_tokens=512, **kwargs):
+        streamer.put(input_ids)
+        for char in self.answer[:max_new_tokens]:
+            time.sleep(self.step_delay)
+            input_ids = torch.cat([input_ids, torch.tensor([self.tokenizer.encode(char)])], dim=-1)
+            self.generated_tokens += 1
+            streamer.put(input_ids[:, -1])
+            if stopping_criteria(input_ids, None).all():
+                break
+        streamer.end()
+        return input_ids
+
+
+@pytest.fixture
+def stub_model(api, monkeypatch):
+    """answer を返すスタブのモデルを設定する関数。推論ワーカープールもテストごとに作り直す"""
+    monkeypatch.setattr(api, "inference_pool", InferencePool(max_workers=1))
+
+    def make(answer, step_delay=0.0):
+        tokenizer = StubTokenizer()
+        model = StubModel(tokenizer, answer, step_delay)
+        monkeypatch.setattr(api, "model", SimpleNamespace(tokenizer=tokenizer, model=model))
+        return model
+
+    return make
+
+
+def parse_sse(body):
+    """SSE の本文を (イベント名, データ) のリストにする"""
+    events = []
+    for message in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in message.splitlines())
+        events.append((fields.get("event", "message"), json.loads(fields["data"])))
+    return events
+
+
+def test_stream_sends_tokens_and_done_event(api, stub_model):
+    stub_model("回答です。 質問: 次の質問")
+    body = {"prompt": "質問: BM25とは？\n回答:", "max_new_tokens": 64, "stop": ["質問:"]}
+    response = TestClient(api.app).post("/generate/stream", json=body)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+    # トークンのイベントを連結すると停止文字列の手前までのテキストになり、最後に done イベントが届く
+    assert all(event == "message" for event, _ in events[:-1])
+    assert "".join(data["token"] for _, data in events[:-1]) == "回答です。 "
+    event, done = events[-1]
+    assert event == "done"
+    assert done["generated_text"] == "回答です。"
+    assert done["output_tokens"] == len("回答です。 質問:")
+    assert api.inference_pool.stats()["running"] == 0
+
+
+async def stream_until_first_token(app, body):
+    """ASGI アプリを直接呼び、最初のトークンを受け取った時点でクライアントを切断する
+
+    TestClient は応答をすべて受け取ってから切断を通知するため、途中切断は receive で再現する。
+    """
+    first_token = asyncio.Event()
+    chunks = []
+    request = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+
+    async def receive():
+        if request:
+            return request.pop()
+        await first_token.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.append(message["body"].decode())
+            first_token.set()
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": "/generate/stream", "raw_path": b"/generate/stream", "root_path": "", "query_string": b"",
+        "headers": [(b"content-type", b"application/json")], "client": ("test", 0), "server": ("test", 80),
+    }
+    await asyncio.wait_for(app(scope, receive, send), timeout=10)
+    return chunks
+
+
+def test_stream_disconnect_cancels_generation_and_releases_ticket(api, stub_model):
+    model = stub_model("字" * 1000, step_delay=0.01)
+    chunks = asyncio.run(stream_until_first_token(api.app, {"prompt": "質問", "max_new_tokens": 1000}))
+
+    assert parse_sse(chunks[0])[0] == ("message", {"token": "字"})
+    # 切断で生成が打ち切られ、ワーカープールのチケットが返却される
+    deadline = time.time() + 5
+    while api.inference_pool.stats()["running"] and time.time() < deadline:
+        time.sleep(0.01)
+    stats = api.inference_pool.stats()
+    assert (stats["queued"], stats["running"], stats["admitted_total"]) == (0, 0, 1)
+    assert model.generated_tokens < 1000
+
+
+def test_health_reports_inference_profile(api, monkeypatch):
+    loaded = {}
+
+    def fake_pipeline(task, model, model_kwargs, device):
+        loaded.update(model_kwargs, device=device)
+        tokenizer = SimpleNamespace(pad_token=None, eos_token="</s>", padding_side="right")
+        return SimpleNamespace(model=torch.nn.Sequential(torch.nn.Linear(8, 8)), tokenizer=tokenizer)
+
+    monkeypatch.setattr(api, "pipeline", fake_pipeline)
+    monkeypatch.setattr(api.torch.cuda, "is_available", lambda: False)
+    monkeypatch.setattr(api.config, "QUANTIZE_INT8", True)
+    monkeypatch.setattr(api.config, "DRAFT_MODEL_NAME", None)
+    monkeypatch.setattr(api, "inference_profile", {"threads": {"intra_op_threads": 2, "inter_op_threads": 1}})
+
+    assert api.load_model() is api.model
+    profile = TestClient(api.app).get("/health").json()["profile"]
+
+    # 量子化する場合は float32 で読み込んでから Linear 層を int8 にする
+    assert loaded == {"torch_dtype": torch.float32, "device": "cpu"}
+    assert isinstance(api.model.model[0], torch.ao.nn.quantized.dynamic.Linear)
+    assert profile == {
+        "threads": {"intra_op_threads": 2, "inter_op_threads": 1},
+        "device": "cpu",
+        "dtype": {"dtype": "float32", "reason": "configured"},
+        "quantization": "int8-dynamic",
+    }
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+import pytest
+
+from batching import BatchScheduler
+
+
+def run_requests(scheduler, requests):
+    async def main():
+        try:
+            return await asyncio.gather(*(scheduler.submit(prompt, kwargs) for prompt, kwargs in requests))
+        finally:
+            await scheduler.stop()
+    return asyncio.run(main())
+
+
+def test_concurrent_requests_are_batched_and_split_by_generation_kwargs():
+    calls = []
+
+    def run_batch(prompts, generation_kwargs):
+        calls.append((list(prompts), dict(generation_kwargs)))
+        return [f"{prompt}:{generation_kwargs['max_new_tokens']}" for prompt in prompts]
+
+    scheduler = BatchScheduler(run_batch, max_batch_size=8, max_wait_ms=50)
+    requests = [("a", {"max_new_tokens": 8}), ("b", {"max_new_tokens": 16}),
+                ("c", {"max_new_tokens": 8}), ("d", {"max_new_tokens": 16})]
+    results = run_requests(scheduler, requests)
+
+    # 各リクエストは自分のプロンプトの出力を受け取り、同じパラメータの組のサイズが返る
+    assert results == [("a:8", 2), ("b:16", 2), ("c:8", 2), ("d:16", 2)]
+    assert sorted(calls, key=lambda call: call[1]["max_new_tokens"]) == [
+        (["a", "c"], {"max_new_tokens": 8}),
+        (["b", "d"], {"max_new_tokens": 16}),
+    ]
+
+
+def test_batches_respect_max_batch_size():
+    sizes = []
+
+    def run_batch(prompts, generation_kwargs):
+        sizes.append(len(prompts))
+        return list(prompts)
+
+    scheduler = BatchScheduler(run_batch, max_batch_size=3, max_wait_ms=50)
+    results = run_requests(scheduler, [(str(i), {}) for i in range(7)])
+    assert [output for output, _ in results] == [str(i) for i in range(7)]
+    assert sizes == [3, 3, 1]
+
+
+def test_errors_are_propagated_to_every_request_in_the_group():
+    def run_batch(prompts, generation_kwargs):
+        return prompts[:-1]  # 出力数が合わない
+
+    scheduler = BatchScheduler(run_batch, max_batch_size=4, max_wait_ms=50)
+
+    async def main():
+        try:
+            return await asyncio.gather(scheduler.submit("a", {}), scheduler.submit("b", {}),
+                                        return_exceptions=True)
+        finally:
+            await scheduler.stop()
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_tickets_are_started_on_the_worker():
+    started = []
+
+    class FakeTicket:
+        def start(self):
+            started.append(threading.current_thread() is not threading.main_thread())
+
+    scheduler = BatchScheduler(lambda prompts, kwargs: list(prompts), max_wait_ms=10)
+
+    async def main():
+        try:
+            return await scheduler.submit("a", {}, ticket=FakeTicket())
+        finally:
+            await scheduler.stop()
+
+    assert asyncio.run(main()) == ("a", 1)
+    assert started == [True]
+
+
+def test_stop_cancels_waiting_requests():
+    release = threading.Event()
+
+    def run_batch(prompts, generation_kwargs):
+        release.wait(5)
+        return list(prompts)
+
+    scheduler = BatchScheduler(run_batch, max_batch_size=1, max_wait_ms=0)
+
+    async def main():
+        first = asyncio.ensure_future(scheduler.submit("a", {}))
+        second = asyncio.ensure_future(scheduler.submit("b", {}))
+        await asyncio.sleep(0.05)  # 1件目の実行中、2件目はキューで待っている
+        await scheduler.stop()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        return await first
+
+    assert asyncio.run(main()) == ("a", 1)
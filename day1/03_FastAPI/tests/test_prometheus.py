@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from prometheus import Registry, RequestMetricsMiddleware
+
+
+def make_metrics():
+    registry = Registry()
+    duration = registry.histogram("http_request_duration_seconds", "処理時間", ["endpoint", "method", "status"])
+    in_flight = registry.gauge("http_requests_in_flight", "処理中の件数")
+    return registry, in_flight, duration
+
+
+def gauge_value(gauge):
+    return dict(gauge._current_values()).get((), 0)
+
+
+def test_counter_and_histogram_render():
+    registry = Registry()
+    counter = registry.counter("requests_total", "件数", ["endpoint"])
+    histogram = registry.histogram("latency_seconds", "時間", buckets=(0.1, 1))
+    counter.inc(endpoint="/generate")
+    counter.inc(2, endpoint="/generate")
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    text = registry.render()
+    assert 'requests_total{endpoint="/generate"} 3.0' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in text
+    assert "latency_seconds_count 2" in text
+
+
+def test_middleware_records_routes_and_streaming_responses():
+    registry, in_flight, duration = make_metrics()
+    app = FastAPI()
+    app.add_middleware(RequestMetricsMiddleware, in_flight=in_flight, duration=duration)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    @app.get("/stream")
+    async def stream():
+        async def body():
+            for i in range(3):
+                yield f"data: {i}\n\n"
+        return StreamingResponse(body(), media_type="text/event-stream")
+
+    @app.get("/boom")
+    async def boom():
+        raise RuntimeError("boom")
+
+    client = TestClient(app, raise_server_exceptions=False)
+    assert client.get("/items/1").status_code == 200
+    assert client.get("/stream").text.count("data:") == 3
+    assert client.get("/boom").status_code == 500
+    assert client.get("/missing").status_code == 404
+
+    assert gauge_value(in_flight) == 0
+    text = registry.render()
+    assert 'endpoint="/items/{item_id}",method="GET",status="200"' in text
+    assert 'endpoint="/stream",method="GET",status="200"' in text
+    assert 'endpoint="/boom",method="GET",status="500"' in text
+    assert 'endpoint="unmatched",method="GET",status="404"' in text
+
+
+def test_middleware_decrements_when_client_disconnects_before_body():
+    _, in_flight, duration = make_metrics()
+    body_started = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        body_started.append(True)
+        await send({"type": "http.response.body", "body": b"never sent"})
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("client disconnected")  # 送信前に切断された
+
+    middleware = RequestMetricsMiddleware(app, in_flight=in_flight, duration=duration)
+    with pytest.raises(OSError):
+        asyncio.run(middleware({"type": "http", "method": "GET", "path": "/stream"}, receive, send))
+    assert body_started == []
+    assert gauge_value(in_flight) == 0
+    assert duration._current_values()
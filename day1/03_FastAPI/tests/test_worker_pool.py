@@ -0,0 +1,62 @@
+import pytest
+
+from worker_pool import InferencePool, QueueFullError
+
+
+@pytest.fixture
+def pool():
+    pool = InferencePool(max_workers=1, max_queue_size=2)
+    yield pool
+    pool.shutdown()
+
+
+def test_admission_rejects_when_queue_is_full(pool):
+    first, second = pool.admit(), pool.admit()
+    with pytest.raises(QueueFullError):
+        pool.admit()
+    stats = pool.stats()
+    assert (stats["queued"], stats["admitted_total"], stats["rejected_total"]) == (2, 2, 1)
+
+    # 推論を始めたリクエストは待ち行列から外れるため、次を受け付けられる
+    first.start()
+    third = pool.admit()
+    assert (pool.stats()["queued"], pool.stats()["running"]) == (2, 1)
+    for ticket in (first, second, third):
+        ticket.release()
+    assert (pool.stats()["queued"], pool.stats()["running"]) == (0, 0)
+
+
+def test_start_and_release_are_idempotent(pool):
+    ticket = pool.admit()
+    ticket.start()
+    ticket.start()
+    ticket.release()
+    ticket.release()
+    ticket.start()  # 解放後の開始は数えない
+    stats = pool.stats()
+    assert (stats["queued"], stats["running"]) == (0, 0)
+    assert len(pool._recent_waits) == 1
+
+
+def test_ticket_released_before_start_leaves_the_queue(pool):
+    with pool.admit():
+        assert pool.queue_depth == 1
+    assert pool.queue_depth == 0
+    assert pool.stats()["wait_time_max"] == 0.0  # 開始していないため待ち時間は記録しない
+
+
+def test_tickets_started_on_workers(pool):
+    tickets = [pool.admit() for _ in range(2)]
+
+    def run(ticket):
+        ticket.start()
+        try:
+            return pool.stats()["running"]
+        finally:
+            ticket.release()
+
+    running = [pool.executor.submit(run, ticket).result() for ticket in tickets]
+    assert running == [1, 1]  # ワーカーが1つのため、同時に実行されるのは1件だけ
+    stats = pool.stats()
+    assert (stats["queued"], stats["running"], stats["admitted_total"]) == (0, 0, 2)
+    assert stats["wait_time_avg"] >= 0.0
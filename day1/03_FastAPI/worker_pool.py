@@ -0,0 +1,126 @@
+# worker_pool.py
+# 推論をイベントループから切り離して実行する専用ワーカープールと、受付数を制限するアドミッション制御
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """受付キューが満杯で、新しいリクエストを受け付けられない場合の例外"""
+
+
+class Ticket:
+    """受け付けたリクエスト1件分の待ち状態を管理するチケット"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.released = False
+
+    @property
+    def wait_time(self):
+        """受付から推論開始までの待ち時間（秒）。未開始の場合は現在までの経過時間"""
+        end = self.started_at if self.started_at is not None else time.time()
+        return end - self.enqueued_at
+
+    def start(self):
+        """推論の開始を記録する（ワーカースレッド上で呼び出される）"""
+        self.pool._mark_started(self)
+
+    def release(self):
+        """リクエストの処理完了（成功・失敗・キャンセルを問わず）を記録する"""
+        self.pool._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class InferencePool:
+    """推論専用のスレッドプールと、待ち行列の長さを制限するアドミッション制御
+
+    モデルの重みはプロセス内で共有したいため、ワーカーはスレッドで実行する
+    （torchの演算中はGILが解放されるため、イベントループは止まらない）。
+
+    Args:
+        max_workers: 推論を同時に実行するワーカースレッド数
+        max_queue_size: 推論開始を待てるリクエストの最大数（超えた場合は QueueFullError）
+        initializer: 各ワーカースレッドの開始時に呼ばれる関数（スレッド数の設定など）
+    """
+
+    def __init__(self, max_workers=1, max_queue_size=32, initializer=None, initargs=()):
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue_size = max(0, int(max_queue_size))
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="inference",
+            initializer=initializer,
+            initargs=initargs,
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._admitted_total = 0
+        self._rejected_total = 0
+        self._recent_waits = deque(maxlen=1000)  # 直近の待ち時間（秒）
+
+    def admit(self):
+        """リクエストを受け付けてチケットを発行する。満杯の場合は即座に QueueFullError を送出する"""
+        with self._lock:
+            if self._queued >= self.max_queue_size:
+                self._rejected_total += 1
+                raise QueueFullError(
+                    f"推論キューが満杯です（待機中: {self._queued}, 上限: {self.max_queue_size}）"
+                )
+            self._queued += 1
+            self._admitted_total += 1
+        return Ticket(self)
+
+    def _mark_started(self, ticket):
+        with self._lock:
+            if ticket.started_at is not None or ticket.released:
+                return
+            ticket.started_at = time.time()
+            self._queued -= 1
+            self._running += 1
+            self._recent_waits.append(ticket.wait_time)
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.started_at is None:
+                self._queued -= 1
+            else:
+                self._running -= 1
+
+    @property
+    def queue_depth(self):
+        return self._queued
+
+    def stats(self):
+        """キューの深さと待ち時間の統計を返す"""
+        with self._lock:
+            waits = sorted(self._recent_waits)
+            queued, running = self._queued, self._running
+            admitted, rejected = self._admitted_total, self._rejected_total
+        return {
+            "workers": self.max_workers,
+            "max_queue_size": self.max_queue_size,
+            "queued": queued,
+            "running": running,
+            "admitted_total": admitted,
+            "rejected_total": rejected,
+            "wait_time_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_time_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "wait_time_max": waits[-1] if waits else 0.0,
+        }
+
+    def shutdown(self, wait=False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,95 @@
+# cpu_profile.py
+# CPU推論向けの設定: ホストに合わせたdtypeの選択、int8動的量子化、torchのスレッド数設定
+import os
+import time
+
+import torch
+
+# dtype名 -> torch.dtype
+DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+_probe_cache = {}
+
+
+def probe_cpu_dtype(candidates=("float32", "bfloat16"), size=1024, repeats=5):
+    """Linear層相当の行列積を各dtypeで実行し、このCPUで最も速いdtypeを返す
+
+    bf16命令（AVX512_BF16/AMX）のないCPUではbfloat16の方が遅くなることが多いため、実測で決める。
+
+    Returns:
+        (最速のdtype名, dtype名 -> 1回あたりの実行時間(秒) の辞書)
+    """
+    key = (tuple(candidates), size, repeats)
+    if key in _probe_cache:
+        return _probe_cache[key]
+
+    timings = {}
+    for name in candidates:
+        try:
+            dtype = DTYPES[name]
+            x = torch.randn(16, size).to(dtype)
+            w = torch.randn(size, size).to(dtype)
+            torch.matmul(x, w)  # ウォームアップ
+            start = time.perf_counter()
+            for _ in range(repeats):
+                torch.matmul(x, w)
+            timings[name] = (time.perf_counter() - start) / repeats
+        except (RuntimeError, KeyError) as e:
+            print(f"dtype '{name}' の計測に失敗しました: {e}")
+    best = min(timings, key=timings.get) if timings else "float32"
+    _probe_cache[key] = (best, timings)
+    return best, timings
+
+
+def select_dtype(device, preference="auto"):
+    """推論に使うdtypeを決める
+
+    Args:
+        device: "cuda" または "cpu"
+        preference: "auto"（ホストを計測して決める）または DTYPES のキー
+
+    Returns:
+        (torch.dtype, 選択理由などの情報を含む辞書)
+    """
+    if preference != "auto":
+        if preference not in DTYPES:
+            raise ValueError(f"未対応のdtypeです: {preference}（指定可能: auto, {', '.join(DTYPES)}）")
+        return DTYPES[preference], {"dtype": preference, "reason": "configured"}
+    if device == "cuda":
+        name = "bfloat16" if torch.cuda.is_bf16_supported() else "float16"
+        return DTYPES[name], {"dtype": name, "reason": "cuda"}
+    name, timings = probe_cpu_dtype()
+    return DTYPES[name], {"dtype": name, "reason": "probed", "probe_seconds": timings}
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None, workers=1):
+    """torchのスレッド数を設定する
+
+    intra_op_threads を指定しない場合は、CPUコアを推論ワーカー数で等分する
+    （ワーカー同士がコアを奪い合ってかえって遅くなるのを防ぐ）。
+
+    Returns:
+        実際に設定されたスレッド数の辞書
+    """
+    if not intra_op_threads:
+        intra_op_threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+    torch.set_num_threads(int(intra_op_threads))
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(int(inter_op_threads))
+        except RuntimeError as e:
+            # inter-opスレッド数は並列処理が始まる前に1度しか設定できない
+            print(f"inter-opスレッド数を変更できませんでした: {e}")
+    return {
+        "intra_op_threads": torch.get_num_threads(),
+        "inter_op_threads": torch.get_num_interop_threads(),
+    }
+
+
+def quantize_int8(model):
+    """Linear層の重みをint8に動的量子化する（CPU専用。float32のモデルに適用すること）"""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
@@ -0,0 +1,100 @@
+# latency.py
+# 1リクエストの処理時間を段階別（テンプレート適用・トークナイズ・プリフィル・デコード・後処理・DB書き込み）に計測する
+import time
+from contextlib import contextmanager
+
+from transformers import StoppingCriteria
+
+STAGES = ("templating", "tokenization", "prefill", "decode", "postprocess", "db_write")
+
+
+class TokenTimer(StoppingCriteria):
+    """生成の各ステップが終わった時刻を記録する停止条件（生成は止めない）
+
+    generate() の直前に作成すること。最初の呼び出しまでがプリフィル（プロンプトのエンコードと最初のトークン）、
+    以降がデコードになる。投機的デコーディングでは1ステップで複数トークン進むため、トークン数は系列長の増分から数える。
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.step_times = []
+        self.step_lengths = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.step_times.append(time.perf_counter())
+        self.step_lengths.append(input_ids.shape[-1])
+        return False
+
+    @property
+    def prefill_time(self):
+        return self.step_times[0] - self.start_time if self.step_times else 0.0
+
+    @property
+    def decode_time(self):
+        return self.step_times[-1] - self.step_times[0] if self.step_times else 0.0
+
+    @property
+    def decode_steps(self):
+        """デコードで生成したトークン数（最初のトークンを除く）"""
+        return self.step_lengths[-1] - self.step_lengths[0] if self.step_lengths else 0
+
+    @property
+    def generated_tokens(self):
+        return self.decode_steps + 1 if self.step_lengths else 0
+
+
+class LatencyBreakdown:
+    """1リクエスト分の段階別の処理時間（秒）と入出力トークン数"""
+
+    def __init__(self):
+        self.timings = {}
+        self.decode_steps = 0
+        self.input_tokens = None
+        self.output_tokens = None
+
+    @contextmanager
+    def stage(self, name):
+        """with ブロックの実行時間を name の段階に加算する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def record_generation(self, timer):
+        """TokenTimer の記録からプリフィルとデコードの時間を加算する"""
+        self.add("prefill", timer.prefill_time)
+        self.add("decode", timer.decode_time)
+        self.decode_steps += timer.decode_steps
+
+    @property
+    def decode_time_per_token(self):
+        if not self.decode_steps:
+            return None
+        return self.timings.get("decode", 0.0) / self.decode_steps
+
+    def copy(self):
+        other = LatencyBreakdown()
+        other.timings = dict(self.timings)
+        other.decode_steps = self.decode_steps
+        other.input_tokens = self.input_tokens
+        other.output_tokens = self.output_tokens
+        return other
+
+    def timing_dict(self):
+        """計測した段階の時間（"<段階>_time" -> 秒）と1トークンあたりのデコード時間"""
+        timings = {f"{stage}_time": self.timings[stage] for stage in STAGES if stage in self.timings}
+        if self.decode_time_per_token is not None:
+            timings["decode_time_per_token"] = self.decode_time_per_token
+        return timings
+
+    def as_dict(self):
+        """全ての段階とトークン数を含む辞書（計測していない段階はNone）"""
+        row = {f"{stage}_time": self.timings.get(stage) for stage in STAGES}
+        row["decode_time_per_token"] = self.decode_time_per_token
+        row["input_tokens"] = self.input_tokens
+        row["output_tokens"] = self.output_tokens
+        return row
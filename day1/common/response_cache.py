@@ -0,0 +1,139 @@
+# response_cache.py
+# 決定的な生成（do_sample=False またはシード固定）の結果を再利用するための応答キャッシュ
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """キャッシュキー用にプロンプトを正規化する（生成結果が変わらない範囲の揺れだけを吸収する）"""
+    text = unicodedata.normalize("NFC", str(prompt))
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text.strip()
+
+
+def is_cacheable(generation_params):
+    """生成結果が入力から一意に決まる（キャッシュしてよい）かどうか"""
+    return not generation_params.get("do_sample", False) or generation_params.get("seed") is not None
+
+
+def make_cache_key(model_name, prompt, generation_params):
+    """モデル名・正規化済みプロンプト・全生成パラメータからキャッシュキーを作成する"""
+    payload = json.dumps(
+        {"model": model_name, "prompt": normalize_prompt(prompt), "params": generation_params},
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """TTL付きLRUの応答キャッシュ（オプションでSQLiteファイルにも保存）
+
+    Args:
+        max_entries: メモリ上に保持する最大件数（超えると最も古く使われたものから削除）
+        ttl_seconds: エントリの有効期間（秒）。0以下の場合は期限なし
+        db_path: SQLiteファイルのパス。指定した場合はプロセス再起動後もキャッシュが残る
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, db_path=None):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds)
+        self.db_path = db_path
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache "
+                "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache (expires_at)"
+            )
+            self._conn.commit()
+
+    def _expires_at(self):
+        return time.time() + self.ttl_seconds if self.ttl_seconds > 0 else float("inf")
+
+    def get(self, key):
+        """キャッシュから値を取得する。存在しないか期限切れの場合はNone"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, expires_at = json.loads(row[0]), row[1]
+                    if expires_at is None or expires_at > now:
+                        # ディスクから読んだ値はメモリにも載せておく
+                        self._put_memory(key, value, expires_at if expires_at is not None else float("inf"))
+                        self.hits += 1
+                        return value
+                    self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """値をキャッシュに保存する"""
+        expires_at = self._expires_at()
+        with self._lock:
+            self._put_memory(key, value, expires_at)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False),
+                     None if expires_at == float("inf") else expires_at),
+                )
+                self._conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+                self._conn.commit()
+
+    def _put_memory(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """キャッシュを空にする（ヒット/ミスの集計もリセット）"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM response_cache")
+                self._conn.commit()
+
+    def stats(self):
+        """ヒット数・ミス数・ヒット率・保持件数を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "persistent": self._conn is not None,
+            }
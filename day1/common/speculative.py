@@ -0,0 +1,161 @@
+# speculative.py
+# 投機的デコーディング（assisted generation）: 小さいドラフトモデルが数トークンを先に提案し、
+# 大きいモデルがそれらを1回のフォワードでまとめて検証する。CPUのデコードはメモリ帯域律速のため、
+# 大きいモデルのフォワード回数が減るほど速くなる
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+import transformers
+
+
+def tokenizers_compatible(target_tokenizer, draft_tokenizer):
+    """2つのトークナイザーが同じ語彙（トークン文字列 -> id の対応）と特殊トークンを持つか"""
+    if len(target_tokenizer) != len(draft_tokenizer):
+        return False
+    if target_tokenizer.eos_token_id != draft_tokenizer.eos_token_id:
+        return False
+    return target_tokenizer.get_vocab() == draft_tokenizer.get_vocab()
+
+
+def supports_universal_assisted_decoding():
+    """語彙の異なるドラフトモデルを使える（Universal Assisted Decoding に対応した）transformersか"""
+    major, minor = (int(part) for part in transformers.__version__.split(".")[:2])
+    return (major, minor) >= (4, 46)
+
+
+@contextmanager
+def count_forward_calls(module):
+    """with ブロック内で module のフォワードが呼ばれた回数を数える"""
+    counter = {"calls": 0}
+
+    def hook(*args):
+        counter["calls"] += 1
+
+    handle = module.register_forward_hook(hook)
+    try:
+        yield counter
+    finally:
+        handle.remove()
+
+
+class SpeculativeStats:
+    """投機的デコーディングの受理率と、通常のデコードに対する速度比を集計する
+
+    ターゲットモデルの1回のフォワードでは「受理されたドラフトのトークン + 1トークン」が確定するため、
+    受理数 = 生成トークン数 - ターゲットのフォワード回数、提案数 = ドラフトのフォワード回数 として概算する
+    （同じモデルで同時に生成している他のリクエストのフォワードも数えるため、並行実行時は目安の値になる）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.assisted_requests = 0
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+        self.target_steps = 0
+        self.assisted_tokens = 0
+        self.assisted_time = 0.0
+        self.baseline_requests = 0
+        self.baseline_tokens = 0
+        self.baseline_time = 0.0
+
+    def record_assisted(self, new_tokens, target_steps, draft_steps, elapsed):
+        with self._lock:
+            self.assisted_requests += 1
+            self.proposed_tokens += draft_steps
+            self.accepted_tokens += max(new_tokens - target_steps, 0)
+            self.target_steps += target_steps
+            self.assisted_tokens += new_tokens
+            self.assisted_time += elapsed
+
+    def record_baseline(self, new_tokens, elapsed):
+        with self._lock:
+            self.baseline_requests += 1
+            self.baseline_tokens += new_tokens
+            self.baseline_time += elapsed
+
+    def stats(self):
+        """受理率、ターゲット1ステップあたりのトークン数、tokens/s と速度比を返す"""
+        with self._lock:
+            assisted_tps = self.assisted_tokens / self.assisted_time if self.assisted_time else None
+            baseline_tps = self.baseline_tokens / self.baseline_time if self.baseline_time else None
+            return {
+                "assisted_requests": self.assisted_requests,
+                "baseline_requests": self.baseline_requests,
+                "acceptance_rate": self.accepted_tokens / self.proposed_tokens if self.proposed_tokens else None,
+                "tokens_per_target_step": self.assisted_tokens / self.target_steps if self.target_steps else None,
+                "assisted_tokens_per_second": assisted_tps,
+                "baseline_tokens_per_second": baseline_tps,
+                "speedup": assisted_tps / baseline_tps if assisted_tps and baseline_tps else None,
+            }
+
+
+class SpeculativeDecoder:
+    """ターゲットモデルとドラフトモデルの組で生成する
+
+    語彙が同じ場合はドラフトのトークンをそのまま検証する。語彙が異なる場合は、対応するtransformersであれば
+    テキストを介して変換する Universal Assisted Decoding を使い、使えなければ通常の生成に戻る。
+
+    Args:
+        num_assistant_tokens: ドラフトが1回に提案するトークン数（Noneの場合はtransformersの既定値）
+        allow_universal: 語彙が異なる組で Universal Assisted Decoding を使うか
+        baseline_every: N件に1件は通常の生成で実行し、速度比の基準にする（0の場合は計測しない）。
+            基準のリクエストは投機的デコーディングの速度向上を受けられないため、速度比を確認する間だけ指定する
+    """
+
+    def __init__(self, target_model, target_tokenizer, draft_model, draft_tokenizer,
+                 num_assistant_tokens=None, allow_universal=True, baseline_every=0):
+        self.target_model = target_model
+        self.target_tokenizer = target_tokenizer
+        self.draft_model = draft_model
+        self.draft_tokenizer = draft_tokenizer
+        self.baseline_every = int(baseline_every)
+        self.stats = SpeculativeStats()
+        self._requests = 0
+        self._requests_lock = threading.Lock()
+        if num_assistant_tokens:
+            draft_model.generation_config.num_assistant_tokens = int(num_assistant_tokens)
+
+        if tokenizers_compatible(target_tokenizer, draft_tokenizer):
+            self.mode = "shared-vocab"
+        elif allow_universal and supports_universal_assisted_decoding():
+            self.mode = "universal"
+        else:
+            self.mode = "disabled"
+            logging.warning("ドラフトモデルとトークナイザーの語彙が異なるため、投機的デコーディングを使わずに生成します。")
+
+    @property
+    def enabled(self):
+        return self.mode != "disabled"
+
+    def _assisted_kwargs(self):
+        kwargs = {"assistant_model": self.draft_model}
+        if self.mode == "universal":
+            kwargs.update({"tokenizer": self.target_tokenizer, "assistant_tokenizer": self.draft_tokenizer})
+        return kwargs
+
+    def generate(self, input_ids, **generation_kwargs):
+        """ターゲットモデルの generate と同じ引数で生成する（バッチサイズ1の場合のみドラフトを使う）"""
+        with self._requests_lock:
+            self._requests += 1
+            use_baseline = self.baseline_every and self._requests % self.baseline_every == 0
+        prompt_length = input_ids.shape[-1]
+        start = time.perf_counter()
+        with torch.no_grad():
+            if not self.enabled or input_ids.shape[0] != 1 or use_baseline:
+                output_ids = self.target_model.generate(input_ids=input_ids, **generation_kwargs)
+                if input_ids.shape[0] == 1:
+                    self.stats.record_baseline(output_ids.shape[-1] - prompt_length, time.perf_counter() - start)
+                return output_ids
+            with count_forward_calls(self.target_model) as target_calls, \
+                    count_forward_calls(self.draft_model) as draft_calls:
+                output_ids = self.target_model.generate(
+                    input_ids=input_ids, **self._assisted_kwargs(), **generation_kwargs
+                )
+        self.stats.record_assisted(
+            output_ids.shape[-1] - prompt_length, target_calls["calls"], draft_calls["calls"],
+            time.perf_counter() - start,
+        )
+        return output_ids
@@ -0,0 +1,182 @@
+# stopping.py
+# 生成の早期終了: ターンの区切りなどの停止文字列で生成を止める停止条件と、
+# 過去の応答の長さから学習したルート（モデル・エンドポイント）ごとの max_new_tokens の上限
+import math
+import threading
+from collections import defaultdict, deque
+
+import torch
+from transformers import StoppingCriteria
+
+# Gemmaのチャットテンプレートのターン区切り（モデルが次の発話を書き始めたら止める）
+DEFAULT_STOP_SEQUENCES = ("<start_of_turn>", "<end_of_turn>")
+
+
+def split_stop_sequences(tokenizer, stop_sequences):
+    """停止文字列を「1トークンの特殊トークン（idで判定できる）」と「それ以外の文字列」に分ける
+
+    特殊トークンは generate の eos_token_id に加えるだけで止められ、デコードして比較する必要がない。
+    語彙にない特殊トークン（別のモデル用の区切りなど）は文字列として扱う。
+    """
+    added_vocab = tokenizer.get_added_vocab()
+    special_tokens = set(tokenizer.all_special_tokens)
+    token_ids, strings = [], []
+    for sequence in stop_sequences:
+        if sequence in added_vocab:
+            token_ids.append(added_vocab[sequence])
+        elif sequence in special_tokens:
+            token_ids.append(tokenizer.convert_tokens_to_ids(sequence))
+        else:
+            strings.append(sequence)
+    return token_ids, strings
+
+
+def eos_token_ids(model, tokenizer, stop_token_ids):
+    """モデル本来のEOSに停止用の特殊トークンを加えた、generate の eos_token_id に渡すリスト"""
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        eos = tokenizer.eos_token_id
+    ids = [eos] if isinstance(eos, int) else list(eos or [])
+    return ids + [token_id for token_id in stop_token_ids if token_id not in ids]
+
+
+def truncate_at_stop(text, stop_strings):
+    """最初に現れた停止文字列の手前までを返す（停止文字列自体も含めない）"""
+    positions = [text.find(stop) for stop in stop_strings]
+    positions = [position for position in positions if position != -1]
+    return text[:min(positions)] if positions else text
+
+
+def safe_stream_length(text, stop_strings):
+    """ストリーミングで送ってよい長さと、停止文字列が現れたかを返す
+
+    末尾が停止文字列の途中（先頭の一部）になっている間は、その部分を送らずに保留する。
+    """
+    truncated = truncate_at_stop(text, stop_strings)
+    if len(truncated) < len(text):
+        return len(truncated), True
+    held = 0
+    for stop in stop_strings:
+        for length in range(min(len(stop) - 1, len(text)), held, -1):
+            if text.endswith(stop[:length]):
+                held = length
+                break
+    return len(text) - held, False
+
+
+class StopStringCriteria(StoppingCriteria):
+    """生成部分に停止文字列が現れたら止める停止条件（バッチでは行ごとに判定する）
+
+    毎ステップ全文をデコードしないよう、前回の判定以降に増えたトークンと、
+    停止文字列がまたがりうる直前の数トークンだけをデコードして調べる。
+    """
+
+    def __init__(self, tokenizer, stop_strings, prompt_length):
+        self.tokenizer = tokenizer
+        self.stop_strings = tuple(stop_strings)
+        self.prompt_length = prompt_length
+        self.overlap = max(len(tokenizer(stop, add_special_tokens=False).input_ids) for stop in self.stop_strings)
+        self._checked_length = prompt_length
+        self._done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self._done is None:
+            self._done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        start = max(self._checked_length - self.overlap, self.prompt_length)
+        self._checked_length = input_ids.shape[-1]
+        tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+        for i, tail in enumerate(tails):
+            if not self._done[i] and any(stop in tail for stop in self.stop_strings):
+                self._done[i] = True
+        return self._done.clone()
+
+
+class CancelStoppingCriteria(StoppingCriteria):
+    """クライアント切断やユーザーの中止操作で、外部から生成を打ち切るための停止条件"""
+
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.cancel_event.is_set()
+
+
+def stopping_kwargs(model, tokenizer, stop_sequences, prompt_length, cancel_event=None):
+    """停止文字列から generate に渡す eos_token_id と追加の停止条件、後処理で切り取る文字列を作る
+
+    cancel_event（threading.Event）を渡すと、セットされた時点で生成を打ち切る停止条件も加える。
+
+    Returns:
+        (eos_token_id のリスト, 停止条件のリスト, 文字列として判定する停止文字列)
+    """
+    stop_token_ids, stop_strings = split_stop_sequences(tokenizer, stop_sequences)
+    criteria = [StopStringCriteria(tokenizer, stop_strings, prompt_length)] if stop_strings else []
+    if cancel_event is not None:
+        criteria.append(CancelStoppingCriteria(cancel_event))
+    return eos_token_ids(model, tokenizer, stop_token_ids), criteria, stop_strings
+
+
+class AdaptiveTokenBudget:
+    """ルートごとの過去の応答トークン数から、max_new_tokens の上限を決める
+
+    上限は直近の応答トークン数の分位点に余裕（margin）を掛けた値で、リクエストの max_new_tokens より
+    大きくはしない。上限で打ち切られた応答もそのまま記録されるため、打ち切りが多いルートでは
+    分位点が上限に張り付き、次の上限が margin 倍に広がる。
+
+    Args:
+        quantile: 上限の基準にする応答トークン数の分位点
+        margin: 分位点に掛ける余裕
+        min_tokens: 上限の下限
+        min_samples: これより記録が少ないルートはリクエストの値をそのまま使う
+        window: ルートごとに保持する直近の記録数
+        tokens_per_word: トークン数が記録されていない履歴で、単語数をトークン数に換算する既定の比率
+    """
+
+    def __init__(self, quantile=0.95, margin=1.25, min_tokens=64, min_samples=20, window=500, tokens_per_word=1.5):
+        self.quantile = quantile
+        self.margin = margin
+        self.min_tokens = int(min_tokens)
+        self.min_samples = int(min_samples)
+        self.tokens_per_word = tokens_per_word
+        self._lengths = defaultdict(lambda: deque(maxlen=int(window)))
+        self._lock = threading.Lock()
+
+    def observe(self, route, output_tokens):
+        """1件の応答のトークン数を記録する"""
+        if output_tokens is None:
+            return
+        with self._lock:
+            self._lengths[route].append(int(output_tokens))
+
+    def seed(self, rows):
+        """(ルート, 単語数, 出力トークン数) の履歴（古い順）を記録する
+
+        出力トークン数がない古い履歴は、両方が記録されている履歴から求めた比率で単語数を換算する。
+        """
+        rows = list(rows)
+        paired = [(words, tokens) for _, words, tokens in rows if words and tokens]
+        if paired:
+            self.tokens_per_word = sum(tokens for _, tokens in paired) / sum(words for words, _ in paired)
+        for route, words, tokens in rows:
+            if tokens is None and words is not None:
+                tokens = math.ceil(words * self.tokens_per_word)
+            self.observe(route, tokens)
+
+    def budget(self, route, requested):
+        """ルートの max_new_tokens の上限（記録が少ない場合は requested）"""
+        with self._lock:
+            lengths = sorted(self._lengths.get(route, ()))
+        if len(lengths) < self.min_samples:
+            return requested
+        quantile_tokens = lengths[min(int(self.quantile * len(lengths)), len(lengths) - 1)]
+        return min(requested, max(self.min_tokens, math.ceil(quantile_tokens * self.margin)))
+
+    def stats(self):
+        """ルートごとの記録数と現在の上限（記録が少なく上限を決めていない場合はNone）"""
+        with self._lock:
+            routes = list(self._lengths)
+        stats = {}
+        for route in routes:
+            budget = self.budget(route, math.inf)
+            stats[route] = {"samples": len(self._lengths[route]), "budget": None if budget == math.inf else budget}
+        return stats
@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pytest
+import torch
+from transformers import BatchEncoding
+
+# テストから共有モジュール（response_cache.py など）を import できるようにする
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+class CharTokenizer:
+    """モデルを読み込まずに停止条件などを試すためのトークナイザー: 1文字を1トークンにする
+
+    語彙は特殊トークン（pad・EOS）、追加トークン（added_tokens）、まだ語彙にない文字の順にidを割り当てる。
+    """
+
+    def __init__(self, added_tokens=("<end_of_turn>",), alphabet=""):
+        self.special_tokens = ["<pad>", "</s>"]
+        self.pad_token_id, self.eos_token_id = 0, 1
+        self.added_tokens = list(added_tokens)
+        self._vocab = {token: i for i, token in enumerate(self.special_tokens + self.added_tokens)}
+        for char in alphabet:
+            self._token_id(char)
+
+    def _token_id(self, char):
+        return self._vocab.setdefault(char, len(self._vocab))
+
+    def __len__(self):
+        return len(self._vocab)
+
+    def get_vocab(self):
+        return dict(self._vocab)
+
+    def get_added_vocab(self):
+        return {token: self._vocab[token] for token in self.added_tokens}
+
+    @property
+    def all_special_tokens(self):
+        return self.special_tokens + self.added_tokens
+
+    def convert_tokens_to_ids(self, token):
+        return self._vocab[token]
+
+    def encode(self, text):
+        return [self._token_id(char) for char in text]
+
+    def __call__(self, text, add_special_tokens=True, return_tensors=None):
+        ids = self.encode(text)
+        return BatchEncoding({"input_ids": torch.tensor([ids]) if return_tensors == "pt" else ids})
+
+    def decode(self, ids, skip_special_tokens=False):
+        tokens = {token_id: token for token, token_id in self._vocab.items()}
+        skipped = {self._vocab[token] for token in self.all_special_tokens} if skip_special_tokens else set()
+        return "".join(tokens[int(token_id)] for token_id in ids if int(token_id) not in skipped)
+
+    def batch_decode(self, rows, skip_special_tokens=False):
+        return [self.decode(row, skip_special_tokens) for row in rows]
+
+
+@pytest.fixture
+def tokenizer():
+    return CharTokenizer()
+
+
+@pytest.fixture
+def make_tokenizer():
+    """設定を指定して CharTokenizer を作る関数"""
+    return CharTokenizer
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+import cpu_profile
+from cpu_profile import configure_threads, probe_cpu_dtype, quantize_int8, select_dtype
+
+
+def test_probe_reports_timings_and_caches_result():
+    best, timings = probe_cpu_dtype(("float32", "int4"), size=32, repeats=1)
+
+    # 計測できなかった dtype は結果に含めない
+    assert best == "float32"
+    assert list(timings) == ["float32"] and timings["float32"] > 0
+    assert probe_cpu_dtype(("float32", "int4"), size=32, repeats=1) == (best, timings)
+
+
+def test_select_dtype(monkeypatch):
+    monkeypatch.setattr(cpu_profile, "probe_cpu_dtype", lambda: ("bfloat16", {"float32": 2.0, "bfloat16": 1.0}))
+
+    assert select_dtype("cpu", "float32") == (torch.float32, {"dtype": "float32", "reason": "configured"})
+    assert select_dtype("cpu") == (torch.bfloat16, {
+        "dtype": "bfloat16", "reason": "probed", "probe_seconds": {"float32": 2.0, "bfloat16": 1.0},
+    })
+    with pytest.raises(ValueError):
+        select_dtype("cpu", "int4")
+
+
+def test_configure_threads_splits_cores_between_workers(monkeypatch):
+    monkeypatch.setattr(cpu_profile.os, "cpu_count", lambda: 8)
+    original = torch.get_num_threads()
+    try:
+        assert configure_threads(workers=4)["intra_op_threads"] == 2
+        assert configure_threads(3, workers=4)["intra_op_threads"] == 3
+        assert configure_threads(workers=16)["intra_op_threads"] == 1
+    finally:
+        torch.set_num_threads(original)
+
+
+def test_quantize_int8_replaces_linear_layers():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(16, 16), torch.nn.ReLU(), torch.nn.Linear(16, 4))
+    inputs = torch.randn(2, 16)
+    expected = model(inputs)
+    quantized = quantize_int8(model)
+
+    assert all(isinstance(quantized[i], torch.ao.nn.quantized.dynamic.Linear) for i in (0, 2))
+    assert torch.allclose(quantized(inputs), expected, atol=0.1)
@@ -0,0 +1,71 @@
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, is_cacheable, make_cache_key
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(response_cache.time, "time", clock.time)
+    return clock
+
+
+def test_cache_key_ignores_whitespace_but_not_parameters():
+    params = {"max_new_tokens": 64, "do_sample": False}
+    key = make_cache_key("model", "質問\r\n", params)
+    assert key == make_cache_key("model", "  質問\n", dict(reversed(params.items())))
+    assert key != make_cache_key("model", "質問", {**params, "max_new_tokens": 65})
+    assert key != make_cache_key("other-model", "質問", params)
+
+
+def test_is_cacheable():
+    assert is_cacheable({"do_sample": False})
+    assert is_cacheable({"do_sample": True, "seed": 0})
+    assert not is_cacheable({"do_sample": True})
+
+
+def test_lru_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2, ttl_seconds=0)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a を使ったため、最も古いのは b
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (3, 1, 2)
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResponseCache(max_entries=10, ttl_seconds=60)
+    cache.set("a", "回答")
+    clock.now += 59
+    assert cache.get("a") == "回答"
+    clock.now += 2
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_persistent_cache_survives_restart_and_respects_ttl(tmp_path, clock):
+    db_path = str(tmp_path / "cache.db")
+    cache = ResponseCache(max_entries=10, ttl_seconds=60, db_path=db_path)
+    cache.set("a", {"text": "回答"})
+    cache.set("b", {"text": "古い回答"})
+
+    restarted = ResponseCache(max_entries=10, ttl_seconds=60, db_path=db_path)
+    assert restarted.get("a") == {"text": "回答"}
+    clock.now += 61
+    assert restarted.get("b") is None
+    assert restarted._conn.execute("SELECT COUNT(*) FROM response_cache WHERE key = 'b'").fetchone()[0] == 0
+
+    restarted.clear()
+    assert ResponseCache(db_path=db_path).get("a") is None
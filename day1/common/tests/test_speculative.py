@@ -0,0 +1,118 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+import speculative
+from speculative import SpeculativeDecoder, tokenizers_compatible
+
+
+class FakeModel(torch.nn.Module):
+    """generate の代わり: 呼ばれた引数を記録し、new_tokens 個のトークンを付け足して返す"""
+
+    def __init__(self, new_tokens=4):
+        super().__init__()
+        self.new_tokens = new_tokens
+        self.generation_config = SimpleNamespace(num_assistant_tokens=5)
+        self.calls = []
+
+    def forward(self, input_ids):
+        return input_ids
+
+    def generate(self, input_ids, **kwargs):
+        self.calls.append(kwargs)
+        for _ in range(self.new_tokens):
+            self(input_ids)
+        return torch.cat([input_ids, torch.zeros((input_ids.shape[0], self.new_tokens), dtype=torch.long)], dim=-1)
+
+
+@pytest.fixture
+def make_decoder(make_tokenizer):
+    """語彙が "abc" のターゲットと、draft_alphabet の語彙のドラフトの組を作る関数"""
+
+    def make(draft_alphabet="abc", **kwargs):
+        return SpeculativeDecoder(FakeModel(), make_tokenizer(alphabet="abc"),
+                                  FakeModel(), make_tokenizer(alphabet=draft_alphabet), **kwargs)
+
+    return make
+
+
+def test_tokenizers_compatible(make_tokenizer):
+    assert tokenizers_compatible(make_tokenizer(alphabet="abc"), make_tokenizer(alphabet="abc"))
+    # 同じ文字でもidが違う、語彙の大きさが違う、EOSが違う場合は互換でない
+    assert not tokenizers_compatible(make_tokenizer(alphabet="abc"), make_tokenizer(alphabet="acb"))
+    assert not tokenizers_compatible(make_tokenizer(alphabet="abc"), make_tokenizer(alphabet="abcd"))
+    other_eos = make_tokenizer(alphabet="abc")
+    other_eos.eos_token_id = 0
+    assert not tokenizers_compatible(make_tokenizer(alphabet="abc"), other_eos)
+
+
+@pytest.mark.parametrize("draft_alphabet, allow_universal, universal_supported, mode", [
+    ("abc", True, True, "shared-vocab"),
+    ("abc", False, False, "shared-vocab"),
+    ("xyz", True, True, "universal"),
+    ("xyz", False, True, "disabled"),
+    ("xyz", True, False, "disabled"),
+])
+def test_mode_selection(monkeypatch, make_decoder, draft_alphabet, allow_universal, universal_supported, mode):
+    monkeypatch.setattr(speculative, "supports_universal_assisted_decoding", lambda: universal_supported)
+    decoder = make_decoder(draft_alphabet, allow_universal=allow_universal)
+
+    assert decoder.mode == mode
+    assert decoder.enabled == (mode != "disabled")
+
+
+def test_assisted_kwargs_by_mode(monkeypatch, make_decoder):
+    monkeypatch.setattr(speculative, "supports_universal_assisted_decoding", lambda: True)
+    shared = make_decoder()
+    universal = make_decoder("xyz")
+    input_ids = torch.tensor([[3, 4]])
+    shared.generate(input_ids)
+    universal.generate(input_ids)
+
+    assert shared.target_model.calls[-1] == {"assistant_model": shared.draft_model}
+    assert universal.target_model.calls[-1] == {
+        "assistant_model": universal.draft_model,
+        "tokenizer": universal.target_tokenizer,
+        "assistant_tokenizer": universal.draft_tokenizer,
+    }
+
+
+def test_disabled_and_batched_requests_use_plain_generation(monkeypatch, make_decoder):
+    monkeypatch.setattr(speculative, "supports_universal_assisted_decoding", lambda: False)
+    disabled = make_decoder("xyz")
+    disabled.generate(torch.tensor([[3, 4]]))
+    shared = make_decoder()
+    shared.generate(torch.tensor([[3, 4], [5, 3]]))
+
+    assert disabled.target_model.calls == [{}]
+    assert shared.target_model.calls == [{}]
+    assert shared.stats.stats()["assisted_requests"] == 0
+
+
+def test_baseline_is_opt_in(make_decoder):
+    decoder = make_decoder(num_assistant_tokens=3)
+    for _ in range(5):
+        decoder.generate(torch.tensor([[3, 4]]))
+
+    stats = decoder.stats.stats()
+    assert decoder.draft_model.generation_config.num_assistant_tokens == 3
+    assert (stats["assisted_requests"], stats["baseline_requests"], stats["speedup"]) == (5, 0, None)
+
+
+def test_baseline_every_counts_requests_across_threads(make_decoder):
+    decoder = make_decoder(baseline_every=4)
+
+    def worker():
+        for _ in range(25):
+            decoder.generate(torch.tensor([[3, 4]]))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = decoder.stats.stats()
+    assert (stats["assisted_requests"], stats["baseline_requests"]) == (150, 50)
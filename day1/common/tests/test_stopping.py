@@ -0,0 +1,125 @@
+import math
+import threading
+from types import SimpleNamespace
+
+import torch
+
+from stopping import (AdaptiveTokenBudget, StopStringCriteria, safe_stream_length, split_stop_sequences,
+                      stopping_kwargs, truncate_at_stop)
+
+
+def run_criteria(criteria, tokenizer, prompt, generated):
+    """generated を1文字（1トークン）ずつ追加しながら停止条件を呼び、最初に止まった時点の生成文字数を返す"""
+    ids = tokenizer.encode(prompt)
+    for i, char in enumerate(generated, start=1):
+        ids.append(tokenizer.encode(char)[0])
+        if criteria(torch.tensor([ids]), None)[0]:
+            return i
+    return None
+
+
+def test_split_stop_sequences(tokenizer):
+    token_ids, strings = split_stop_sequences(tokenizer, ["<end_of_turn>", "</s>", "質問:", "<start_of_turn>"])
+
+    assert token_ids == [tokenizer.convert_tokens_to_ids("<end_of_turn>"), tokenizer.eos_token_id]
+    # 語彙にない特殊トークンは文字列として判定する
+    assert strings == ["質問:", "<start_of_turn>"]
+
+
+def test_truncate_at_stop():
+    assert truncate_at_stop("回答です。質問: 次", ["質問:", "Q:"]) == "回答です。"
+    assert truncate_at_stop("Q: と 質問:", ["質問:", "Q:"]) == ""
+    assert truncate_at_stop("停止文字列なし", ["質問:"]) == "停止文字列なし"
+    assert truncate_at_stop("回答", []) == "回答"
+
+
+def test_stop_string_split_across_tokens(tokenizer):
+    prompt = "質問: BM25とは？\n回答:"
+    criteria = StopStringCriteria(tokenizer, ["質問:"], len(tokenizer.encode(prompt)))
+
+    # プロンプト中の停止文字列では止めず、生成部分で3トークンにまたがって現れた時点で止める
+    assert run_criteria(criteria, tokenizer, prompt, "単語の出現頻度です。質問: 次") == len("単語の出現頻度です。質問:")
+
+
+def test_stop_string_after_many_steps(tokenizer):
+    prompt = "Q"
+    generated = "あ" * 50 + "<start_of_turn>"
+    criteria = StopStringCriteria(tokenizer, ["<start_of_turn>"], len(tokenizer.encode(prompt)))
+
+    assert run_criteria(criteria, tokenizer, prompt, generated) == len(generated)
+
+
+def test_stop_string_criteria_is_per_row(tokenizer):
+    criteria = StopStringCriteria(tokenizer, ["Q:"], prompt_length=1)
+    rows = ["aQ:b", "abcd"]
+    result = None
+    for length in range(2, 5):
+        result = criteria(torch.tensor([tokenizer.encode(row[:length]) for row in rows]), None)
+
+    assert result.tolist() == [True, False]
+
+
+def test_stopping_kwargs_adds_stop_token_and_cancel(tokenizer):
+    model = SimpleNamespace(generation_config=SimpleNamespace(eos_token_id=tokenizer.eos_token_id))
+    cancel_event = threading.Event()
+    eos, criteria, strings = stopping_kwargs(model, tokenizer, ["<end_of_turn>", "質問:"], 3, cancel_event=cancel_event)
+
+    assert eos == [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")]
+    assert strings == ["質問:"]
+    assert len(criteria) == 2
+    ids = torch.tensor([tokenizer.encode("abcd")])
+    assert not criteria[1](ids, None)
+    cancel_event.set()
+    assert criteria[1](ids, None)
+
+
+def test_safe_stream_length_holds_back_partial_stop():
+    stops = ["<end_of_turn>", "質問:"]
+
+    assert safe_stream_length("回答です", stops) == (len("回答です"), False)
+    # 末尾が停止文字列の先頭の一部の間は、その部分を送らない
+    assert safe_stream_length("回答です<end_", stops) == (len("回答です"), False)
+    assert safe_stream_length("回答です質問", stops) == (len("回答です"), False)
+    # 停止文字列にならなかった場合は送る
+    assert safe_stream_length("回答です<b>", stops) == (len("回答です<b>"), False)
+    # 停止文字列が現れたら、その手前までを送って終了
+    assert safe_stream_length("回答です質問: 次", stops) == (len("回答です"), True)
+
+
+def test_budget_uses_request_until_enough_samples():
+    budget = AdaptiveTokenBudget(min_samples=5, min_tokens=8)
+    for _ in range(4):
+        budget.observe("gemma", 10)
+
+    assert budget.budget("gemma", 512) == 512
+    assert budget.stats() == {"gemma": {"samples": 4, "budget": None}}
+
+
+def test_budget_clamps_to_quantile_with_margin():
+    budget = AdaptiveTokenBudget(quantile=0.95, margin=1.25, min_tokens=8, min_samples=5)
+    for tokens in range(1, 101):
+        budget.observe("gemma", tokens)
+
+    expected = math.ceil(96 * 1.25)  # 100件の95%点（小さい方から96番目）に余裕を掛ける
+    assert budget.budget("gemma", 512) == expected
+    assert budget.budget("gemma", 50) == 50  # リクエストの値より大きくはしない
+    assert budget.budget("xglm", 512) == 512  # 記録のないルートはそのまま
+
+
+def test_budget_respects_min_tokens_and_window():
+    budget = AdaptiveTokenBudget(min_tokens=64, min_samples=3, window=3)
+    for tokens in (500, 500, 500, 4, 4, 4):
+        budget.observe("gemma", tokens)
+
+    # 直近3件（4トークン）だけを使い、下限の64で止める
+    assert budget.budget("gemma", 512) == 64
+
+
+def test_budget_seed_converts_words_to_tokens():
+    budget = AdaptiveTokenBudget(quantile=1.0, margin=1.0, min_tokens=1, min_samples=1)
+    budget.seed([("gemma", 10, 20), ("gemma", 30, 60), ("xglm", 40, None), ("xglm", None, None)])
+
+    assert budget.tokens_per_word == 2.0
+    assert budget.budget("gemma", 512) == 60
+    # トークン数がない履歴は単語数を比率で換算し、どちらもない履歴は数えない
+    assert budget.stats()["xglm"] == {"samples": 1, "budget": 80}
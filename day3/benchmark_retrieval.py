@@ -0,0 +1,129 @@
+# benchmark_retrieval.py
+# 検索バックエンドごとの再現率（厳密な検索の上位k件をどれだけ含むか）とレイテンシを比較するベンチマーク
+# 使い方:
+#   python benchmark_retrieval.py --index-dir index                  # 作成済みの索引で比較
+#   python benchmark_retrieval.py --synthetic 500000 --dim 1536      # 講義数百回分を想定した乱数の埋め込みで比較
+#
+# クエリには索引のチャンクの埋め込みにノイズを加えたものを使う（埋め込みモデルを読み込まずに実行できる）。
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from embedding_index import EmbeddingIndex
+from retriever import ExactSearch, IVFSearch, HNSWSearch
+
+
+class SyntheticIndex:
+    """乱数の単位ベクトルをメモリマップに書き出した、EmbeddingIndex の代わりの索引"""
+
+    def __init__(self, index_dir, count, dim, dtype="float16", seed=0, block_size=65536):
+        self.index_dir = index_dir
+        rng = np.random.default_rng(seed)
+        self.embeddings = np.lib.format.open_memmap(
+            f"{index_dir}/embeddings.npy", mode="w+", dtype=dtype, shape=(count, dim)
+        )
+        for start in range(0, count, block_size):
+            block = rng.standard_normal((min(block_size, count - start), dim)).astype(np.float32)
+            self.embeddings[start:start + block.shape[0]] = block / np.linalg.norm(block, axis=1, keepdims=True)
+        self.embeddings.flush()
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+
+def make_queries(index, count, noise, seed=0):
+    """索引からランダムに選んだチャンクの埋め込みにノイズを加え、正規化したクエリ"""
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(index), size=min(count, len(index)), replace=False))
+    queries = np.asarray(index.embeddings[rows], dtype=np.float32)
+    queries += noise * rng.standard_normal(queries.shape).astype(np.float32) * np.abs(queries).mean()
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def full_sort_search(index, queries, k):
+    """ノートブックと同じく、全件のスコアを argsort で並び替える方法（比較の基準）"""
+    scores = queries @ np.asarray(index.embeddings, dtype=np.float32).T
+    return scores.argsort(axis=1)[:, ::-1][:, :k]
+
+
+def measure(search, queries, k):
+    """1件ずつ検索したときのレイテンシ（秒）の一覧と、結果の行番号"""
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        indices, _ = search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+        results.append(indices[0])
+    return np.array(latencies), results
+
+
+def recall(results, truth, k):
+    """厳密な検索の上位k件のうち、結果に含まれている割合の平均"""
+    return float(np.mean([len(set(result[:k]) & set(expected[:k])) / k for result, expected in zip(results, truth)]))
+
+
+def report(name, latencies, results, truth, k):
+    print(f"{name:<24} recall@{k}={recall(results, truth, k):.3f}  "
+          f"p50={np.percentile(latencies, 50) * 1000:8.2f}ms  p95={np.percentile(latencies, 95) * 1000:8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="検索バックエンドの再現率とレイテンシを比較します")
+    parser.add_argument("--index-dir", help="embedding_index.py で作成した索引")
+    parser.add_argument("--synthetic", type=int, help="乱数の埋め込みをこの件数だけ作って比較する")
+    parser.add_argument("--dim", type=int, default=1536, help="--synthetic の埋め込みの次元")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--noise", type=float, default=0.5, help="クエリに加えるノイズの大きさ")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128])
+    args = parser.parse_args()
+    if not args.index_dir and not args.synthetic:
+        parser.error("--index-dir または --synthetic を指定してください")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.synthetic:
+            print(f"{args.synthetic} 件 x {args.dim} 次元の乱数の埋め込みを作成しています...")
+            index = SyntheticIndex(temp_dir, args.synthetic, args.dim)
+        else:
+            index = EmbeddingIndex(args.index_dir)
+        queries = make_queries(index, args.queries, args.noise)
+        k = args.top_k
+        print(f"索引: {len(index)} 件, クエリ: {len(queries)} 件, k={k}")
+
+        exact = ExactSearch(index)
+        latencies, truth = measure(exact.search, queries, k)
+        if len(index) * index.embeddings.shape[1] <= 2 ** 28:  # 全件をfloat32で読み込める規模のときだけ比較する
+            start = time.perf_counter()
+            full_sort_search(index, queries, k)
+            print(f"{'argsort（全件の並び替え）':<24} {(time.perf_counter() - start) / len(queries) * 1000:.2f}ms/クエリ")
+        report("exact（argpartition）", latencies, truth, truth, k)
+        start = time.perf_counter()
+        exact.search(queries, k)
+        print(f"{'exact（まとめて検索）':<24} {(time.perf_counter() - start) / len(queries) * 1000:.2f}ms/クエリ")
+
+        start = time.perf_counter()
+        ivf = IVFSearch.build(index)
+        print(f"IVF: {ivf.centroids.shape[0]} クラスタを {time.perf_counter() - start:.1f}s で作成しました")
+        for n_probe in args.n_probe:
+            ivf.n_probe = n_probe
+            latencies, results = measure(ivf.search, queries, k)
+            report(f"ivf n_probe={n_probe}", latencies, results, truth, k)
+
+        try:
+            start = time.perf_counter()
+            hnsw = HNSWSearch.build(index)
+        except ImportError as e:
+            print(f"HNSWは比較しません: {e}")
+            return
+        print(f"HNSW: グラフを {time.perf_counter() - start:.1f}s で作成しました")
+        for ef in args.ef:
+            hnsw.graph.set_ef(max(ef, k))
+            latencies, results = measure(hnsw.search, queries, k)
+            report(f"hnsw ef={ef}", latencies, results, truth, k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# bm25_index.py
+# 埋め込み索引（embedding_index.py）のチャンクに対する、BM25の転置インデックス。
+# 日本語はJanomeで分かち書きし、「CerebrasGPT」「Llama」のようなモデル名など、埋め込みの検索では
+# 取りこぼしやすい語の完全一致を拾う。転置インデックスは索引のディレクトリに保存し、検索時は作り直さない。
+#
+# 使い方:
+#   from embedding_index import EmbeddingIndex
+#   from bm25_index import BM25Index
+#   bm25 = BM25Index.load_or_build(EmbeddingIndex("index"))
+#   rows, scores = bm25.search(["CerebrasGPTのパラメータ数は？"], k=50)
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+
+import numpy as np
+
+from retriever import top_k
+
+BM25_FILE = "bm25.npz"          # 転置インデックス（語ごとのチャンクの行と出現回数、チャンクの長さ）
+VOCAB_FILE = "bm25_vocab.json"  # 語彙（語 -> 転置インデックスの位置）と作成時の設定
+# 検索に使わない品詞（助詞・助動詞・記号など）
+SKIP_PARTS_OF_SPEECH = ("助詞", "助動詞", "記号", "接頭詞", "フィラー")
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """共有のJanomeトークナイザーを取得する（辞書の読み込みが重いため、初回呼び出し時に1つだけ生成）"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                try:
+                    from janome.tokenizer import Tokenizer
+                except ImportError as e:
+                    raise ImportError("BM25の分かち書きには janome が必要です（pip install janome）") from e
+                _tokenizer = Tokenizer()
+    return _tokenizer
+
+
+def tokenize(text):
+    """検索用の語のリスト（NFKCで正規化・小文字化し、活用する語は原形にして、助詞・記号などを除く）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokenizer = get_tokenizer()
+    terms = []
+    with _tokenizer_lock:  # 同じインスタンスを複数スレッドから同時に使わない
+        tokens = list(tokenizer.tokenize(text))
+    for token in tokens:
+        if token.part_of_speech.split(",")[0] in SKIP_PARTS_OF_SPEECH:
+            continue
+        term = token.base_form if token.base_form != "*" else token.surface
+        term = term.strip()
+        if term:
+            terms.append(term)
+    return terms
+
+
+def corpus_digest(index):
+    """索引のチャンクの内容のハッシュをまとめたもの（転置インデックスが古くなっていないかの確認に使う）"""
+    return hashlib.sha256("\n".join(index.hashes).encode("utf-8")).hexdigest()
+
+
+class BM25Index:
+    """BM25の転置インデックス
+
+    語ごとに、その語を含むチャンクの行と出現回数を連続した配列（postings）に並べ、
+    語の位置（offsets）から取り出す。検索時はクエリの語の postings だけを読んでスコアを足し合わせる。
+
+    Args:
+        k1, b: BM25のパラメータ（出現回数の飽和の度合いと、チャンクの長さによる正規化の度合い）
+    """
+
+    def __init__(self, vocab, offsets, rows, freqs, lengths, k1=1.5, b=0.75, digest=None):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.rows = rows
+        self.freqs = freqs
+        self.lengths = lengths
+        self.k1 = k1
+        self.b = b
+        self.digest = digest
+        document_freqs = np.diff(offsets)
+        count = len(lengths)
+        # BM25のIDF（負にならないよう +1 した形）
+        self.idf = np.log(1.0 + (count - document_freqs + 0.5) / (document_freqs + 0.5)).astype(np.float32)
+        self.length_norm = (k1 * (1 - b + b * lengths / max(lengths.mean(), 1e-9))).astype(np.float32)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, index, k1=1.5, b=0.75, progress=None):
+        """索引の全チャンクを分かち書きして転置インデックスを作り、索引のディレクトリに保存する"""
+        postings = {}  # 語 -> [(行, 出現回数), ...]
+        lengths = np.zeros(len(index.texts), dtype=np.float32)
+        for row, text in enumerate(index.texts):
+            terms = tokenize(text)
+            lengths[row] = len(terms)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((row, count))
+            if progress is not None:
+                progress(row + 1, len(index.texts))
+
+        vocab = {term: position for position, term in enumerate(sorted(postings))}
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        rows, freqs = [], []
+        for term, position in vocab.items():
+            for row, count in postings[term]:
+                rows.append(row)
+                freqs.append(count)
+            offsets[position + 1] = len(rows)
+        rows = np.array(rows, dtype=np.int32)
+        freqs = np.array(freqs, dtype=np.float32)
+
+        digest = corpus_digest(index)
+        np.savez(os.path.join(index.index_dir, BM25_FILE), offsets=offsets, rows=rows, freqs=freqs, lengths=lengths)
+        with open(os.path.join(index.index_dir, VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump({"k1": k1, "b": b, "digest": digest, "vocab": vocab}, f, ensure_ascii=False)
+        return cls(vocab, offsets, rows, freqs, lengths, k1=k1, b=b, digest=digest)
+
+    @classmethod
+    def load(cls, index_dir):
+        data = np.load(os.path.join(index_dir, BM25_FILE))
+        with open(os.path.join(index_dir, VOCAB_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        return cls(meta["vocab"], data["offsets"], data["rows"], data["freqs"], data["lengths"],
+                   k1=meta["k1"], b=meta["b"], digest=meta["digest"])
+
+    @classmethod
+    def load_or_build(cls, index, **build_options):
+        """保存済みの転置インデックスが現在の索引のチャンクから作ったものであれば読み込み、そうでなければ作り直す"""
+        if os.path.exists(os.path.join(index.index_dir, VOCAB_FILE)):
+            loaded = cls.load(index.index_dir)
+            if loaded.digest == corpus_digest(index):
+                return loaded
+        return cls.build(index, **build_options)
+
+    def scores(self, question):
+        """質問と全チャンクのBM25スコア（質問の語を含まないチャンクは0）"""
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(question)):
+            position = self.vocab.get(term)
+            if position is None:
+                continue
+            start, end = self.offsets[position], self.offsets[position + 1]
+            rows, freqs = self.rows[start:end], self.freqs[start:end]
+            # 1つの語の postings に同じ行は1回しか現れないため、そのまま足し込める
+            scores[rows] += self.idf[position] * freqs * (self.k1 + 1) / (freqs + self.length_norm[rows])
+        return scores
+
+    def search(self, questions, k):
+        """質問ごとのBM25スコアの上位k件の (行, スコア)。スコアが0のチャンク（語が1つも一致しない）は -1 で埋める"""
+        indices = np.full((len(questions), k), -1, dtype=np.int64)
+        scores = np.zeros((len(questions), k), dtype=np.float32)
+        for i, question in enumerate(questions):
+            rows, best = top_k(self.scores(question), k)
+            matched = best[0] > 0
+            count = int(matched.sum())
+            indices[i, :count] = rows[0][matched]
+            scores[i, :count] = best[0][matched]
+        return indices, scores
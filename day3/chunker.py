@@ -0,0 +1,190 @@
+# chunker.py
+# 大きな文字起こしファイルを少しずつ読みながら、文の区切りでチャンクに分割するジェネレータ。
+# チャンクはトークン数の上限と重なり（オーバーラップ）を指定でき、前後の文を含めた範囲（近傍ウィンドウ）の
+# ファイル上の位置を分割時に記録しておくため、検索のたびに文を連結し直さずにファイルから読み出せる。
+#
+# 使い方:
+#   from chunker import iter_chunks, read_window
+#   for chunk in iter_chunks("data/LLM2024_day4.txt", max_tokens=256, overlap_tokens=32, window_sentences=2):
+#       print(chunk.chunk_id, chunk.text, read_window(chunk))
+import codecs
+import hashlib
+import math
+import os
+import re
+from collections import deque
+from dataclasses import dataclass
+
+# 文の区切り（句点と空行）
+SENTENCE_BOUNDARY = re.compile(r"。|\n\s*\n")
+
+
+@dataclass
+class Sentence:
+    index: int
+    text: str
+    start: int  # ファイル上の位置（バイト）
+    end: int
+    tokens: int
+
+
+@dataclass
+class Chunk:
+    chunk_id: str      # ファイル名と内容のハッシュから作る、位置がずれても変わらないID
+    source: str        # 元のファイルのパス
+    index: int         # ファイル内での通し番号
+    text: str
+    tokens: int
+    start: int         # チャンクのファイル上の位置（バイト）
+    end: int
+    window_start: int  # 前後 window_sentences 文を含めた範囲のファイル上の位置（バイト）
+    window_end: int
+
+    def metadata(self):
+        """索引に保存する位置の情報"""
+        return {"source": self.source, "index": self.index, "start": self.start, "end": self.end,
+                "window_start": self.window_start, "window_end": self.window_end}
+
+
+def tokenizer_counter(tokenizer):
+    """transformersのトークナイザーでトークン数を数える関数を作る（特殊トークンは含めない）"""
+    return lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def _iter_segments(path, read_size):
+    """ファイルを read_size バイトずつ読み、文の区切りまでの (テキスト, 開始バイト) を順に返す"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer, buffer_start = "", 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(read_size)
+            buffer += decoder.decode(data, final=not data)
+            consumed = 0
+            for match in SENTENCE_BOUNDARY.finditer(buffer):
+                segment = buffer[consumed:match.end()]
+                yield segment, buffer_start
+                buffer_start += len(segment.encode("utf-8"))
+                consumed = match.end()
+            buffer = buffer[consumed:]
+            if not data:
+                break
+    if buffer:
+        yield buffer, buffer_start
+
+
+def _split_long(text, start, tokens, max_tokens):
+    """上限を超える1文を、ほぼ同じ長さの部分に文字単位で分ける"""
+    parts = math.ceil(tokens / max_tokens)
+    size = math.ceil(len(text) / parts)
+    for offset in range(0, len(text), size):
+        piece = text[offset:offset + size]
+        yield piece, start + len(text[:offset].encode("utf-8"))
+
+
+def iter_sentences(path, count_tokens=len, max_tokens=None, read_size=1 << 16):
+    """ファイルの文を (通し番号, テキスト, 位置, トークン数) の Sentence として順に返す
+
+    前後の空白を除いた部分の位置を記録する。max_tokens を超える文はいくつかに分ける。
+    """
+    index = 0
+    for segment, segment_start in _iter_segments(path, read_size):
+        text = segment.strip()
+        if not text:
+            continue
+        start = segment_start + len(segment[:len(segment) - len(segment.lstrip())].encode("utf-8"))
+        tokens = count_tokens(text)
+        pieces = [(text, start)]
+        if max_tokens and tokens > max_tokens:
+            pieces = list(_split_long(text, start, tokens, max_tokens))
+        for piece, piece_start in pieces:
+            piece_tokens = tokens if len(pieces) == 1 else count_tokens(piece)
+            yield Sentence(index, piece, piece_start, piece_start + len(piece.encode("utf-8")), piece_tokens)
+            index += 1
+
+
+def iter_chunks(path, max_tokens=256, overlap_tokens=32, window_sentences=2, count_tokens=len, read_size=1 << 16):
+    """ファイルを文の区切りでチャンクに分け、Chunk を順に返すジェネレータ
+
+    トークン数が max_tokens を超えない範囲で文をまとめ、次のチャンクは前のチャンクの末尾から
+    overlap_tokens 以内の文を重ねて始める。メモリに保持するのは、作成中のチャンクと
+    近傍ウィンドウに必要な前後の文だけで、ファイル全体は読み込まない。
+
+    Args:
+        count_tokens: テキストのトークン数を返す関数（既定は文字数。埋め込みモデルのトークナイザーで
+            数える場合は tokenizer_counter(tokenizer) を渡す）
+        window_sentences: 近傍ウィンドウに含める前後の文の数（ノートブックの documents[i-2:i+2] に相当）
+    """
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens は max_tokens より小さくしてください")
+    source_name = os.path.basename(path)
+    seen_hashes = {}
+    kept = deque()      # 作成中・ウィンドウ待ちのチャンクが参照する文
+    pending = deque()   # 後ろのウィンドウの文が揃うのを待っているチャンク: [最初の文, 最後の文, テキスト, トークン数]
+    current, current_tokens = [], 0
+    chunk_index = 0
+
+    def sentence(i):
+        return kept[i - kept[0].index]
+
+    def finalize(first, last, text, tokens, window_end):
+        nonlocal chunk_index
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+        occurrence = seen_hashes.get(digest, 0)
+        seen_hashes[digest] = occurrence + 1
+        chunk_id = f"{source_name}:{digest}" + (f"-{occurrence}" if occurrence else "")
+        window_first = max(first - window_sentences, kept[0].index)
+        chunk = Chunk(chunk_id, path, chunk_index, text, tokens, sentence(first).start, sentence(last).end,
+                      sentence(window_first).start, window_end)
+        chunk_index += 1
+        return chunk
+
+    def close_current():
+        text = "".join(sentence(i).text for i in current)
+        pending.append([current[0], current[-1], text, current_tokens])
+
+    last_sentence = None
+    for s in iter_sentences(path, count_tokens, max_tokens, read_size):
+        kept.append(s)
+        last_sentence = s
+        # 後ろのウィンドウの文が揃ったチャンクを返す
+        while pending and pending[0][1] + window_sentences <= s.index:
+            first, last, text, tokens = pending.popleft()
+            yield finalize(first, last, text, tokens, sentence(last + window_sentences).end)
+
+        if current and current_tokens + s.tokens > max_tokens:
+            close_current()
+            # 末尾から overlap_tokens 以内の文を次のチャンクの先頭に重ねる（チャンク全体は重ねない）
+            overlap, overlap_total = [], 0
+            for i in reversed(current[1:]):
+                if overlap_total + sentence(i).tokens > overlap_tokens:
+                    break
+                overlap.insert(0, i)
+                overlap_total += sentence(i).tokens
+            current, current_tokens = overlap, overlap_total
+            while current and current_tokens + s.tokens > max_tokens:
+                current_tokens -= sentence(current.pop(0)).tokens
+        current.append(s.index)
+        current_tokens += s.tokens
+
+        # 前のウィンドウにも使わなくなった文は捨てる
+        oldest_needed = min([current[0]] + [chunk[0] for chunk in pending]) - window_sentences
+        while kept and kept[0].index < oldest_needed:
+            kept.popleft()
+
+    if current:
+        close_current()
+    while pending:
+        first, last, text, tokens = pending.popleft()
+        yield finalize(first, last, text, tokens, last_sentence.end)
+
+
+def read_span(path, start, end):
+    """ファイルの start〜end バイトの範囲をテキストとして読み出す"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8")
+
+
+def read_window(chunk):
+    """チャンクの前後の文を含めた近傍ウィンドウのテキスト"""
+    return read_span(chunk.source, chunk.window_start, chunk.window_end)
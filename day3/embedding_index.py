@@ -0,0 +1,225 @@
+# embedding_index.py
+# 講義の文字起こしのチャンクを1度だけ埋め込んでディスクに保存し、検索時はメモリマップで参照する索引。
+# チャンクごとに内容のハッシュを記録しておき、作り直すときは追加・変更されたチャンクだけを埋め込む。
+#
+# 使い方:
+#   python embedding_index.py --input data/LLM2024_day4.txt --index-dir index [--max-tokens 256 --overlap-tokens 32]
+#
+#   from embedding_index import EmbeddingIndex
+#   index = EmbeddingIndex("index")
+#   scores = index.similarities(emb_model.encode([question], prompt_name="query"))
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from chunker import Chunk, iter_chunks, read_span, tokenizer_counter
+
+EMBEDDINGS_FILE = "embeddings.npy"  # 埋め込み（チャンク数 x 次元）。行の順序は chunks.jsonl と同じ
+CHUNKS_FILE = "chunks.jsonl"        # 1行1チャンクの {"id", "hash", "text"}（chunker.py のチャンクはファイル上の位置も）
+MANIFEST_FILE = "manifest.json"     # 埋め込みモデル・次元・dtype・件数
+DEFAULT_MODEL_NAME = "infly/inf-retriever-v1-1.5b"
+
+
+def content_hash(text):
+    """チャンクの内容のハッシュ（同じテキストは再び埋め込まない）"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iter_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class EmbeddingIndex:
+    """ディスク上の埋め込み索引（埋め込みはメモリマップで開くため、全体をメモリに読み込まない）
+
+    Args:
+        index_dir: build() で作成した索引のディレクトリ
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, MANIFEST_FILE), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.embeddings = np.load(os.path.join(index_dir, EMBEDDINGS_FILE), mmap_mode="r")
+        self.chunk_ids, self.hashes, self.texts, self.metadata = [], [], [], []
+        for chunk in _iter_jsonl(os.path.join(index_dir, CHUNKS_FILE)):
+            self.chunk_ids.append(chunk.pop("id"))
+            self.hashes.append(chunk.pop("hash"))
+            self.texts.append(chunk.pop("text"))
+            self.metadata.append(chunk)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @property
+    def model_name(self):
+        return self.manifest["model_name"]
+
+    def digest(self):
+        """埋め込みの内容を表すハッシュ（モデル・次元・dtypeと、全チャンクの内容のハッシュから作る）
+
+        索引から作った検索用の構造（IVFのクラスタ・HNSWのグラフ）が古くなっていないかの確認に使う。
+        件数が同じでもチャンクの内容が変われば値が変わる。作成日時は含めないため、内容が同じまま
+        作り直した場合は変わらない。
+        """
+        header = json.dumps([self.manifest[key] for key in ("model_name", "dim", "dtype", "count")])
+        return hashlib.sha256("\n".join([header, *self.hashes]).encode("utf-8")).hexdigest()
+
+    def window_text(self, row):
+        """チャンクの前後の文を含めた近傍ウィンドウのテキスト（位置の情報がないチャンクはチャンク自体）"""
+        meta = self.metadata[row]
+        if "window_start" not in meta:
+            return self.texts[row]
+        return read_span(meta["source"], meta["window_start"], meta["window_end"])
+
+    def similarities(self, query_embeddings, block_size=65536):
+        """クエリの埋め込み（クエリ数 x 次元）と全チャンクの内積（クエリ数 x チャンク数）
+
+        埋め込みは block_size 行ずつfloat32に変換して計算するため、索引全体を一度にメモリへ読み込まない。
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        scores = np.empty((queries.shape[0], len(self)), dtype=np.float32)
+        for start in range(0, len(self), block_size):
+            block = np.asarray(self.embeddings[start:start + block_size], dtype=np.float32)
+            scores[:, start:start + block.shape[0]] = queries @ block.T
+        return scores
+
+    @classmethod
+    def build(cls, index_dir, chunks, encoder, model_name=DEFAULT_MODEL_NAME, dtype="float16", batch_size=32,
+              progress=None):
+        """チャンクを埋め込んで索引を作成する（既存の索引があれば、内容が同じチャンクの埋め込みを再利用する）
+
+        チャンクはまず一時ファイルに書き出し、2回目の読み出しで埋め込むため、全チャンクをメモリに載せない。
+        埋め込みモデルが既存の索引と異なる場合は全て埋め込み直す。
+
+        Args:
+            chunks: chunker.Chunk または (チャンクID, テキスト) の反復可能オブジェクト（ジェネレータでもよい）
+            encoder: encode(テキストのリスト) で埋め込みの配列を返すモデル（SentenceTransformerなど）
+            dtype: 保存する埋め込みのdtype（"float16" はfloat32の半分のサイズ）
+            progress: progress(処理済み件数, 全件数) の形で進捗を受け取る関数
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        previous = None
+        if os.path.exists(os.path.join(index_dir, MANIFEST_FILE)):
+            previous = cls(index_dir)
+            if previous.model_name != model_name:
+                previous = None
+        previous_rows = {chunk_hash: row for row, chunk_hash in enumerate(previous.hashes)} if previous else {}
+
+        chunks_path = os.path.join(index_dir, CHUNKS_FILE + ".tmp")
+        embeddings_path = os.path.join(index_dir, EMBEDDINGS_FILE + ".tmp.npy")
+        total = 0
+        with open(chunks_path, "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                if isinstance(chunk, Chunk):
+                    record = {"id": chunk.chunk_id, "hash": content_hash(chunk.text), "text": chunk.text,
+                              **chunk.metadata()}
+                else:
+                    chunk_id, text = chunk
+                    record = {"id": chunk_id, "hash": content_hash(text), "text": text}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                total += 1
+
+        embeddings = None  # 次元が決まった時点（最初の埋め込み・再利用）で作成する
+        built_rows = {}    # 今回の索引で既に書き込んだハッシュ -> 行（重複したチャンクは1回だけ埋め込む）
+        embedded = reused = 0
+        row = 0
+        for batch in _iter_batches(_iter_jsonl(chunks_path), batch_size):
+            to_embed = [chunk for chunk in batch
+                        if chunk["hash"] not in previous_rows and chunk["hash"] not in built_rows]
+            vectors = {}
+            if to_embed:
+                encoded = np.asarray(encoder.encode([chunk["text"] for chunk in to_embed]), dtype=np.float32)
+                vectors = {chunk["hash"]: vector for chunk, vector in zip(to_embed, encoded)}
+                embedded += len(to_embed)
+            for chunk in batch:
+                chunk_hash = chunk["hash"]
+                if chunk_hash in vectors:
+                    vector = vectors[chunk_hash]
+                elif chunk_hash in built_rows:
+                    vector = embeddings[built_rows[chunk_hash]]
+                else:
+                    vector = previous.embeddings[previous_rows[chunk_hash]]
+                    reused += 1
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(
+                        embeddings_path, mode="w+", dtype=dtype, shape=(total, vector.shape[-1])
+                    )
+                embeddings[row] = vector
+                built_rows.setdefault(chunk_hash, row)
+                row += 1
+            if progress is not None:
+                progress(row, total)
+        if embeddings is None:
+            raise ValueError("チャンクが1件もありません")
+        embeddings.flush()
+        dim = embeddings.shape[1]
+        del embeddings
+
+        manifest = {
+            "model_name": model_name,
+            "dim": dim,
+            "dtype": dtype,
+            "count": total,
+            "embedded": embedded,
+            "reused": reused,
+            "updated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        # 埋め込みとチャンクを置き換えてから、最後にマニフェストを書き換える
+        os.replace(embeddings_path, os.path.join(index_dir, EMBEDDINGS_FILE))
+        os.replace(chunks_path, os.path.join(index_dir, CHUNKS_FILE))
+        with open(os.path.join(index_dir, MANIFEST_FILE + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(os.path.join(index_dir, MANIFEST_FILE + ".tmp"), os.path.join(index_dir, MANIFEST_FILE))
+        return cls(index_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文字起こしのチャンクを埋め込み、検索用の索引を作成・更新します")
+    parser.add_argument("--input", nargs="+", required=True, help="文字起こしのテキストファイル")
+    parser.add_argument("--index-dir", default="index", help="索引を保存するディレクトリ")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME, help="埋め込みモデル")
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=256, help="1チャンクのトークン数の上限")
+    parser.add_argument("--overlap-tokens", type=int, default=32, help="前のチャンクと重ねるトークン数の上限")
+    parser.add_argument("--window-sentences", type=int, default=2, help="近傍ウィンドウに含める前後の文の数")
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+    encoder = SentenceTransformer(args.model, trust_remote_code=True)
+    count_tokens = tokenizer_counter(encoder.tokenizer)
+
+    def iter_all_chunks():
+        for path in args.input:
+            yield from iter_chunks(path, max_tokens=args.max_tokens, overlap_tokens=args.overlap_tokens,
+                                   window_sentences=args.window_sentences, count_tokens=count_tokens)
+
+    start_time = time.time()
+    index = EmbeddingIndex.build(
+        args.index_dir, iter_all_chunks(), encoder, model_name=args.model, dtype=args.dtype, batch_size=args.batch_size,
+        progress=lambda done, total: print(f"{done}/{total} 件（{time.time() - start_time:.1f}s）"),
+    )
+    manifest = index.manifest
+    print(f"完了: {manifest['count']} 件（新たに埋め込み {manifest['embedded']} 件、再利用 {manifest['reused']} 件）")
+
+
+if __name__ == "__main__":
+    main()
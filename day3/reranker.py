@@ -0,0 +1,234 @@
+# reranker.py
+# 検索で取得した参考資料が質問に関連しているかを、候補ごとに generate せずにまとめて判定するリランカー。
+# LLMの場合は「yes」「no」の次トークンのロジットを1回のフォワードで読み取り、その差を関連度にする。
+# クロスエンコーダー（質問と資料の組を分類するモデル）も同じインターフェースで使える。
+# スコアはPlattスケーリング（ロジスティック回帰）で較正した「関連している確率」として返す。
+#
+# 使い方:
+#   from reranker import LLMReranker
+#   reranker = LLMReranker(model, tokenizer)
+#   ranked = reranker.rerank(question, [hit["window"] for hit in hits])  # [(候補の位置, スコア), ...]
+#   references = reranker.filter(question, passages, threshold=0.5)     # ノートブックの yes/no の判定に相当
+import json
+
+import numpy as np
+import torch
+
+# ノートブックの判定と同じ指示文
+DEFAULT_SYSTEM_PROMPT = "与えられた参考資料が質問に直接関連しているか？'yes''no'で答えること。ただし、余計なテキストを生成しないこと。"
+DEFAULT_CROSS_ENCODER = "hotchpotch/japanese-reranker-cross-encoder-xsmall-v1"
+
+
+def _sigmoid(x):
+    return np.exp(-np.logaddexp(0.0, -x))  # 1 / (1 + exp(-x)) を、大きな負の値でもオーバーフローさせずに計算する
+
+
+def _platt_loss(a, b, x, y, l2):
+    """sigmoid(a * x + b) の負の対数尤度（a の L2 正則化付き）"""
+    z = a * x + b
+    return np.sum(np.logaddexp(0.0, z) - y * z) + 0.5 * l2 * a * a
+
+
+def fit_platt(margins, labels, iterations=100, l2=1e-3):
+    """関連度（ロジットの差）と正解ラベル（1/0）から、sigmoid(a * margin + b) の a, b をニュートン法で求める
+
+    関連度の幅が大きいとニュートン法の1歩が行き過ぎて発散するため、損失が十分に下がるまで歩幅を半分にする
+    （Lin, Lin, Weng によるPlattの方法の改良と同じ）。
+    """
+    x = np.asarray(margins, dtype=np.float64)
+    y = np.asarray(labels, dtype=np.float64)
+    # 過学習を抑えるため、Plattの方法と同じく目標値を少し0・1から離す
+    positives, negatives = y.sum(), len(y) - y.sum()
+    y = np.where(y > 0.5, (positives + 1) / (positives + 2), 1 / (negatives + 2))
+    a, b = 0.0, float(np.log((positives + 1) / (negatives + 1)))  # 関連度を使わない場合の最適値から始める
+    loss = _platt_loss(a, b, x, y, l2)
+    for _ in range(iterations):
+        p = _sigmoid(a * x + b)
+        w = p * (1 - p)
+        gradient = np.array([np.sum((p - y) * x) + l2 * a, np.sum(p - y)])
+        hessian = np.array([[np.sum(w * x * x) + l2, np.sum(w * x)], [np.sum(w * x), np.sum(w) + 1e-12]])
+        step = np.linalg.solve(hessian, gradient)
+        decrease = gradient @ step
+        scale = 1.0
+        while scale >= 1e-10:
+            new_a, new_b = a - scale * step[0], b - scale * step[1]
+            new_loss = _platt_loss(new_a, new_b, x, y, l2)
+            if new_loss <= loss - 1e-4 * scale * decrease:
+                break
+            scale /= 2
+        else:
+            break  # 損失が下がる歩幅が見つからない（収束している）
+        a, b, loss = new_a, new_b, new_loss
+        if np.abs(scale * step).max() < 1e-8:
+            break
+    return float(a), float(b)
+
+
+class _Reranker:
+    """関連度（margins）の計算をサブクラスに任せ、較正・並び替え・絞り込みを共通で行う"""
+
+    def __init__(self, batch_size=8):
+        self.batch_size = batch_size
+        self.scale, self.bias = 1.0, 0.0
+
+    def margins(self, question, passages):
+        """候補ごとの関連度（較正前の実数。大きいほど関連している）"""
+        raise NotImplementedError
+
+    def _batches(self, passages):
+        """パディングが少なくなるよう長さ順に並べたバッチ（候補の位置のリスト）"""
+        order = sorted(range(len(passages)), key=lambda i: len(passages[i]))
+        for start in range(0, len(order), self.batch_size):
+            yield order[start:start + self.batch_size]
+
+    def scores(self, question, passages):
+        """候補ごとの、較正済みの関連している確率"""
+        if not passages:
+            return np.empty(0)
+        return _sigmoid(self.scale * self.margins(question, passages) + self.bias)
+
+    def rerank(self, question, passages, top_n=None):
+        """候補を関連している確率の高い順に並べた (候補の位置, スコア) のリスト"""
+        scores = self.scores(question, passages)
+        order = np.argsort(-scores, kind="stable")[:top_n]
+        return [(int(i), float(scores[i])) for i in order]
+
+    def filter(self, question, passages, threshold=0.5):
+        """関連している確率が threshold 以上の候補を、元の順序のまま返す"""
+        scores = self.scores(question, passages)
+        return [passage for passage, score in zip(passages, scores) if score >= threshold]
+
+    def calibrate(self, examples):
+        """(質問, 資料, 関連しているか) の例から、スコアを確率に変換する係数を学習する"""
+        by_question = {}
+        for question, passage, label in examples:
+            by_question.setdefault(question, []).append((passage, 1.0 if label else 0.0))
+        margins, labels = [], []
+        for question, pairs in by_question.items():  # 同じ質問の資料はまとめて判定する
+            margins.extend(self.margins(question, [passage for passage, _ in pairs]))
+            labels.extend(label for _, label in pairs)
+        self.scale, self.bias = fit_platt(margins, labels)
+        return self.scale, self.bias
+
+    def save_calibration(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"scale": self.scale, "bias": self.bias}, f)
+
+    def load_calibration(self, path):
+        with open(path, encoding="utf-8") as f:
+            calibration = json.load(f)
+        self.scale, self.bias = calibration["scale"], calibration["bias"]
+
+
+class LLMReranker(_Reranker):
+    """チャット形式のLLMで、全候補の「yes」「no」の次トークンのロジットを1回のフォワードで読み取る
+
+    関連度は yes と no の対数確率の差（表記ゆれの "Yes" などは1トークンになるものをまとめる）で、
+    較正前でも sigmoid を通すと「yes と no のうち yes を選ぶ確率」になる。
+
+    Args:
+        system_prompt: 判定の指示文（systemロールに対応しないテンプレートではユーザー発話の先頭に置く）
+        batch_size: 1回のフォワードで判定する候補数の上限（メモリに合わせて調整する）
+        max_passage_tokens: 資料をこのトークン数で切り詰める（Noneの場合は切り詰めない）
+    """
+
+    def __init__(self, model, tokenizer, system_prompt=DEFAULT_SYSTEM_PROMPT, yes_words=("yes", "Yes", "YES"),
+                 no_words=("no", "No", "NO"), batch_size=8, max_passage_tokens=None):
+        super().__init__(batch_size)
+        self.model = model
+        self.tokenizer = tokenizer
+        self.system_prompt = system_prompt
+        self.max_passage_tokens = max_passage_tokens
+        self.yes_ids = self._single_token_ids(yes_words)
+        self.no_ids = self._single_token_ids(no_words)
+        if not self.yes_ids or not self.no_ids:
+            raise ValueError("yes/no を1トークンで表せないトークナイザーです")
+
+    def _single_token_ids(self, words):
+        ids = set()
+        for word in words:
+            token_ids = self.tokenizer.encode(word, add_special_tokens=False)
+            if len(token_ids) == 1:
+                ids.add(token_ids[0])
+        return sorted(ids)
+
+    def _truncate(self, passage):
+        if self.max_passage_tokens is None:
+            return passage
+        token_ids = self.tokenizer.encode(passage, add_special_tokens=False)
+        if len(token_ids) <= self.max_passage_tokens:
+            return passage
+        return self.tokenizer.decode(token_ids[:self.max_passage_tokens])
+
+    def build_prompt(self, question, passage):
+        """ノートブックと同じ形式の判定用プロンプト（生成開始の位置まで）"""
+        user_content = f"[参考資料]\n{self._truncate(passage)}\n\n[質問] {question}"
+        messages = [{"role": "system", "content": self.system_prompt}, {"role": "user", "content": user_content}]
+        try:
+            return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        except Exception:
+            # Gemmaなど、systemロールに対応しないテンプレートの場合
+            messages = [{"role": "user", "content": f"{self.system_prompt}\n\n{user_content}"}]
+            return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    def margins(self, question, passages):
+        margins = np.empty(len(passages), dtype=np.float64)
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"  # 最後の位置が全候補で生成開始の位置になるよう左側をパディング
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        try:
+            for batch in self._batches(passages):
+                prompts = [self.build_prompt(question, passages[i]) for i in batch]
+                inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False)
+                inputs = inputs.to(self.model.device)
+                with torch.no_grad():
+                    logits = self.model(**inputs).logits[:, -1, :].float()
+                log_probs = torch.log_softmax(logits, dim=-1)
+                yes = torch.logsumexp(log_probs[:, self.yes_ids], dim=-1)
+                no = torch.logsumexp(log_probs[:, self.no_ids], dim=-1)
+                margins[batch] = (yes - no).cpu().numpy()
+        finally:
+            self.tokenizer.padding_side = padding_side
+        return margins
+
+
+class CrossEncoderReranker(_Reranker):
+    """質問と資料の組を1つの入力として分類するクロスエンコーダー（transformersの系列分類モデル）
+
+    出力が1つのモデルはそのロジット、2つのモデルは「関連あり」と「関連なし」のロジットの差を関連度にする。
+    """
+
+    def __init__(self, model_name=DEFAULT_CROSS_ENCODER, batch_size=32, max_length=512, device=None):
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        super().__init__(batch_size)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).to(self.device).eval()
+        self.max_length = max_length
+
+    def margins(self, question, passages):
+        margins = np.empty(len(passages), dtype=np.float64)
+        for batch in self._batches(passages):
+            inputs = self.tokenizer(
+                [question] * len(batch), [passages[i] for i in batch],
+                return_tensors="pt", padding=True, truncation="only_second", max_length=self.max_length,
+            ).to(self.device)
+            with torch.no_grad():
+                logits = self.model(**inputs).logits.float()
+            batch_margins = logits[:, 0] if logits.shape[-1] == 1 else logits[:, 1] - logits[:, 0]
+            margins[batch] = batch_margins.cpu().numpy()
+        return margins
+
+
+def expected_calibration_error(scores, labels, bins=10):
+    """較正の確認用: スコアの区間ごとの「平均スコア」と「実際に関連していた割合」の差の加重平均"""
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.float64)
+    bin_ids = np.minimum((scores * bins).astype(np.int64), bins - 1)
+    error = 0.0
+    for bin_id in np.unique(bin_ids):
+        in_bin = bin_ids == bin_id
+        error += in_bin.mean() * abs(scores[in_bin].mean() - labels[in_bin].mean())
+    return float(error)
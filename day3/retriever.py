@@ -0,0 +1,362 @@
+# retriever.py
+# 埋め込み索引（embedding_index.py）に対する上位k件の検索。
+# 全件のスコアを並び替えずに argpartition で上位k件だけを取り出し、複数の質問はまとめて1回の行列積で計算する。
+# 件数が増えた場合に備えて、近似最近傍探索（IVF・HNSW）のバックエンドも同じインターフェースで切り替えられる。
+#
+# 使い方:
+#   from embedding_index import EmbeddingIndex
+#   from retriever import HybridRetriever, Retriever
+#   retriever = Retriever(EmbeddingIndex("index"), backend="exact")  # "ivf" / "hnsw"
+#   results = retriever.search_text(emb_model, ["LLMにおけるInference Time Scalingとは？"], top_k=5)
+#
+#   # BM25（語の完全一致）と組み合わせる場合。first_stage を指定するとBM25の候補だけを埋め込みで採点する
+#   hybrid = HybridRetriever(EmbeddingIndex("index"), first_stage=200)
+#   results = hybrid.search_text(emb_model, ["CerebrasGPTとは？"], top_k=5)
+import json
+import os
+
+import numpy as np
+
+IVF_FILE = "ivf.npz"
+HNSW_FILE = "hnsw.bin"
+HNSW_META_FILE = "hnsw.json"  # グラフを作成したときの索引の digest() と件数
+
+
+def top_k(scores, k):
+    """各行のスコアの上位k件の (列の位置, スコア) を降順で返す
+
+    argpartition で上位k件を O(n) で取り出してから、そのk件だけを並び替える。
+    """
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(scores.dtype)
+    if k < scores.shape[1]:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(k), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, indices, axis=1), axis=1)
+    indices = np.take_along_axis(indices, order, axis=1)
+    return indices, np.take_along_axis(scores, indices, axis=1)
+
+
+def _merge_top_k(indices, scores, new_indices, new_scores, k):
+    """2つの上位k件の候補を合わせて、上位k件を取り直す"""
+    merged_indices = np.concatenate([indices, new_indices], axis=1)
+    positions, merged_scores = top_k(np.concatenate([scores, new_scores], axis=1), k)
+    return np.take_along_axis(merged_indices, positions, axis=1), merged_scores
+
+
+def _index_digest(index):
+    """索引の内容のハッシュ（digest() を持たない索引、例えばベンチマークの乱数の索引では None）"""
+    return index.digest() if hasattr(index, "digest") else None
+
+
+def _is_current(saved_digest, index):
+    """保存済みの構造が現在の索引から作ったものか（どちらかのハッシュが無い場合は古いものとみなす）"""
+    digest = _index_digest(index)
+    return bool(saved_digest) and digest is not None and saved_digest == digest
+
+
+class ExactSearch:
+    """全チャンクとの内積による厳密な検索
+
+    埋め込みを block_size 行ずつ読み出し、ブロックごとの上位k件を合わせていくため、
+    スコアの行列（クエリ数 x チャンク数）全体を作らない。
+    """
+
+    name = "exact"
+
+    def __init__(self, index, block_size=65536):
+        self.index = index
+        self.block_size = block_size
+
+    def search(self, queries, k):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        embeddings = self.index.embeddings
+        indices = np.empty((queries.shape[0], 0), dtype=np.int64)
+        scores = np.empty((queries.shape[0], 0), dtype=np.float32)
+        for start in range(0, embeddings.shape[0], self.block_size):
+            block = np.asarray(embeddings[start:start + self.block_size], dtype=np.float32)
+            block_indices, block_scores = top_k(queries @ block.T, k)
+            indices, scores = _merge_top_k(indices, scores, block_indices + start, block_scores, k)
+        return indices, scores
+
+
+class IVFSearch:
+    """転置ファイル（IVF）による近似検索
+
+    埋め込みを k-means で n_lists 個のクラスタ（リスト）に分けておき、検索時はクエリとの内積が大きい
+    n_probe 個のクラスタに属するチャンクだけをスコア計算する。クラスタの割り当ては ivf.npz に保存する。
+    """
+
+    name = "ivf"
+
+    def __init__(self, index, centroids, list_offsets, list_rows, n_probe=8, digest=None):
+        self.index = index
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.n_probe = n_probe
+        self.digest = digest
+
+    @classmethod
+    def build(cls, index, n_lists=None, iterations=10, sample_size=65536, block_size=65536, seed=0, n_probe=8):
+        """k-means（内積で割り当てる球面k-means）でクラスタを学習し、全チャンクを割り当てる
+
+        n_lists を省略した場合は件数の平方根を目安にする。学習は最大 sample_size 件の標本で行う。
+        """
+        embeddings = index.embeddings
+        count = embeddings.shape[0]
+        n_lists = min(n_lists or max(1, int(np.sqrt(count))), count)
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(count, size=min(sample_size, count), replace=False))
+        sample = np.asarray(embeddings[sample_rows], dtype=np.float32)
+        n_lists = min(n_lists, sample.shape[0])
+        centroids = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(n_lists):
+                members = sample[assignment == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+
+        assignment = np.empty(count, dtype=np.int64)
+        for start in range(0, count, block_size):
+            block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+            assignment[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+        # 同じクラスタの行が連続するよう並べ、クラスタごとの開始位置を記録する
+        list_rows = np.argsort(assignment, kind="stable")
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        digest = _index_digest(index)
+        np.savez(os.path.join(index.index_dir, IVF_FILE), centroids=centroids, list_offsets=list_offsets,
+                 list_rows=list_rows, digest=np.array(digest or ""))
+        return cls(index, centroids, list_offsets, list_rows, n_probe=n_probe, digest=digest)
+
+    @classmethod
+    def load(cls, index, n_probe=8):
+        data = np.load(os.path.join(index.index_dir, IVF_FILE))
+        digest = str(data["digest"]) if "digest" in data.files else None
+        return cls(index, data["centroids"], data["list_offsets"], data["list_rows"], n_probe=n_probe, digest=digest)
+
+    @classmethod
+    def load_or_build(cls, index, n_probe=8, **build_options):
+        """保存済みのクラスタが現在の索引から作ったものであれば読み込み、そうでなければ作り直す
+
+        件数が同じでもチャンクの内容が変わっていれば（索引の digest() が異なれば）作り直す。
+        """
+        if os.path.exists(os.path.join(index.index_dir, IVF_FILE)):
+            loaded = cls.load(index, n_probe=n_probe)
+            if len(loaded.list_rows) == len(index) and _is_current(loaded.digest, index):
+                return loaded
+        return cls.build(index, n_probe=n_probe, **build_options)
+
+    def search(self, queries, k):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_probe = min(self.n_probe, self.centroids.shape[0])
+        probes, _ = top_k(queries @ self.centroids.T, n_probe)
+        indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            # メモリマップを前から順に読むよう、候補の行は昇順に並べる
+            rows = np.sort(np.concatenate([
+                self.list_rows[self.list_offsets[cluster]:self.list_offsets[cluster + 1]] for cluster in probes[i]
+            ]))
+            if len(rows) == 0:
+                continue
+            candidate_scores = np.asarray(self.index.embeddings[rows], dtype=np.float32) @ query
+            positions, best = top_k(candidate_scores, k)
+            indices[i, :positions.shape[1]] = rows[positions[0]]
+            scores[i, :positions.shape[1]] = best[0]
+        return indices, scores
+
+
+class HNSWSearch:
+    """階層的なグラフ（HNSW、hnswlibを使用）による近似検索。グラフは hnsw.bin に保存する"""
+
+    name = "hnsw"
+
+    def __init__(self, index, graph, ef=64):
+        self.index = index
+        self.graph = graph
+        self.graph.set_ef(ef)
+
+    @staticmethod
+    def _new_graph(dim):
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError("HNSWバックエンドには hnswlib が必要です（pip install hnswlib）") from e
+        return hnswlib.Index(space="ip", dim=dim)
+
+    @classmethod
+    def build(cls, index, m=16, ef_construction=200, block_size=65536, ef=64):
+        embeddings = index.embeddings
+        graph = cls._new_graph(embeddings.shape[1])
+        graph.init_index(max_elements=embeddings.shape[0], ef_construction=ef_construction, M=m)
+        for start in range(0, embeddings.shape[0], block_size):
+            block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+            graph.add_items(block, np.arange(start, start + block.shape[0]))
+        graph.save_index(os.path.join(index.index_dir, HNSW_FILE))
+        with open(os.path.join(index.index_dir, HNSW_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"digest": _index_digest(index), "count": embeddings.shape[0]}, f)
+        return cls(index, graph, ef=ef)
+
+    @classmethod
+    def load_or_build(cls, index, ef=64, **build_options):
+        """保存済みのグラフが現在の索引から作ったものであれば読み込み、そうでなければ作り直す
+
+        件数が同じでもチャンクの内容が変わっていれば（索引の digest() が異なれば）作り直す。
+        """
+        path = os.path.join(index.index_dir, HNSW_FILE)
+        meta_path = os.path.join(index.index_dir, HNSW_META_FILE)
+        if os.path.exists(path) and os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["count"] == len(index) and _is_current(meta["digest"], index):
+                graph = cls._new_graph(index.embeddings.shape[1])
+                graph.load_index(path, max_elements=len(index))
+                return cls(index, graph, ef=ef)
+        return cls.build(index, ef=ef, **build_options)
+
+    def search(self, queries, k):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, len(self.index))
+        labels, distances = self.graph.knn_query(queries, k=k)
+        return labels.astype(np.int64), (1.0 - distances).astype(np.float32)  # 内積の距離は 1 - 内積
+
+
+BACKENDS = {
+    "exact": lambda index, **options: ExactSearch(index, **options),
+    "ivf": lambda index, **options: IVFSearch.load_or_build(index, **options),
+    "hnsw": lambda index, **options: HNSWSearch.load_or_build(index, **options),
+}
+
+
+class Retriever:
+    """埋め込み索引に対する検索（バックエンドを切り替えても同じ形の結果を返す）
+
+    Args:
+        index: EmbeddingIndex
+        backend: "exact"（厳密）/ "ivf" / "hnsw"（近似。初回は索引のディレクトリにクラスタ・グラフを作成する）
+        backend_options: バックエンドの設定（ivf の n_probe・n_lists、hnsw の ef・m など）
+    """
+
+    def __init__(self, index, backend="exact", **backend_options):
+        if backend not in BACKENDS:
+            raise ValueError(f"未対応のバックエンドです: {backend}（{', '.join(BACKENDS)} から選択）")
+        self.index = index
+        self.backend = BACKENDS[backend](index, **backend_options)
+
+    def search(self, query_embeddings, top_k=5, with_window=False):
+        """クエリの埋め込みごとに、上位 top_k 件の {"row", "id", "text", "score"} のリストを返す
+
+        with_window=True の場合は、前後の文を含めた近傍ウィンドウのテキストも "window" に入れる。
+        """
+        indices, scores = self.backend.search(query_embeddings, top_k)
+        results = []
+        for row_indices, row_scores in zip(indices, scores):
+            hits = []
+            for row, score in zip(row_indices, row_scores):
+                if row < 0:
+                    continue
+                hits.append(self._hit(row, score, with_window))
+            results.append(hits)
+        return results
+
+    def _hit(self, row, score, with_window):
+        hit = {"row": int(row), "id": self.index.chunk_ids[row], "text": self.index.texts[row], "score": float(score)}
+        if with_window:
+            hit["window"] = self.index.window_text(row)
+        return hit
+
+    def search_text(self, encoder, questions, top_k=5, with_window=False):
+        """質問文を埋め込んで検索する（SentenceTransformerのクエリ用プロンプトを使う）"""
+        return self.search(encoder.encode(list(questions), prompt_name="query"), top_k=top_k, with_window=with_window)
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """複数の順位付け（行のリスト。-1 は無視）を Reciprocal Rank Fusion で1つにまとめる
+
+    各順位付けで r 位（1始まり）の行に 1 / (k + r) を足す。スコアの尺度が異なる検索（BM25と内積）を
+    正規化せずに組み合わせられる。戻り値は {行: スコア}。
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            if row >= 0:
+                fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (k + rank)
+    return fused
+
+
+class HybridRetriever(Retriever):
+    """BM25（bm25_index.py）と埋め込みの検索を Reciprocal Rank Fusion で組み合わせる検索
+
+    既定では、それぞれの検索の上位 depth 件の順位を融合する。first_stage を指定した場合は、
+    BM25の上位 first_stage 件だけを埋め込みで採点する（全チャンクとの内積を計算しない）。
+    質問の語がどのチャンクにも一致しない場合は、埋め込みの検索だけを使う。
+
+    Args:
+        depth: 融合する各検索の候補数（top_k より小さい場合は top_k）
+        rrf_k: RRFの定数（大きいほど下位の候補の寄与が相対的に大きくなる）
+        first_stage: BM25で絞り込む候補数（None の場合は絞り込まない）
+        backend, backend_options: 埋め込みの検索のバックエンド（Retriever と同じ）
+    """
+
+    def __init__(self, index, backend="exact", depth=50, rrf_k=60, first_stage=None, bm25=None, **backend_options):
+        super().__init__(index, backend=backend, **backend_options)
+        if bm25 is None:
+            from bm25_index import BM25Index
+            bm25 = BM25Index.load_or_build(index)
+        self.bm25 = bm25
+        self.depth = depth
+        self.rrf_k = rrf_k
+        self.first_stage = first_stage
+
+    def _dense_candidates(self, rows, query, k):
+        """BM25で絞り込んだ行だけを埋め込みで採点し、上位k件の行を返す"""
+        rows = np.sort(rows[rows >= 0])
+        candidate_scores = np.asarray(self.index.embeddings[rows], dtype=np.float32) @ query
+        positions, _ = top_k(candidate_scores, k)
+        return rows[positions[0]]
+
+    def hybrid_search(self, questions, query_embeddings, top_k=5, with_window=False):
+        """質問文と、その埋め込みごとに、上位 top_k 件の {"row", "id", "text", "score"} のリストを返す
+
+        "score" はRRFのスコアで、それぞれの検索での順位（1始まり。候補に入らなかった場合は None）を
+        "bm25_rank"・"dense_rank" に入れる。
+        """
+        questions = list(questions)
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        depth = max(self.depth, top_k)
+        sparse_rows, _ = self.bm25.search(questions, self.first_stage or depth)
+        if self.first_stage is None:
+            dense_rows, _ = self.backend.search(queries, depth)
+        results = []
+        for i, query in enumerate(queries):
+            if self.first_stage is not None and (sparse_rows[i] >= 0).any():
+                dense = self._dense_candidates(sparse_rows[i], query, depth)
+            elif self.first_stage is not None:
+                dense = self.backend.search(query[None, :], depth)[0][0]
+            else:
+                dense = dense_rows[i]
+            sparse = sparse_rows[i][:depth]
+            fused = reciprocal_rank_fusion([sparse, dense], k=self.rrf_k)
+            sparse_ranks = {int(row): rank for rank, row in enumerate(sparse, start=1) if row >= 0}
+            dense_ranks = {int(row): rank for rank, row in enumerate(dense, start=1) if row >= 0}
+            hits = []
+            for row, score in sorted(fused.items(), key=lambda item: -item[1])[:top_k]:
+                hit = self._hit(row, score, with_window)
+                hit["bm25_rank"] = sparse_ranks.get(row)
+                hit["dense_rank"] = dense_ranks.get(row)
+                hits.append(hit)
+            results.append(hits)
+        return results
+
+    def search_text(self, encoder, questions, top_k=5, with_window=False):
+        """質問文を埋め込み、BM25と組み合わせて検索する"""
+        questions = list(questions)
+        return self.hybrid_search(questions, encoder.encode(questions, prompt_name="query"), top_k=top_k,
+                                  with_window=with_window)
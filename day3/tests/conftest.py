@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# テストから day3 のモジュール（chunker.py など）を import できるようにする
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from embedding_index import EmbeddingIndex, content_hash  # noqa: E402
+
+
+class FakeEncoder:
+    """埋め込みモデルの代わり: テキストのハッシュから決まる単位ベクトルを返し、埋め込んだ件数を数える
+
+    クエリ（prompt_name="query"）は、同じテキストのチャンクの埋め込みと同じベクトルになる。
+    """
+
+    def __init__(self, dim=16, clusters=None, noise=0.3):
+        self.dim = dim
+        self.encoded = 0
+        rng = np.random.default_rng(0)
+        # clusters を指定すると、いくつかの中心の周りに集まった埋め込みにする（近似検索の再現率の確認用）
+        self.centers = rng.standard_normal((clusters, dim)) if clusters else None
+        self.noise = noise
+
+    def _vector(self, text):
+        seed = int(content_hash(text)[:16], 16)
+        rng = np.random.default_rng(seed)
+        vector = rng.standard_normal(self.dim)
+        if self.centers is not None:
+            vector = self.centers[seed % len(self.centers)] + self.noise * vector
+        return vector / np.linalg.norm(vector)
+
+    def encode(self, texts, prompt_name=None):
+        if prompt_name is None:
+            self.encoded += len(texts)
+        return np.array([self._vector(text) for text in texts], dtype=np.float32)
+
+
+@pytest.fixture
+def encoder():
+    return FakeEncoder()
+
+
+@pytest.fixture
+def make_encoder():
+    """設定を指定して FakeEncoder を作る関数"""
+    return FakeEncoder
+
+
+@pytest.fixture
+def build_index(tmp_path):
+    """(チャンクID, テキスト) のリストから索引を作る関数（同じ index_dir で呼ぶと作り直しになる）"""
+    def build(texts, encoder, index_dir=None, **options):
+        index_dir = str(index_dir or tmp_path / "index")
+        chunks = [(f"chunk-{i}", text) for i, text in enumerate(texts)]
+        return EmbeddingIndex.build(index_dir, chunks, encoder, model_name="fake-model", dtype="float32", **options)
+    return build
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("janome")
+
+from bm25_index import BM25_FILE, BM25Index, corpus_digest, tokenize  # noqa: E402
+from retriever import HybridRetriever  # noqa: E402
+
+TEXTS = [
+    "大規模言語モデルは大量のテキストで事前学習される。",
+    "CerebrasGPTは111Mから13Bのパラメータのモデルを公開した。",
+    "Llamaのモデルは公開されている。",
+    "推論時の計算量を増やす手法が注目されている。",
+]
+
+
+def test_tokenize_normalizes_and_drops_particles():
+    terms = tokenize("ＣｅｒｅｂｒａｓＧＰＴのパラメータは？")
+    assert "cerebrasgpt" in terms
+    assert "の" not in terms and "？" not in terms
+
+
+def test_search_ranks_exact_term_matches_and_pads_with_minus_one(encoder, build_index):
+    index = build_index(TEXTS, encoder)
+    bm25 = BM25Index.build(index)
+    rows, scores = bm25.search(["CerebrasGPTのパラメータ数は？", "量子コンピュータ"], k=3)
+    assert rows[0, 0] == 1
+    assert (np.diff(scores[0][rows[0] >= 0]) <= 0).all()
+    assert rows[1].tolist() == [-1, -1, -1]  # 一致する語がない質問
+    # 保存したファイルから読み込んでも同じスコアになる
+    loaded_rows, loaded_scores = BM25Index.load(index.index_dir).search(["CerebrasGPTのパラメータ数は？"], k=3)
+    np.testing.assert_array_equal(loaded_rows[0], rows[0])
+    np.testing.assert_allclose(loaded_scores[0], scores[0])
+
+
+def test_load_or_build_reuses_only_an_index_with_the_same_digest(encoder, build_index):
+    index = build_index(TEXTS, encoder)
+    built = BM25Index.load_or_build(index)
+    assert built.digest == corpus_digest(index)
+    path = os.path.join(index.index_dir, BM25_FILE)
+    mtime = os.path.getmtime(path)
+
+    loaded = BM25Index.load_or_build(build_index(TEXTS, encoder))
+    assert os.path.getmtime(path) == mtime
+    np.testing.assert_allclose(loaded.scores("Llamaのモデル"), built.scores("Llamaのモデル"))
+
+    # 件数が同じでも内容が変われば作り直す
+    changed_texts = TEXTS[:3] + ["Gemmaのモデルも公開されている。"]
+    rebuilt = BM25Index.load_or_build(build_index(changed_texts, encoder))
+    assert rebuilt.digest != built.digest
+    assert rebuilt.search(["Gemma"], k=1)[0][0, 0] == 3
+
+
+def test_hybrid_search_fuses_bm25_and_dense_ranks(encoder, build_index):
+    index = build_index(TEXTS, encoder)
+    hybrid = HybridRetriever(index, depth=4)
+    [hits] = hybrid.search_text(encoder, ["CerebrasGPT"], top_k=4)
+    top = hits[0]
+    assert top["row"] == 1 and top["bm25_rank"] == 1
+    assert [hit["score"] for hit in hits] == sorted((hit["score"] for hit in hits), reverse=True)
+
+    # first_stage を指定すると、BM25の候補だけを埋め込みで採点する
+    narrowed = HybridRetriever(index, depth=4, first_stage=2, bm25=hybrid.bm25)
+    [hits] = narrowed.search_text(encoder, ["CerebrasGPT"], top_k=4)
+    assert {hit["row"] for hit in hits} == {1}
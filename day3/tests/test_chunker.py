@@ -0,0 +1,92 @@
+import re
+
+import pytest
+
+from chunker import iter_chunks, iter_sentences, read_span, read_window
+
+TEXT = (
+    "大規模言語モデル（LLM）は、大量のテキストで事前学習されたモデルです。"
+    "推論時の計算量を増やす Inference Time Scaling が注目されています。\n\n"
+    "CerebrasGPT は 111M から 13B のパラメータのモデルを公開しました。"
+    "  Llama は Meta が公開したモデルです。"
+    "絵文字😀や全角記号（！）を含む文も正しく位置を記録します。\n\n\n"
+    "最後の文には句点がありません"
+)
+
+
+def strip_spaces(text):
+    return re.sub(r"\s", "", text)
+
+
+@pytest.fixture
+def transcript(tmp_path):
+    path = tmp_path / "transcript.txt"
+    path.write_text(TEXT, encoding="utf-8")
+    return str(path)
+
+
+def test_sentence_spans_point_at_the_sentence_bytes(transcript):
+    sentences = list(iter_sentences(transcript))
+    assert len(sentences) == 6
+    for s in sentences:
+        assert read_span(transcript, s.start, s.end) == s.text
+    assert sentences[-1].text == "最後の文には句点がありません"
+
+
+@pytest.mark.parametrize("read_size", [1, 5, 7, 1 << 16])
+def test_chunk_spans_do_not_depend_on_read_size(transcript, read_size):
+    # 読み出し単位が UTF-8 の文字の途中で切れても、位置と内容は変わらない
+    expected = list(iter_chunks(transcript, max_tokens=60, overlap_tokens=20, window_sentences=1))
+    chunks = list(iter_chunks(transcript, max_tokens=60, overlap_tokens=20, window_sentences=1, read_size=read_size))
+    assert chunks == expected
+
+
+def test_chunk_spans_and_windows(transcript):
+    chunks = list(iter_chunks(transcript, max_tokens=60, overlap_tokens=20, window_sentences=1))
+    assert len(chunks) > 2
+    for chunk in chunks:
+        assert chunk.tokens <= 60
+        # チャンクの範囲には、文の間の空白を除いてチャンクのテキストがそのまま入っている
+        assert strip_spaces(read_span(transcript, chunk.start, chunk.end)) == strip_spaces(chunk.text)
+        assert chunk.window_start <= chunk.start < chunk.end <= chunk.window_end
+        assert strip_spaces(chunk.text) in strip_spaces(read_window(chunk))
+    assert [chunk.index for chunk in chunks] == list(range(len(chunks)))
+    assert len({chunk.chunk_id for chunk in chunks}) == len(chunks)
+
+
+def test_overlap_repeats_only_trailing_sentences(tmp_path):
+    path = tmp_path / "uniform.txt"
+    path.write_text("".join(f"文番号{i:02d}。" for i in range(10)), encoding="utf-8")  # 1文6トークン
+    chunks = list(iter_chunks(str(path), max_tokens=18, overlap_tokens=7, window_sentences=0))
+    assert [chunk.text for chunk in chunks[:2]] == ["文番号00。文番号01。文番号02。", "文番号02。文番号03。文番号04。"]
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # 前のチャンクの最後の1文（overlap_tokens 以内）だけを重ねる
+        assert read_span(str(path), chunk.start, previous.end) == previous.text[-6:]
+    assert chunks[-1].text.endswith("文番号09。")
+
+
+def test_long_sentences_are_split_within_max_tokens(tmp_path):
+    path = tmp_path / "long.txt"
+    path.write_text("あ" * 50 + "い" * 45 + "。短い文。", encoding="utf-8")
+    chunks = list(iter_chunks(str(path), max_tokens=30, overlap_tokens=0, window_sentences=0))
+    assert all(chunk.tokens <= 30 for chunk in chunks)
+    assert "".join(chunk.text for chunk in chunks) == "あ" * 50 + "い" * 45 + "。短い文。"
+    for chunk in chunks:
+        assert read_span(str(path), chunk.start, chunk.end) == chunk.text
+
+
+def test_chunk_ids_depend_on_content_not_position(tmp_path):
+    first = tmp_path / "a.txt"
+    second = tmp_path / "b" / "a.txt"
+    second.parent.mkdir()
+    first.write_text("同じ文。同じ文。", encoding="utf-8")
+    second.write_text("\n\n前置き。\n\n同じ文。同じ文。", encoding="utf-8")
+    ids = [chunk.chunk_id for chunk in iter_chunks(str(first), max_tokens=5, overlap_tokens=0)]
+    assert ids[0].startswith("a.txt:") and ids[1] == ids[0] + "-1"  # 同じ内容の2つ目には番号を付ける
+    moved = [chunk.chunk_id for chunk in iter_chunks(str(second), max_tokens=5, overlap_tokens=0)]
+    assert moved[1:] == ids
+
+
+def test_overlap_must_be_smaller_than_max_tokens(transcript):
+    with pytest.raises(ValueError):
+        next(iter_chunks(transcript, max_tokens=10, overlap_tokens=10))
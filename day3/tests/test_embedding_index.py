@@ -0,0 +1,55 @@
+import numpy as np
+
+from chunker import iter_chunks
+from embedding_index import EmbeddingIndex
+
+TEXTS = ["LLMの事前学習について。", "Inference Time Scalingとは。", "CerebrasGPTのパラメータ数。"]
+
+
+def test_rebuild_embeds_only_new_and_changed_chunks(tmp_path, encoder, build_index):
+    index = build_index(TEXTS, encoder)
+    assert encoder.encoded == 3
+    first_embeddings = np.array(index.embeddings)
+
+    texts = [TEXTS[0], "Inference Time Scalingの定義。", TEXTS[2], "新しいチャンク。"]
+    index = build_index(texts, encoder)
+    assert encoder.encoded == 3 + 2
+    assert (index.manifest["embedded"], index.manifest["reused"]) == (2, 2)
+    assert index.texts == texts
+    np.testing.assert_array_equal(index.embeddings[0], first_embeddings[0])
+    np.testing.assert_array_equal(index.embeddings[2], first_embeddings[2])
+    np.testing.assert_allclose(index.embeddings[3], encoder.encode(["新しいチャンク。"], prompt_name="query")[0])
+
+
+def test_duplicate_chunks_are_embedded_once(encoder, build_index):
+    index = build_index([TEXTS[0], TEXTS[1], TEXTS[0]], encoder, batch_size=1)
+    assert encoder.encoded == 2
+    np.testing.assert_array_equal(index.embeddings[0], index.embeddings[2])
+
+
+def test_changing_the_model_embeds_everything_again(tmp_path, encoder, build_index):
+    build_index(TEXTS, encoder)
+    chunks = [(f"chunk-{i}", text) for i, text in enumerate(TEXTS)]
+    index = EmbeddingIndex.build(str(tmp_path / "index"), chunks, encoder, model_name="other-model")
+    assert (index.manifest["embedded"], index.manifest["reused"]) == (3, 0)
+    assert index.embeddings.dtype == np.float16
+
+
+def test_digest_changes_with_content_but_not_with_rebuild(encoder, build_index):
+    digest = build_index(TEXTS, encoder).digest()
+    assert build_index(TEXTS, encoder).digest() == digest
+    assert build_index(list(reversed(TEXTS)), encoder).digest() != digest  # 件数が同じでも内容が違えば変わる
+
+
+def test_similarities_and_window_text(tmp_path, encoder):
+    path = tmp_path / "transcript.txt"
+    path.write_text("".join(f"文番号{i:02d}。" for i in range(6)), encoding="utf-8")
+    chunks = iter_chunks(str(path), max_tokens=12, overlap_tokens=0, window_sentences=1)
+    index = EmbeddingIndex.build(str(tmp_path / "index"), chunks, encoder, dtype="float32")
+    assert index.texts == ["文番号00。文番号01。", "文番号02。文番号03。", "文番号04。文番号05。"]
+    assert index.window_text(1) == "文番号01。文番号02。文番号03。文番号04。"
+
+    queries = encoder.encode(index.texts, prompt_name="query")
+    scores = index.similarities(queries, block_size=2)
+    np.testing.assert_allclose(scores, queries @ np.asarray(index.embeddings).T, rtol=1e-6)
+    assert list(scores.argmax(axis=1)) == [0, 1, 2]
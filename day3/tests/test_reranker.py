@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from reranker import _Reranker, expected_calibration_error, fit_platt  # noqa: E402
+
+
+class LengthReranker(_Reranker):
+    """資料の長さを関連度とする、モデルを使わないリランカー（判定した候補を記録する）"""
+
+    def __init__(self, batch_size=2):
+        super().__init__(batch_size)
+        self.calls = []
+
+    def margins(self, question, passages):
+        self.calls.append((question, len(passages)))
+        return np.array([len(passage) - 5.0 for passage in passages])
+
+
+def test_fit_platt_recovers_the_logistic_parameters():
+    rng = np.random.default_rng(0)
+    margins = rng.uniform(-6, 6, size=5000)
+    labels = rng.random(5000) < 1 / (1 + np.exp(-(0.5 * margins - 1.0)))
+    a, b = fit_platt(margins, labels)
+    assert a == pytest.approx(0.5, abs=0.05)
+    assert b == pytest.approx(-1.0, abs=0.1)
+
+
+def test_fit_platt_stays_finite_on_separable_data():
+    a, b = fit_platt([-2.0, -1.0, 1.0, 2.0], [0, 0, 1, 1])
+    assert np.isfinite(a) and np.isfinite(b) and a > 0
+    probabilities = 1 / (1 + np.exp(-(a * np.array([-2.0, 2.0]) + b)))
+    assert 0 < probabilities[0] < 0.5 < probabilities[1] < 1  # 0・1 に張り付かない
+
+
+def test_calibrate_groups_examples_by_question(tmp_path):
+    reranker = LengthReranker()
+    examples = [("q1", "a" * 9, True), ("q1", "a", False), ("q2", "a" * 8, True), ("q2", "aa", False),
+                ("q1", "a" * 7, True), ("q2", "a" * 3, False)]
+    scale, bias = reranker.calibrate(examples)
+    assert sorted(reranker.calls) == [("q1", 3), ("q2", 3)]  # 質問ごとに1回だけ判定する
+    assert scale > 0
+
+    path = str(tmp_path / "calibration.json")
+    reranker.save_calibration(path)
+    restored = LengthReranker()
+    restored.load_calibration(path)
+    assert (restored.scale, restored.bias) == (scale, bias)
+
+
+def test_rerank_and_filter():
+    reranker = LengthReranker()
+    passages = ["aaaaaaa", "a", "aaaaaaaaaa", "aaaa"]
+    assert [i for i, _ in reranker.rerank("q", passages)] == [2, 0, 3, 1]
+    assert [i for i, _ in reranker.rerank("q", passages, top_n=2)] == [2, 0]
+    assert reranker.filter("q", passages, threshold=0.5) == ["aaaaaaa", "aaaaaaaaaa"]  # 元の順序のまま
+    assert reranker.rerank("q", []) == []
+    assert list(reranker._batches(passages)) == [[1, 3], [0, 2]]  # 長さ順のバッチ
+
+
+def test_expected_calibration_error():
+    assert expected_calibration_error([0.9, 0.9, 0.1, 0.1], [1, 1, 0, 0]) == pytest.approx(0.1)
+    assert expected_calibration_error([0.75] * 4, [1, 1, 1, 0]) == pytest.approx(0.0)
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pytest
+
+from retriever import (HNSW_FILE, IVF_FILE, ExactSearch, HNSWSearch, IVFSearch, Retriever,
+                       reciprocal_rank_fusion, top_k)
+
+
+def recall(expected, actual):
+    return np.mean([len(set(e) & set(a)) / len(e) for e, a in zip(expected, actual)])
+
+
+@pytest.fixture
+def clustered_index(build_index, make_encoder):
+    encoder = make_encoder(dim=32, clusters=20, noise=0.5)
+    index = build_index([f"チャンク{i}" for i in range(2000)], encoder, batch_size=256)
+    queries = encoder.encode([f"質問{i}" for i in range(50)], prompt_name="query")
+    return index, queries
+
+
+def test_top_k_matches_full_sort():
+    rng = np.random.default_rng(0)
+    scores = rng.standard_normal((4, 100)).astype(np.float32)
+    indices, best = top_k(scores, 5)
+    np.testing.assert_array_equal(indices, np.argsort(-scores, axis=1)[:, :5])
+    np.testing.assert_array_equal(best, np.take_along_axis(scores, indices, axis=1))
+    assert (np.diff(best, axis=1) <= 0).all()
+
+
+def test_top_k_edge_cases():
+    scores = np.array([0.1, 0.3, 0.2], dtype=np.float32)
+    indices, best = top_k(scores, 10)  # 件数より多いkは全件
+    assert indices.tolist() == [[1, 2, 0]]
+    assert best.dtype == np.float32
+    indices, best = top_k(scores, 0)
+    assert indices.shape == best.shape == (1, 0)
+
+
+def test_exact_search_merges_blocks(clustered_index):
+    index, queries = clustered_index
+    indices, scores = ExactSearch(index, block_size=64).search(queries, 10)
+    expected = np.argsort(-(queries @ np.asarray(index.embeddings).T), axis=1)[:, :10]
+    np.testing.assert_array_equal(indices, expected)
+
+
+def test_ivf_recall(clustered_index):
+    index, queries = clustered_index
+    exact, _ = ExactSearch(index).search(queries, 10)
+    ivf = IVFSearch.build(index, n_probe=8)
+    assert recall(exact, ivf.search(queries, 10)[0]) >= 0.9
+    # 全クラスタを探索すれば厳密な検索と一致する
+    ivf.n_probe = ivf.centroids.shape[0]
+    assert recall(exact, ivf.search(queries, 10)[0]) == 1.0
+
+
+def test_hnsw_recall(clustered_index):
+    pytest.importorskip("hnswlib")
+    index, queries = clustered_index
+    exact, _ = ExactSearch(index).search(queries, 10)
+    indices, scores = HNSWSearch.build(index, ef=64).search(queries, 10)
+    assert recall(exact, indices) >= 0.9
+    np.testing.assert_allclose(scores[:, 0], (queries * np.asarray(index.embeddings)[indices[:, 0]]).sum(axis=1),
+                               atol=1e-5)
+
+
+def test_ivf_is_rebuilt_only_when_the_index_content_changes(encoder, build_index):
+    texts = [f"チャンク{i}" for i in range(200)]
+    index = build_index(texts, encoder)
+    built = IVFSearch.load_or_build(index, n_lists=8)
+    path = os.path.join(index.index_dir, IVF_FILE)
+    mtime = os.path.getmtime(path)
+
+    # 内容が同じまま作り直した索引では、保存済みのクラスタを読み込む
+    loaded = IVFSearch.load_or_build(build_index(texts, encoder), n_lists=8)
+    assert os.path.getmtime(path) == mtime
+    np.testing.assert_array_equal(loaded.list_rows, built.list_rows)
+
+    # 件数が同じでも内容が変われば作り直す（古い割り当てのままだと見つからない行が出る）
+    changed = build_index(texts[:100] + [f"別のチャンク{i}" for i in range(100)], encoder)
+    rebuilt = IVFSearch.load_or_build(changed, n_lists=8)
+    assert rebuilt.digest == changed.digest() != built.digest
+    # チャンク自身の埋め込みで検索すると、割り当てられたクラスタだけを探索しても自身が見つかる
+    rebuilt.n_probe = 1
+    queries = np.asarray(changed.embeddings[100:200])
+    assert rebuilt.search(queries, 1)[0][:, 0].tolist() == list(range(100, 200))
+
+
+def test_hnsw_is_rebuilt_only_when_the_index_content_changes(encoder, build_index):
+    pytest.importorskip("hnswlib")
+    texts = [f"チャンク{i}" for i in range(100)]
+    index = build_index(texts, encoder)
+    HNSWSearch.load_or_build(index)
+    path = os.path.join(index.index_dir, HNSW_FILE)
+    mtime = os.path.getmtime(path)
+    HNSWSearch.load_or_build(build_index(texts, encoder))
+    assert os.path.getmtime(path) == mtime
+
+    changed = build_index([f"別のチャンク{i}" for i in range(100)], encoder)
+    graph = HNSWSearch.load_or_build(changed)
+    queries = np.asarray(changed.embeddings[:10])
+    assert graph.search(queries, 1)[0][:, 0].tolist() == list(range(10))
+
+
+def test_retriever_returns_hits_with_ids_and_texts(encoder, build_index):
+    texts = ["LLMの事前学習", "Inference Time Scaling", "CerebrasGPT"]
+    retriever = Retriever(build_index(texts, encoder))
+    [hits] = retriever.search_text(encoder, ["CerebrasGPT"], top_k=2)
+    assert [hit["row"] for hit in hits][0] == 2
+    assert hits[0]["id"] == "chunk-2" and hits[0]["text"] == "CerebrasGPT"
+    assert len(hits) == 2
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([[3, 1, -1], [1, 2]], k=60)
+    assert fused == pytest.approx({3: 1 / 61, 1: 1 / 62 + 1 / 61, 2: 1 / 62})
+    assert max(fused, key=fused.get) == 1  # 両方で上位に入った行が最上位になる
+    assert reciprocal_rank_fusion([[-1, -1]]) == {}